@@ -0,0 +1,270 @@
+"""
+Benchmarks of the encoders, the event log, the object store, the replay and the events ordering.
+Run from the repository root:
+
+    python -m benchmarks.run                                   # in-process mongomock
+    python -m benchmarks.run --mongo mongodb://localhost:27017  # local mongod
+    python -m benchmarks.run --output current.json --compare baseline.json
+
+The results are written as JSON (one entry per benchmark and parameters with the operations per second). With --compare
+the results are checked against a previous run and the exit code is 1 if any benchmark is slower than the tolerance.
+A benchmark, which fails, is recorded with its error (and the exit code is 1), the other benchmarks still run.
+mongomock doesn't support the bulk writes of pymongo 4.11 and later (used by the write-behind and delta store benchmarks),
+so the 'benchmarks' extra installs an older pymongo. Use --mongo with a newer pymongo
+"""
+import argparse
+import datetime
+import json
+import logging
+import platform
+import sys
+import threading
+import time
+import uuid
+
+import bson
+import numpy as np
+from pyevents.events import SyncListeners
+
+import pyevents_util.mongodb.util as mongoutil
+from pyevents_util.algo_phase import AlgoPhaseEventsOrder
+from pyevents_util.mongodb.mongodb_sequence_log import MongoDBSequenceLog, MongoDBSequenceProvider
+from pyevents_util.mongodb.mongodb_store import MongoDBStore
+
+RESULTS_VERSION = 1
+
+DATABASE = 'pyevents_benchmark'
+
+
+def _group_id():
+    # string ids work with every uuid representation (mongomock can't encode native uuids with pymongo 4)
+    return 'benchmark-' + uuid.uuid4().hex
+
+
+def bench_encoder(db, size: int, operations: int):
+    doc = {'_id': 0, 'type': 'data', 'phase': 'TRAINING_unordered', 'data': {'input': np.random.rand(size), 'target': np.random.rand(size // 10 + 1)}}
+
+    start = time.perf_counter()
+    for _ in range(operations):
+        mongoutil.default_encoder(doc)
+
+    return operations, time.perf_counter() - start
+
+
+def bench_decoder(db, size: int, operations: int):
+    data = bson.encode(mongoutil.default_encoder({'_id': 0, 'type': 'data', 'phase': 'TRAINING_unordered', 'data': {'input': np.random.rand(size), 'target': np.random.rand(size // 10 + 1)}}))
+
+    # default_decoder decodes in place, so each operation decodes a fresh copy of the document (read outside of the timing)
+    seconds = 0
+    for _ in range(operations):
+        doc = bson.decode(data)
+
+        start = time.perf_counter()
+        mongoutil.default_decoder(doc)
+        seconds += time.perf_counter() - start
+
+    return operations, seconds
+
+
+def bench_sequence_log(db, events: int, batch_size: int = None):
+    log = MongoDBSequenceLog(db.events, accept_for_serialization=lambda event: False, listeners=SyncListeners(), group_id=_group_id(), batch_size=batch_size)
+
+    start = time.perf_counter()
+    for i in range(events):
+        log.store({'type': 'data', 'phase': 'TRAINING_unordered', 'data': np.full(16, i)})
+
+    log.close()
+
+    return events, time.perf_counter() - start
+
+
+def bench_store(db, objects: int, ids: int, max_pending: int = None, delta: bool = False):
+    store = MongoDBStore(db.store, accept_for_serialization=lambda event: False, listeners=SyncListeners(), max_pending=max_pending, delta=delta)
+
+    start = time.perf_counter()
+    for i in range(objects):
+        store.store({'_id': i % ids, 'iteration': i, 'weights': np.full(16, i % 3)})
+
+    store.close()
+
+    return objects, time.perf_counter() - start
+
+
+def bench_replay(db, events: int, batch_size: int, prefetch: int = 0):
+    log = MongoDBSequenceLog(db.events, accept_for_serialization=lambda event: False, listeners=SyncListeners(), group_id=_group_id(), batch_size=batch_size)
+    for i in range(events):
+        log.store({'type': 'data', 'phase': 'TRAINING_unordered', 'data': np.full(16, i)})
+    log.close()
+
+    provider = MongoDBSequenceProvider(db.events, group_id=log.group_id, listeners=SyncListeners(), batch_size=batch_size, prefetch=prefetch)
+
+    start = time.perf_counter()
+    count = sum(1 for _ in provider.events())
+
+    return count, time.perf_counter() - start
+
+
+def bench_events_order(db, events: int, phases: int):
+    listeners = SyncListeners()
+
+    names = ['PHASE_' + str(i) for i in range(phases)]
+    order = AlgoPhaseEventsOrder(phases=[(n, 1) for n in names], listeners=listeners)
+
+    total = (events // phases) * phases
+    dispatched = [0]
+    done = threading.Event()
+
+    # each phase has a single iteration per turn and the after_iteration events are fired directly instead of by a model
+    def model(event):
+        if event['type'] == 'data' and not event['phase'].endswith('_unordered'):
+            dispatched[0] += 1
+            listeners({'type': 'after_iteration', 'phase': event['phase']})
+
+            if dispatched[0] == total:
+                done.set()
+
+    listeners += model
+
+    start = time.perf_counter()
+
+    for _ in range(events // phases):
+        for n in names:
+            listeners({'type': 'data', 'phase': n + '_unordered', 'data': None})
+
+    done.wait()
+
+    seconds = time.perf_counter() - start
+
+    order.stop()
+    order.join()
+
+    return total, seconds
+
+
+# (name, function, list of parameters)
+BENCHMARKS = [
+    ('encoder', bench_encoder, [{'size': 100, 'operations': 5000}, {'size': 10000, 'operations': 2000}, {'size': 1000000, 'operations': 50}]),
+    ('decoder', bench_decoder, [{'size': 100, 'operations': 5000}, {'size': 10000, 'operations': 2000}, {'size': 1000000, 'operations': 50}]),
+    ('sequence_log', bench_sequence_log, [{'events': 1000}, {'events': 1000, 'batch_size': 100}]),
+    ('store', bench_store, [{'objects': 2000, 'ids': 200}, {'objects': 2000, 'ids': 200, 'max_pending': 100}, {'objects': 2000, 'ids': 200, 'delta': True}]),
+    ('replay', bench_replay, [{'events': 5000, 'batch_size': 100}, {'events': 5000, 'batch_size': 100, 'prefetch': 2}]),
+    ('events_order', bench_events_order, [{'events': 20000, 'phases': 2}, {'events': 20000, 'phases': 20}]),
+]
+
+
+def connect(mongo: str):
+    """
+    :param mongo: 'mongomock' or a MongoDB connection string
+    :return: database for the benchmarks
+    """
+    if mongo == 'mongomock':
+        import mongomock
+        client = mongomock.MongoClient()
+    else:
+        import pymongo
+        client = pymongo.MongoClient(mongo)
+
+    return client[DATABASE]
+
+
+def run(mongo: str = 'mongomock', repeat: int = 3, names: list = None) -> dict:
+    """
+    Run the benchmarks
+    :param mongo: 'mongomock' or a MongoDB connection string
+    :param repeat: number of runs of each benchmark. The fastest run is reported
+    :param names: names of the benchmarks to run (all if None)
+    :return: results
+    """
+    db = connect(mongo)
+
+    results = list()
+    for name, function, parameters in BENCHMARKS:
+        if names and name not in names:
+            continue
+
+        for params in parameters:
+            best = None
+            try:
+                for _ in range(repeat):
+                    # each run starts with empty collections
+                    for collection in db.list_collection_names():
+                        db.drop_collection(collection)
+
+                    operations, seconds = function(db, **params)
+                    if best is None or seconds < best[1]:
+                        best = (operations, seconds)
+            except Exception as e:
+                logging.getLogger(__name__).exception("Benchmark " + name + ' ' + json.dumps(params, sort_keys=True) + " failed")
+                results.append({'name': name, 'params': params, 'error': type(e).__name__ + ': ' + str(e)})
+                continue
+
+            operations, seconds = best
+            result = {'name': name, 'params': params, 'operations': operations, 'seconds': seconds, 'ops_per_second': operations / seconds if seconds > 0 else float('inf')}
+            results.append(result)
+
+            print(name + ' ' + json.dumps(params, sort_keys=True) + ': ' + '{:.1f}'.format(result['ops_per_second']) + ' ops/s', file=sys.stderr)
+
+    return {'version': RESULTS_VERSION,
+            'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'run_id': str(uuid.uuid4()),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'numpy': np.__version__,
+            'mongo': 'mongomock' if mongo == 'mongomock' else 'mongod',
+            'repeat': repeat,
+            'results': results}
+
+
+def compare(current: dict, baseline: dict, tolerance: float) -> list:
+    """
+    :param current: results of run()
+    :param baseline: results of a previous run()
+    :param tolerance: allowed relative slowdown (0.2 means 20 % fewer operations per second)
+    :return: list of the regressions (name, params, baseline ops/s, current ops/s)
+    """
+    previous = {(r['name'], json.dumps(r['params'], sort_keys=True)): r['ops_per_second'] for r in baseline['results'] if 'error' not in r}
+
+    regressions = list()
+    for r in current['results']:
+        key = (r['name'], json.dumps(r['params'], sort_keys=True))
+        if 'error' not in r and key in previous and r['ops_per_second'] < previous[key] * (1 - tolerance):
+            regressions.append((r['name'], r['params'], previous[key], r['ops_per_second']))
+
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="pyevents_util benchmarks")
+    parser.add_argument('--mongo', default='mongomock', help="'mongomock' (default) or a MongoDB connection string of a local mongod")
+    parser.add_argument('--repeat', type=int, default=3, help="runs of each benchmark (the fastest is reported)")
+    parser.add_argument('--benchmark', action='append', help="run only this benchmark (can be repeated)")
+    parser.add_argument('--output', help="JSON file for the results (stdout by default)")
+    parser.add_argument('--compare', help="JSON results of a previous run to check for regressions")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed relative slowdown for --compare")
+    args = parser.parse_args(argv)
+
+    results = run(args.mongo, args.repeat, args.benchmark)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    failed = any('error' in r for r in results['results'])
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+
+        for name, params, before, after in regressions:
+            print("Regression " + name + ' ' + json.dumps(params, sort_keys=True) + ': ' + '{:.1f} -> {:.1f}'.format(before, after) + ' ops/s', file=sys.stderr)
+
+        return 1 if regressions or failed else 0
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,19 +1,102 @@
+import collections
+import collections.abc
+import functools
+import itertools
 import logging
 import queue
 import threading
+import time
 import typing
+from concurrent.futures import ThreadPoolExecutor
 
+from pyevents_util.events import AfterIterationEvent, BeforeIterationEvent, event_factory
+from pyevents_util.metrics import SIZE_BUCKETS
+from pyevents_util.routing import subscribe
 
-class AlgoPhase(object):
-    """Simple training/testing/evaluation class"""
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def stack_inputs(inputs: list):
+    """
+    Combine the inputs of several iterations into a single batch: numpy arrays are stacked along a new first axis,
+    dicts (like feed dicts) are combined per key and all other inputs are collected in a list
+    :param inputs: list of model inputs
+    :return: batch input
+    """
+    first = inputs[0]
+
+    if isinstance(first, dict):
+        return {k: stack_inputs([i[k] for i in inputs]) for k in first}
+
+    if np is not None and isinstance(first, np.ndarray):
+        return np.stack(inputs)
+
+    return list(inputs)
+
+
+def split_outputs(output, size: int):
+    """
+    Split the output of a batch into the outputs of the individual iterations. dicts are split per key, sequences with
+    length size are split along the first axis. All other outputs (None, scalars, aggregated values) are passed to all iterations
+    :param output: batch output
+    :param size: batch size
+    :return: list of outputs
+    """
+    if isinstance(output, dict):
+        parts = {k: split_outputs(v, size) for k, v in output.items()}
+        return [{k: parts[k][i] for k in parts} for i in range(size)]
+
+    if (isinstance(output, (list, tuple)) or (np is not None and isinstance(output, np.ndarray) and output.ndim > 0)) and len(output) == size:
+        return list(output)
 
-    def __init__(self, model, listeners, phase=None, event_processor=None):
+    return [output] * size
+
+
+class AlgoPhase(object):
+    """
+    Simple training/testing/evaluation class.
+    If batch_size is set, the inputs of up to batch_size data events (or the inputs, collected in batch_timeout seconds)
+    are combined with collate, the model is called once for all of them and its output is split back with split.
+    Each input still has its own iteration number and before_iteration/after_iteration events.
+    If workers is set, the model is called on a thread pool (for thread safe models, which release the GIL) with at most
+    max_in_flight pending iterations. The after_iteration events are still fired in iteration order
+    """
+
+    def __init__(self, model, listeners, phase=None, event_processor=None, batch_size: int = None, batch_timeout: float = None,
+                 collate: typing.Callable = stack_inputs, split: typing.Callable = split_outputs, workers: int = None, max_in_flight: int = None,
+                 compact_events: bool = False, metrics=None):
+        """
+        :param model: function, which is called with the input data of each iteration
+        :param listeners: event listeners
+        :param phase: phase of the data events, processed by this instance
+        :param event_processor: input event processor
+        :param batch_size: maximum number of inputs per model call (no batching if None)
+        :param batch_timeout: maximum time in seconds to wait for a batch to fill up (wait indefinitely if None)
+        :param collate: function, which combines a list of inputs into a batch
+        :param split: function(output, size), which splits the batch output into a list of outputs
+        :param workers: number of threads to run the model on (the model runs on the thread of the data event if None)
+        :param max_in_flight: maximum number of submitted, but not completed model calls (2 * workers by default). process() blocks, when it is reached
+        :param compact_events: fire the before_iteration/after_iteration events as slotted Event objects instead of dicts
+        :param metrics: MetricsRegistry for the model latency, iterations and batch sizes (no metrics if None)
+        """
         self._phase = phase
         self._model = model
         self._iteration = 0
 
+        self._before_iteration_event = event_factory(BeforeIterationEvent, compact_events)
+        self._after_iteration_event = event_factory(AfterIterationEvent, compact_events)
+
+        self._metrics = metrics
+        if metrics is not None:
+            self._model_latency = metrics.histogram('pyevents_model_latency_seconds', "Duration of the model calls", phase=phase)
+            self._iterations = metrics.counter('pyevents_iterations_total', "Completed iterations", phase=phase)
+            self._batch_sizes = metrics.histogram('pyevents_batch_size', "Number of inputs per model call", buckets=SIZE_BUCKETS, phase=phase)
+
         self.listeners = listeners
-        self.listeners += self.onevent
+        subscribe(self.listeners, self.onevent, [('data', phase)])
 
         self._lock = threading.RLock()
 
@@ -22,83 +105,567 @@ class AlgoPhase(object):
         else:
             self.input_event_processor = self.onevent
 
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self._collate = collate
+        self._split = split
+
+        self._batch = list()
+        self._batch_lock = threading.Lock()
+
+        # the partial batches are flushed after batch_timeout by a single flusher thread, which waits for the deadline
+        # of the current batch. It is started with the first partial batch and stopped by close()
+        self._batch_ready = threading.Condition(self._lock)
+        self._batch_deadline = None
+        self._flusher = None
+
+        if workers is not None:
+            self._executor = self._create_executor(workers)
+            self._in_flight = threading.BoundedSemaphore(max_in_flight if max_in_flight is not None else 2 * workers)
+        else:
+            self._executor = None
+            self._in_flight = None
+
+        self._reorder_lock = threading.RLock()
+        self._completed = dict()
+        self._next_iteration = 1
+
     def process(self, data):
+        if self.batch_size is not None:
+            self._add_to_batch(data)
+            return
+
         with self._lock:
+            # the permits are taken in iteration order. They are released in this order too, so a caller with a later
+            # iteration can't hold the last permit, while the earlier iteration waits for one
+            if self._in_flight is not None:
+                self._in_flight.acquire()
+
             self._iteration += 1
             iteration = self._iteration
 
-        self.listeners({'type': 'before_iteration', 'model': self._model, 'phase': self._phase, 'iteration': iteration, 'model_input': data})
+        self.listeners(self._before_iteration_event(self._model, self._phase, iteration, data))
 
         logging.getLogger(__name__).debug("Phase " + str(self._phase) + " iteration " + str(iteration))
 
+        if self._executor is not None:
+            self._submit([(iteration, data)], data, batched=False)
+            return
+
+        start = time.perf_counter() if self._metrics is not None else None
+
         model_output = self._model(data)
 
-        self.listeners({'type': 'after_iteration', 'model': self._model, 'phase': self._phase, 'iteration': iteration, 'model_input': data, 'model_output': model_output})
+        if start is not None:
+            self._record_call(start, 1)
+
+        self.listeners(self._after_iteration_event(self._model, self._phase, iteration, data, model_output))
+
+    def _add_to_batch(self, data):
+        with self._lock:
+            self._iteration += 1
+            self._batch.append((self._iteration, data))
+
+            full = len(self._batch) >= self.batch_size
+
+            if not full and len(self._batch) == 1 and self.batch_timeout is not None:
+                self._batch_deadline = time.monotonic() + self.batch_timeout
+
+                if self._flusher is None:
+                    self._flusher = threading.Thread(target=self._flush_on_timeout, name='AlgoPhase-flusher', daemon=True)
+                    self._flusher.start()
+
+                self._batch_ready.notify()
+
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Process the collected batch"""
+        with self._batch_lock:
+            with self._lock:
+                batch, self._batch = self._batch, list()
+
+                self._batch_deadline = None
+
+            if not batch:
+                return
+
+            for iteration, data in batch:
+                self.listeners(self._before_iteration_event(self._model, self._phase, iteration, data))
+
+            logging.getLogger(__name__).debug("Phase " + str(self._phase) + " iterations " + str(batch[0][0]) + "-" + str(batch[-1][0]))
+
+            if self._executor is not None:
+                # the batches are submitted in order under the batch lock
+                self._in_flight.acquire()
+                self._submit(batch, self._collate([data for _, data in batch]), batched=True)
+                return
+
+            start = time.perf_counter() if self._metrics is not None else None
+
+            outputs = self._split(self._model(self._collate([data for _, data in batch])), len(batch))
+
+            if start is not None:
+                self._record_call(start, len(batch))
+
+            for (iteration, data), model_output in zip(batch, outputs):
+                self.listeners(self._after_iteration_event(self._model, self._phase, iteration, data, model_output))
+
+    def _flush_on_timeout(self):
+        """Flush the partial batches, which didn't fill up until their deadline. Runs on the flusher thread"""
+        while True:
+            with self._batch_ready:
+                while self._flusher is threading.current_thread() and (self._batch_deadline is None or self._batch_deadline > time.monotonic()):
+                    self._batch_ready.wait(None if self._batch_deadline is None else self._batch_deadline - time.monotonic())
+
+                if self._flusher is not threading.current_thread():
+                    return
+
+                self._batch_deadline = None
+
+            self.flush()
+
+    def _create_executor(self, workers):
+        return ThreadPoolExecutor(max_workers=workers)
+
+    def _call_async(self, model_input):
+        """
+        :return: future with the output of the model
+        """
+        return self._executor.submit(self._model, model_input)
+
+    def _submit(self, batch, model_input, batched: bool):
+        """Run the model on the executor with an acquired in-flight permit. The after_iteration events are fired by _complete"""
+        start = time.perf_counter()
+
+        future = self._call_async(model_input)
+
+        if self._metrics is not None:
+            future.add_done_callback(lambda f: self._record_call(start, len(batch)))
+
+        future.add_done_callback(functools.partial(self._complete, batch, batched))
+
+    def _record_call(self, start: float, size: int):
+        self._model_latency.since(start)
+        self._iterations.inc(size)
+
+        if self.batch_size is not None:
+            self._batch_sizes.observe(size)
+
+    def _complete(self, batch, batched, future):
+        """Fire the after_iteration events of all completed iterations, which are next in order"""
+        with self._reorder_lock:
+            self._completed[batch[0][0]] = (batch, batched, future)
+
+            while self._next_iteration in self._completed:
+                batch, batched, future = self._completed.pop(self._next_iteration)
+                self._next_iteration = batch[-1][0] + 1
+                self._in_flight.release()
+
+                try:
+                    outputs, error = self._split(future.result(), len(batch)) if batched else [future.result()], None
+                except Exception as e:
+                    logging.getLogger(__name__).exception("Phase " + str(self._phase) + " iteration " + str(batch[0][0]) + " failed")
+                    outputs, error = [None] * len(batch), e
+
+                for (iteration, data), model_output in zip(batch, outputs):
+                    event = self._after_iteration_event(self._model, self._phase, iteration, data, model_output)
+                    if error is not None:
+                        event['error'] = error
+
+                    self.listeners(event)
+
+    def close(self):
+        """Process the collected batch and wait for the running model calls"""
+        with self._batch_ready:
+            flusher, self._flusher = self._flusher, None
+            self._batch_ready.notify()
+
+        if flusher is not None and flusher is not threading.current_thread():
+            flusher.join()
+
+        self.flush()
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
 
     def onevent(self, event):
         if event['type'] == 'data' and 'phase' in event and event['phase'] == self._phase:
             self.process(event['data'])
 
 
+# number of the threads, which send the events of all AlgoPhaseEventsOrder instances
+SCHEDULER_THREADS = 4
+
+
+class _Scheduler(object):
+    """
+    Small pool of daemon threads, which runs the scheduled tasks of all AlgoPhaseEventsOrder instances. The threads are
+    started with the first task
+    """
+
+    def __init__(self, threads: int):
+        self.threads = threads
+
+        self._tasks = queue.Queue()
+        self._lock = threading.Lock()
+        self._started = False
+
+    def schedule(self, task):
+        with self._lock:
+            if not self._started:
+                for i in range(self.threads):
+                    threading.Thread(target=self._run, name='AlgoPhaseEventsOrder-' + str(i), daemon=True).start()
+
+                self._started = True
+
+        self._tasks.put(task)
+
+    def _run(self):
+        while True:
+            task = self._tasks.get()
+
+            try:
+                task()
+            except Exception as e:
+                logging.getLogger(__name__).exception("Scheduled task failed: " + str(e))
+
+
+_scheduler = _Scheduler(SCHEDULER_THREADS)
+
+
 class AlgoPhaseEventsOrder(object):
-    def __init__(self, phases: typing.List[typing.Tuple[str, int]], listeners, phase_suffix='_unordered'):
+    """
+    Reorder the unordered data events of several phases (e.g. training and testing): the events of each phase are
+    queued and sent (without the phase suffix) in turns, after the given number of iterations of the previous phase.
+    The queues can be bounded with one of the overflow policies:
+
+    - 'block': wait for free space in the queue (in the producer thread, which calls put()). The events from the
+      listeners never block the sending thread (with AsyncListeners it is the only dispatch thread, which also has to deliver
+      the after_iteration events that free the queue): they wait in a FIFO of up to max_pending events per phase and
+      further events are rejected
+    - 'drop_oldest': drop the oldest queued event of the phase and send a 'data_dropped' event with it
+    - 'reject': drop the new event and send a 'data_rejected' event with it
+
+    The instances don't have their own threads: the events are sent by a pool of SCHEDULER_THREADS threads, which is
+    shared by all instances. The turns of each instance run serially (in order) on one of the threads at a time, so a slow
+    listener (or model of a SyncListeners phase) occupies a single thread and delays the other instances only if all the
+    threads are busy.
+    The ordering starts with the first event (or with start()) and ends with a phase None (or with stop())
+    """
+
+    BLOCK = 'block'
+    DROP_OLDEST = 'drop_oldest'
+    REJECT = 'reject'
+
+    def __init__(self, phases: typing.List[typing.Tuple[str, int]], listeners, phase_suffix='_unordered', capacity: typing.Union[int, typing.Dict[str, int]] = None, overflow: str = 'block',
+                 metrics=None, max_pending: int = None):
+        """
+        :param phases: list of (phase, number of iterations) in the order of execution
+        :param listeners: event listeners
+        :param phase_suffix: suffix of the phases of the unordered data events
+        :param capacity: maximum number of queued events per phase (or dict with the capacity of each phase). Unbounded by default
+        :param overflow: what to do with the events of a full queue: 'block', 'drop_oldest' or 'reject'
+        :param metrics: MetricsRegistry for the queue depths, high-water marks and dropped/rejected events (no metrics if None)
+        :param max_pending: maximum number of events from the listeners, which wait for a full queue with the 'block' policy
+        (per phase, the capacity of the phase by default)
+        """
+        if overflow not in (self.BLOCK, self.DROP_OLDEST, self.REJECT):
+            raise ValueError("Unknown overflow policy " + str(overflow))
+
         self.phases = phases
 
         self.listeners = listeners
-        self.listeners += self.listener
+        subscribe(self.listeners, self.listener, [r for p in phases if p[0] is not None for r in (('after_iteration', p[0]), ('data', p[0] + phase_suffix))])
 
         self.phase_suffix = phase_suffix
 
-        self._lock = threading.RLock()
+        self.overflow = overflow
 
-        self.event_queues = {p[0]: queue.Queue() for p in phases}
+        self._lock = threading.Lock()
+
+        # phase -> index in self.phases
+        self._index = {p[0]: i for i, p in enumerate(phases)}
+
+        capacities = capacity if isinstance(capacity, dict) else {p[0]: capacity for p in phases}
+
+        self.event_queues = {p[0]: queue.Queue(maxsize=capacities.get(p[0]) or 0) for p in phases}
+
+        # events from the listeners, which wait for free space in the full queues ('block' policy). Guarded by self._lock
+        self._pending = {p[0]: collections.deque() for p in phases}
+        self._max_pending = {p[0]: max_pending if max_pending is not None else capacities.get(p[0]) or 0 for p in phases}
 
         self.phases_queue = queue.Queue()
 
-        self.phases_count = {p[0]: 0 for p in phases}
+        # number of after_iteration events of each phase
+        self._counts = [itertools.count(1) for _ in phases]
+
+        self._high_water = {p[0]: 0 for p in phases}
+        self._dropped = {p[0]: 0 for p in phases}
+        self._rejected = {p[0]: 0 for p in phases}
+
+        # current phase and number of events, which are still to be sent in its turn. Used only by the running _run
+        self._phase = None
+        self._remaining = 0
+
+        self._started = False
+
+        # _run is scheduled or running (at most once per instance, so the turns run serially). With _rerun it runs again
+        self._scheduled = False
+        self._rerun = False
 
-        self.thread = None
+        self._stopping = False
+        self._stopped = threading.Event()
+
+        if metrics is not None:
+            for p in self.event_queues:
+                if p is not None:
+                    metrics.gauge('pyevents_queue_depth', self.event_queues[p].qsize, "Queued unordered data events", phase=p)
+                    metrics.gauge('pyevents_queue_high_water', functools.partial(self._high_water.get, p), "Maximum number of queued unordered data events", phase=p)
+                    metrics.gauge('pyevents_queue_dropped', functools.partial(self._dropped.get, p), "Data events, dropped from full queues", phase=p)
+                    metrics.gauge('pyevents_queue_rejected', functools.partial(self._rejected.get, p), "Data events, rejected by full queues", phase=p)
 
     def listener(self, event):
-        if isinstance(event, dict) and 'type' in event and event['type'] == 'after_iteration' and 'phase' in event:
+        if isinstance(event, collections.abc.Mapping) and 'type' in event and event['type'] == 'after_iteration' and 'phase' in event:
             if event['phase'].endswith(self.phase_suffix):
                 raise Exception("after_iteration events cannot be unordered")
 
-            self.start_generator()
+            ind = self._index.get(event['phase'])
+            if ind is None:
+                return
 
-            with self._lock:
-                phase = event['phase']
+            self.start()
+
+            # itertools.count is atomic, so concurrent after_iteration events don't need a lock
+            if next(self._counts[ind]) % self.phases[ind][1] == 0:
+                self.phases_queue.put(self.phases[(ind + 1) % len(self.phases)][0])
+                self._schedule()
+        elif isinstance(event, collections.abc.Mapping) and 'type' in event and event['type'] == 'data' and 'phase' in event and event['phase'].endswith(self.phase_suffix):
+            if self._strip_suffix(event['phase']) in self.event_queues:
+                if self.overflow == self.BLOCK:
+                    self._offer(event)
+                else:
+                    self.put(event)
+
+    def _offer(self, event) -> bool:
+        """Queue an event from a listener with the 'block' policy. The events for a full queue wait in the pending FIFO"""
+        self.start()
+
+        phase = self._strip_suffix(event['phase'])
+        q, pending = self.event_queues[phase], self._pending[phase]
+
+        queued = False
+
+        with self._lock:
+            if not pending:
+                try:
+                    q.put_nowait(event)
+                    queued = True
+                except queue.Full:
+                    pass
 
-                self.phases_count[phase] += 1
+            if queued:
+                depth = q.qsize()
+                if depth > self._high_water[phase]:
+                    self._high_water[phase] = depth
+            elif len(pending) < self._max_pending[phase]:
+                pending.append(event)
+                return True
 
-                ind = [p[0] for p in self.phases].index(phase)
+        if not queued:
+            return self._reject(phase, event)
 
-                if self.phases_count[phase] == self.phases[ind][1]:
-                    self.phases_count[phase] = 0
-                    self.phases_queue.put(self.phases[(ind + 1) % len(self.phases)][0])
-        elif isinstance(event, dict) and 'type' in event and event['type'] == 'data' and 'phase' in event and event['phase'].endswith(self.phase_suffix):
-            self.start_generator()
-            self.event_queues[event['phase'].replace(self.phase_suffix, '')].put(event)
+        if phase == self._phase:
+            self._schedule()
+
+        return True
+
+    def _refill(self, phase):
+        """Move the pending events to the free space of the queue"""
+        q, pending = self.event_queues[phase], self._pending[phase]
+
+        with self._lock:
+            while pending:
+                try:
+                    q.put_nowait(pending[0])
+                except queue.Full:
+                    break
+
+                pending.popleft()
+
+    def put(self, event, timeout: float = None) -> bool:
+        """
+        Queue an unordered data event according to the overflow policy. Producers can call this method directly
+        (instead of sending the event to the listeners) to be throttled in their own thread with the 'block' policy.
+        It must not be called with the 'block' policy from a listener: the full queue would block the dispatch thread
+        :param event: unordered data event
+        :param timeout: maximum time to wait for free space with the 'block' policy (no limit by default)
+        :return: True if the event was queued, False if it was rejected
+        """
+        self.start()
+
+        phase = self._strip_suffix(event['phase'])
+        q = self.event_queues[phase]
+
+        if self.overflow == self.BLOCK:
+            try:
+                q.put(event, timeout=timeout)
+            except queue.Full:
+                return self._reject(phase, event)
+        elif self.overflow == self.DROP_OLDEST:
+            while True:
+                try:
+                    q.put_nowait(event)
+                    break
+                except queue.Full:
+                    pass
+
+                try:
+                    dropped = q.get_nowait()
+                except queue.Empty:
+                    continue
+
+                q.task_done()
+
+                with self._lock:
+                    self._dropped[phase] += 1
+
+                self.listeners({'type': 'data_dropped', 'phase': phase, 'event': dropped})
+        else:
+            try:
+                q.put_nowait(event)
+            except queue.Full:
+                return self._reject(phase, event)
+
+        depth = q.qsize()
+        with self._lock:
+            if depth > self._high_water[phase]:
+                self._high_water[phase] = depth
+
+        if phase == self._phase:
+            self._schedule()
+
+        return True
+
+    def _strip_suffix(self, phase):
+        return phase[:-len(self.phase_suffix)] if self.phase_suffix else phase
+
+    def _reject(self, phase, event):
+        with self._lock:
+            self._rejected[phase] += 1
+
+        self.listeners({'type': 'data_rejected', 'phase': phase, 'event': event})
+
+        return False
+
+    def queue_stats(self) -> dict:
+        """
+        :return: dict with the current depth, the capacity (None if unbounded), the high-water mark, the number of
+        dropped and rejected events and the number of pending events (waiting for a full queue) of the queue of each phase
+        """
+        with self._lock:
+            return {p: {'depth': q.qsize(),
+                        'capacity': q.maxsize or None,
+                        'pending': len(self._pending[p]),
+                        'high_water': self._high_water[p],
+                        'dropped': self._dropped[p],
+                        'rejected': self._rejected[p]} for p, q in self.event_queues.items()}
+
+    def start(self):
+        """
+        Start the ordering with the first phase. Called automatically with the first event
+        """
+        with self._lock:
+            if self._started:
+                return
+
+            self._started = True
+
+        self.phases_queue.put(self.phases[0][0])
+        self._schedule()
 
     def start_generator(self):
+        self.start()
+
+    def stop(self):
+        """
+        Stop the ordering. The already queued events of the current turn are still sent
+        """
+        self.start()
+        self._stopping = True
+        self.phases_queue.put(None)
+        self._schedule()
+
+    def join(self, timeout: float = None) -> bool:
+        """
+        Wait for the end of the ordering (phase None or stop())
+        :param timeout: maximum time to wait in seconds (no limit by default)
+        :return: True if the ordering has ended
+        """
+        return self._stopped.wait(timeout)
+
+    def _schedule(self):
         with self._lock:
-            if self.thread is None:
-                self.phases_queue.put(self.phases[0][0])
+            if self._stopped.is_set():
+                return
+
+            if self._scheduled:
+                self._rerun = True
+                return
+
+            self._scheduled = True
+
+        _scheduler.schedule(self._run)
+
+    def _run(self):
+        while True:
+            self._send()
+
+            with self._lock:
+                if not self._rerun or self._stopped.is_set():
+                    self._scheduled = False
+                    return
+
+                self._rerun = False
+
+    def _send(self):
+        """Send the queued events of the current turns"""
+        while True:
+            if self._remaining == 0:
+                try:
+                    phase = self.phases_queue.get_nowait()
+                except queue.Empty:
+                    return
+
+                self.phases_queue.task_done()
+
+                if phase is None:
+                    self._end()
+                    return
+
+                self._phase = phase
+                self._remaining = self.phases[self._index[phase]][1]
+
+                continue
+
+            q = self.event_queues[self._phase]
+            try:
+                event = q.get_nowait().copy()
+            except queue.Empty:
+                if self._stopping:
+                    self._end()
 
-                def events_generator():
-                    while True:
-                        phase = self.phases_queue.get()
+                return
 
-                        if phase is None:
-                            break
+            self._remaining -= 1
 
-                        for i in range(self.phases[[p[0] for p in self.phases].index(phase)][1]):
-                            event = self.event_queues[phase].get().copy()
-                            event['phase'] = phase
-                            self.listeners(event)
-                            self.event_queues[phase].task_done()
+            self._refill(self._phase)
 
-                        self.phases_queue.task_done()
+            event['phase'] = self._phase
+            self.listeners(event)
+            q.task_done()
 
-                self.thread = threading.Thread(target=events_generator, daemon=True)
-                self.thread.start()
+    def _end(self):
+        self._phase = None
+        self._stopped.set()
@@ -0,0 +1,364 @@
+import asyncio
+import collections
+import collections.abc
+import inspect
+import logging
+import time
+import typing
+
+from pyevents_util.algo_phase import AlgoPhaseEventsOrder
+from pyevents_util.events import AfterIterationEvent, BeforeIterationEvent, event_factory
+from pyevents_util.routing import subscribe
+
+
+def _call_soon(loop, fn, *args):
+    """Call fn in the thread of the event loop: directly if already there, otherwise thread safe"""
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+
+    if running is loop:
+        fn(*args)
+    else:
+        loop.call_soon_threadsafe(fn, *args)
+
+
+class AsyncAlgoPhase(object):
+    """
+    asyncio counterpart of AlgoPhase. Each data event of the phase is processed in its own task on the event loop.
+    The model can be a coroutine function (or return an awaitable). Blocking models can be offloaded with
+    run_in_executor. The events are the same as in AlgoPhase and the after_iteration events are fired in iteration order.
+    If the model fails, the after_iteration event has an 'error' key with the exception
+    """
+
+    def __init__(self, model, listeners, phase=None, run_in_executor: bool = False, executor=None, max_in_flight: int = None, loop: asyncio.AbstractEventLoop = None,
+                 compact_events: bool = False, metrics=None):
+        """
+        :param model: function or coroutine function, which is called with the input data of each iteration
+        :param listeners: event listeners
+        :param phase: phase of the data events, processed by this instance
+        :param run_in_executor: run a (blocking) model with loop.run_in_executor
+        :param executor: executor for run_in_executor (the default executor of the loop if None)
+        :param max_in_flight: maximum number of concurrently running model calls (unlimited by default)
+        :param loop: event loop (the running loop by default)
+        :param compact_events: fire the before_iteration/after_iteration events as slotted Event objects instead of dicts
+        :param metrics: MetricsRegistry for the model latency and iterations (no metrics if None)
+        """
+        self._phase = phase
+        self._model = model
+        self._iteration = 0
+
+        self._before_iteration_event = event_factory(BeforeIterationEvent, compact_events)
+        self._after_iteration_event = event_factory(AfterIterationEvent, compact_events)
+
+        self._metrics = metrics
+        if metrics is not None:
+            self._model_latency = metrics.histogram('pyevents_model_latency_seconds', "Duration of the model calls", phase=phase)
+            self._iterations = metrics.counter('pyevents_iterations_total', "Completed iterations", phase=phase)
+
+        self.listeners = listeners
+        subscribe(self.listeners, self.onevent, [('data', phase)])
+
+        self._loop = loop if loop is not None else asyncio.get_running_loop()
+
+        self._run_in_executor = run_in_executor or executor is not None
+        self._executor = executor
+
+        self._in_flight = asyncio.Semaphore(max_in_flight) if max_in_flight is not None else None
+
+        self._tasks = set()
+        self._completed = dict()
+        self._next_iteration = 1
+
+    async def process(self, data):
+        self._iteration += 1
+        iteration = self._iteration
+
+        if self._in_flight is not None:
+            await self._in_flight.acquire()
+
+        try:
+            self.listeners(self._before_iteration_event(self._model, self._phase, iteration, data))
+
+            logging.getLogger(__name__).debug("Phase " + str(self._phase) + " iteration " + str(iteration))
+
+            start = time.perf_counter()
+
+            try:
+                model_output, error = await self._call(data), None
+            except Exception as e:
+                logging.getLogger(__name__).exception("Phase " + str(self._phase) + " iteration " + str(iteration) + " failed")
+                model_output, error = None, e
+
+            if self._metrics is not None:
+                self._model_latency.since(start)
+                self._iterations.inc()
+        finally:
+            if self._in_flight is not None:
+                self._in_flight.release()
+
+        self._complete(iteration, data, model_output, error)
+
+    async def _call(self, data):
+        if self._run_in_executor and not asyncio.iscoroutinefunction(self._model):
+            model_output = await self._loop.run_in_executor(self._executor, self._model, data)
+        else:
+            model_output = self._model(data)
+
+        if inspect.isawaitable(model_output):
+            model_output = await model_output
+
+        return model_output
+
+    def _complete(self, iteration, data, model_output, error):
+        """Fire the after_iteration events of all completed iterations, which are next in order"""
+        self._completed[iteration] = (data, model_output, error)
+
+        while self._next_iteration in self._completed:
+            data, model_output, error = self._completed.pop(self._next_iteration)
+
+            event = self._after_iteration_event(self._model, self._phase, self._next_iteration, data, model_output)
+            if error is not None:
+                event['error'] = error
+
+            self._next_iteration += 1
+
+            self.listeners(event)
+
+    def _create_task(self, data):
+        task = self._loop.create_task(self.process(data))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def close(self):
+        """Wait for the running iterations"""
+        while self._tasks:
+            await asyncio.gather(*self._tasks)
+
+    def onevent(self, event):
+        if event['type'] == 'data' and 'phase' in event and event['phase'] == self._phase:
+            _call_soon(self._loop, self._create_task, event['data'])
+
+
+class AsyncAlgoPhaseEventsOrder(object):
+    """
+    asyncio counterpart of AlgoPhaseEventsOrder. The phases are scheduled by a task on the event loop and the events
+    of each phase are queued in bounded asyncio queues with the same overflow policies. With the 'block' policy,
+    producers in coroutines can await put() to be throttled. The events from the listeners can't wait: the events for a
+    full queue are kept in order in a FIFO of up to max_pending events per phase, which is moved to the queue as it is
+    consumed. Further events are rejected (with a 'data_rejected' event)
+    """
+
+    def __init__(self, phases: typing.List[typing.Tuple[str, int]], listeners, phase_suffix='_unordered', capacity: typing.Union[int, typing.Dict[str, int]] = None, overflow: str = 'block',
+                 loop: asyncio.AbstractEventLoop = None, max_pending: int = None):
+        """
+        :param phases: list of (phase, number of iterations) in the order of execution
+        :param listeners: event listeners
+        :param phase_suffix: suffix of the phases of the unordered data events
+        :param capacity: maximum number of queued events per phase (or dict with the capacity of each phase). Unbounded by default
+        :param overflow: what to do with the events of a full queue: 'block', 'drop_oldest' or 'reject'
+        :param loop: event loop (the running loop by default)
+        :param max_pending: maximum number of events from the listeners, which wait for a full queue with the 'block' policy
+        (per phase, the capacity of the phase by default)
+        """
+        if overflow not in (AlgoPhaseEventsOrder.BLOCK, AlgoPhaseEventsOrder.DROP_OLDEST, AlgoPhaseEventsOrder.REJECT):
+            raise ValueError("Unknown overflow policy " + str(overflow))
+
+        self.phases = phases
+
+        self.listeners = listeners
+        subscribe(self.listeners, self.listener, [r for p in phases if p[0] is not None for r in (('after_iteration', p[0]), ('data', p[0] + phase_suffix))])
+
+        self.phase_suffix = phase_suffix
+
+        self.overflow = overflow
+
+        self._loop = loop if loop is not None else asyncio.get_running_loop()
+
+        self._index = {p[0]: i for i, p in enumerate(phases)}
+
+        capacities = capacity if isinstance(capacity, dict) else {p[0]: capacity for p in phases}
+
+        self.event_queues = {p[0]: asyncio.Queue(maxsize=capacities.get(p[0]) or 0) for p in phases}
+
+        # events from the listeners, which wait for free space in the full queues ('block' policy)
+        self._pending = {p[0]: collections.deque() for p in phases}
+        self._max_pending = {p[0]: max_pending if max_pending is not None else capacities.get(p[0]) or 0 for p in phases}
+
+        self.phases_queue = asyncio.Queue()
+
+        self._counts = [0] * len(phases)
+
+        self._high_water = {p[0]: 0 for p in phases}
+        self._dropped = {p[0]: 0 for p in phases}
+        self._rejected = {p[0]: 0 for p in phases}
+
+        self._task = None
+        self._started = asyncio.Event()
+        self._stopping = asyncio.Event()
+
+    def listener(self, event):
+        if isinstance(event, collections.abc.Mapping) and 'type' in event and event['type'] == 'after_iteration' and 'phase' in event:
+            if event['phase'].endswith(self.phase_suffix):
+                raise Exception("after_iteration events cannot be unordered")
+
+            if event['phase'] in self._index:
+                _call_soon(self._loop, self._after_iteration, event['phase'])
+        elif isinstance(event, collections.abc.Mapping) and 'type' in event and event['type'] == 'data' and 'phase' in event and event['phase'].endswith(self.phase_suffix):
+            if self._strip_suffix(event['phase']) in self.event_queues:
+                _call_soon(self._loop, self._offer, event)
+
+    def _after_iteration(self, phase):
+        self.start()
+
+        ind = self._index[phase]
+        self._counts[ind] += 1
+
+        if self._counts[ind] == self.phases[ind][1]:
+            self._counts[ind] = 0
+            self.phases_queue.put_nowait(self.phases[(ind + 1) % len(self.phases)][0])
+
+    def _offer(self, event):
+        """Queue an event from a listener. With the 'block' policy, the events for a full queue wait in the pending FIFO"""
+        phase = self._strip_suffix(event['phase'])
+        pending = self._pending[phase]
+
+        if self.overflow == AlgoPhaseEventsOrder.BLOCK and (pending or self.event_queues[phase].full()):
+            self.start()
+
+            if len(pending) < self._max_pending[phase]:
+                pending.append(event)
+            else:
+                self._reject(phase, event)
+        else:
+            self._put_nowait(event)
+
+    def _refill(self, phase):
+        """Move the pending events to the free space of the queue"""
+        q, pending = self.event_queues[phase], self._pending[phase]
+
+        while pending and not q.full():
+            q.put_nowait(pending.popleft())
+
+    async def put(self, event) -> bool:
+        """
+        Queue an unordered data event according to the overflow policy
+        :param event: unordered data event
+        :return: True if the event was queued, False if it was rejected
+        """
+        if self.overflow == AlgoPhaseEventsOrder.BLOCK:
+            self.start()
+
+            phase = self._strip_suffix(event['phase'])
+            await self.event_queues[phase].put(event)
+            self._update_high_water(phase)
+
+            return True
+
+        return self._put_nowait(event)
+
+    def _put_nowait(self, event) -> bool:
+        self.start()
+
+        phase = self._strip_suffix(event['phase'])
+        q = self.event_queues[phase]
+
+        if q.full():
+            if self.overflow == AlgoPhaseEventsOrder.REJECT:
+                return self._reject(phase, event)
+
+            if self.overflow == AlgoPhaseEventsOrder.DROP_OLDEST:
+                dropped = q.get_nowait()
+                q.task_done()
+                self._dropped[phase] += 1
+                self.listeners({'type': 'data_dropped', 'phase': phase, 'event': dropped})
+
+        q.put_nowait(event)
+        self._update_high_water(phase)
+
+        return True
+
+    def _reject(self, phase, event):
+        self._rejected[phase] += 1
+        self.listeners({'type': 'data_rejected', 'phase': phase, 'event': event})
+
+        return False
+
+    def _update_high_water(self, phase):
+        depth = self.event_queues[phase].qsize()
+        if depth > self._high_water[phase]:
+            self._high_water[phase] = depth
+
+    def _strip_suffix(self, phase):
+        return phase[:-len(self.phase_suffix)] if self.phase_suffix else phase
+
+    def queue_stats(self) -> dict:
+        """
+        :return: dict with the current depth, the capacity (None if unbounded), the high-water mark, the number of
+        dropped and rejected events and the number of pending events (waiting for a full queue) of the queue of each phase
+        """
+        return {p: {'depth': q.qsize(),
+                    'capacity': q.maxsize or None,
+                    'pending': len(self._pending[p]),
+                    'high_water': self._high_water[p],
+                    'dropped': self._dropped[p],
+                    'rejected': self._rejected[p]} for p, q in self.event_queues.items()}
+
+    def start(self):
+        """
+        Start the ordering task with the first phase. Called automatically with the first event
+        """
+        if self._task is None:
+            self.phases_queue.put_nowait(self.phases[0][0])
+            self._task = self._loop.create_task(self._run())
+            self._started.set()
+
+    def stop(self):
+        """
+        Stop the ordering. The already queued events of the current turn are still sent
+        """
+        def stop():
+            self.start()
+            self._stopping.set()
+            self.phases_queue.put_nowait(None)
+
+        _call_soon(self._loop, stop)
+
+    async def join(self):
+        """Wait for the end of the ordering (phase None or stop())"""
+        await self._started.wait()
+        await self._task
+
+    async def _run(self):
+        while True:
+            phase = await self.phases_queue.get()
+
+            if phase is None:
+                break
+
+            q = self.event_queues[phase]
+
+            for i in range(self.phases[self._index[phase]][1]):
+                if q.empty():
+                    if self._stopping.is_set():
+                        return
+
+                    get = asyncio.ensure_future(q.get())
+                    stopping = asyncio.ensure_future(self._stopping.wait())
+                    await asyncio.wait({get, stopping}, return_when=asyncio.FIRST_COMPLETED)
+                    stopping.cancel()
+
+                    if not get.done():
+                        get.cancel()
+                        return
+
+                    event = get.result().copy()
+                else:
+                    event = q.get_nowait().copy()
+
+                self._refill(phase)
+
+                event['phase'] = phase
+                self.listeners(event)
+                q.task_done()
@@ -0,0 +1,143 @@
+import collections.abc
+
+
+class Event(collections.abc.Mapping):
+    """
+    Compact event with __slots__ instead of a dict per event. The events keep the dict-style access (event['type'],
+    'phase' in event, event.get('data'), dict(event), etc.), so that the existing listeners, filters and encoders work
+    with them unchanged. The fields, which were not set, are missing (like the missing keys of a dict event).
+    Keys, which are not fields of the event type (e.g. 'error'), are kept in an additional dict
+    """
+
+    __slots__ = ('_extra',)
+
+    # value of the 'type' key
+    type = None
+
+    # names of the slots
+    fields = ()
+
+    def __init__(self, *args, **kwargs):
+        for f, v in zip(self.fields, args):
+            setattr(self, f, v)
+
+        for k, v in kwargs.items():
+            self[k] = v
+
+    def __getitem__(self, key):
+        if key == 'type':
+            return self.type
+
+        if key in self.fields:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+
+        try:
+            return self._extra[key]
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self.fields:
+            setattr(self, key, value)
+        elif key == 'type':
+            raise KeyError("The type of " + self.__class__.__name__ + " cannot be changed")
+        else:
+            try:
+                self._extra[key] = value
+            except AttributeError:
+                self._extra = {key: value}
+
+    def __delitem__(self, key):
+        if key in self.fields:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        else:
+            try:
+                del self._extra[key]
+            except AttributeError:
+                raise KeyError(key)
+
+    def __iter__(self):
+        yield 'type'
+
+        for f in self.fields:
+            if hasattr(self, f):
+                yield f
+
+        if hasattr(self, '_extra'):
+            yield from self._extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def copy(self):
+        """Shallow copy of the event (of the same type)"""
+        result = self.__class__.__new__(self.__class__)
+
+        for f in self.fields:
+            try:
+                setattr(result, f, getattr(self, f))
+            except AttributeError:
+                pass
+
+        if hasattr(self, '_extra'):
+            result._extra = dict(self._extra)
+
+        return result
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(' + repr(dict(self)) + ')'
+
+
+class DataEvent(Event):
+    """'data' event: DataEvent(data, phase)"""
+
+    __slots__ = ('data', 'phase')
+    type = 'data'
+    fields = __slots__
+
+
+class BeforeIterationEvent(Event):
+    """'before_iteration' event: BeforeIterationEvent(model, phase, iteration, model_input)"""
+
+    __slots__ = ('model', 'phase', 'iteration', 'model_input')
+    type = 'before_iteration'
+    fields = __slots__
+
+
+class AfterIterationEvent(Event):
+    """'after_iteration' event: AfterIterationEvent(model, phase, iteration, model_input, model_output)"""
+
+    __slots__ = ('model', 'phase', 'iteration', 'model_input', 'model_output')
+    type = 'after_iteration'
+    fields = __slots__
+
+
+class StoreObjectEvent(Event):
+    """'store_object' event: StoreObjectEvent(data)"""
+
+    __slots__ = ('data',)
+    type = 'store_object'
+    fields = __slots__
+
+
+def event_factory(cls: type, compact: bool):
+    """
+    :param cls: event type
+    :param compact: whether the events should be instances of cls
+    :return: cls if compact, otherwise a function with the same arguments as cls, which creates a dict event
+    """
+    if compact:
+        return cls
+
+    def create(*args):
+        event = {'type': cls.type}
+        event.update(zip(cls.fields, args))
+        return event
+
+    return create
@@ -0,0 +1,277 @@
+import bisect
+import logging
+import os
+import sys
+import threading
+import time
+import typing
+
+# upper bounds of the latency histograms in seconds
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# upper bounds of the batch size histograms
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096, 16384)
+
+
+class Counter(object):
+    """Monotonically increasing value"""
+
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Histogram(object):
+    """Distribution of the observed values in fixed buckets"""
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count', '_lock')
+
+    def __init__(self, buckets: typing.Sequence[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def since(self, start: float):
+        """Observe the time since start (a time.perf_counter() value)"""
+        self.observe(time.perf_counter() - start)
+
+
+class MetricsRegistry(object):
+    """
+    Registry of the metrics of the components (AlgoPhase, AlgoPhaseEventsOrder, MongoDBSequenceLog, etc.), which are
+    created with it. The components without registry are not instrumented at all.
+    The metrics are identified by name and labels, like in Prometheus
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+        # name -> (type, help, {labels: metric})
+        self._metrics = dict()
+
+        # (name, labels) -> (time, value) of the previous snapshot for the counter rates
+        self._previous = dict()
+        self._start = time.time()
+
+    def _get(self, type: str, name: str, help: str, labels: dict, create: typing.Callable, replace: bool = False):
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+        with self._lock:
+            entry = self._metrics.get(name)
+            if entry is None:
+                entry = self._metrics[name] = (type, help, dict())
+            elif entry[0] != type:
+                raise ValueError("Metric " + name + " is already registered as " + entry[0])
+
+            metric = entry[2].get(key)
+            if metric is None or replace:
+                metric = entry[2][key] = create()
+
+            return metric
+
+    def counter(self, name: str, help: str = '', **labels) -> Counter:
+        """
+        :return: the counter with name and labels (created if it doesn't exist)
+        """
+        return self._get('counter', name, help, labels, Counter)
+
+    def histogram(self, name: str, help: str = '', buckets: typing.Sequence[float] = LATENCY_BUCKETS, **labels) -> Histogram:
+        """
+        :return: the histogram with name and labels (created if it doesn't exist)
+        """
+        return self._get('histogram', name, help, labels, lambda: Histogram(buckets))
+
+    def gauge(self, name: str, function: typing.Callable, help: str = '', **labels):
+        """
+        Register gauge, which is evaluated for each snapshot. The function replaces the one of an already registered gauge
+        with the same name and labels (for example of a previous instance of the component)
+        :param function: function without arguments, which returns the current value
+        """
+        self._get('gauge', name, help, labels, lambda: function, replace=True)
+
+    def snapshot(self) -> dict:
+        """
+        :return: dict name -> {'type', 'help', 'samples'}. Each sample has the labels and either the value (gauges),
+        the value and the rate per second since the previous snapshot (counters) or the count, sum and cumulative
+        [upper bound, count] buckets (histograms)
+        """
+        now = time.time()
+
+        with self._lock:
+            metrics = {name: (type, help, dict(samples)) for name, (type, help, samples) in self._metrics.items()}
+
+        result = dict()
+        for name, (type, help, samples) in metrics.items():
+            result[name] = {'type': type, 'help': help, 'samples': list()}
+
+            for key, metric in samples.items():
+                sample = {'labels': dict(key)}
+
+                if type == 'counter':
+                    value = metric.value
+                    with self._lock:
+                        previous_time, previous_value = self._previous.get((name, key), (self._start, 0))
+                        self._previous[(name, key)] = (now, value)
+
+                    sample['value'] = value
+                    sample['rate'] = (value - previous_value) / (now - previous_time) if now > previous_time else 0.0
+                elif type == 'histogram':
+                    with metric._lock:
+                        counts, sample['sum'], sample['count'] = list(metric.counts), metric.sum, metric.count
+
+                    cumulative = 0
+                    sample['buckets'] = list()
+                    for bound, count in zip(list(metric.buckets) + [float('inf')], counts):
+                        cumulative += count
+                        sample['buckets'].append([bound, cumulative])
+                else:
+                    try:
+                        sample['value'] = metric()
+                    except Exception as e:
+                        logging.getLogger(__name__).debug("Gauge " + name + " failed: " + str(e))
+                        continue
+
+                result[name]['samples'].append(sample)
+
+        return result
+
+
+def _labels_text(labels: dict, extra: dict = None) -> str:
+    labels = dict(labels, **extra) if extra else labels
+    if not labels:
+        return ''
+
+    return '{' + ','.join(k + '="' + str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"' for k, v in labels.items()) + '}'
+
+
+def _number_text(value) -> str:
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def prometheus_text(snapshot: dict) -> str:
+    """
+    :param snapshot: MetricsRegistry.snapshot()
+    :return: the snapshot in the Prometheus text exposition format
+    """
+    lines = list()
+
+    for name, metric in sorted(snapshot.items()):
+        if metric['help']:
+            lines.append('# HELP ' + name + ' ' + metric['help'])
+        lines.append('# TYPE ' + name + ' ' + metric['type'])
+
+        for sample in metric['samples']:
+            labels = sample['labels']
+
+            if metric['type'] == 'histogram':
+                for bound, count in sample['buckets']:
+                    lines.append(name + '_bucket' + _labels_text(labels, {'le': _number_text(bound)}) + ' ' + str(count))
+                lines.append(name + '_sum' + _labels_text(labels) + ' ' + _number_text(sample['sum']))
+                lines.append(name + '_count' + _labels_text(labels) + ' ' + str(sample['count']))
+            else:
+                lines.append(name + _labels_text(labels) + ' ' + _number_text(sample['value']))
+
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsExporter(object):
+    """
+    Periodically write the metrics in the Prometheus text format to a file (e.g. for the node_exporter textfile collector)
+    or to a stream (stdout by default)
+    """
+
+    def __init__(self, registry: MetricsRegistry, interval: float = 10.0, path: str = None, stream=None):
+        """
+        :param registry: metrics registry
+        :param interval: export interval in seconds
+        :param path: file to write the metrics to. The file is replaced atomically
+        :param stream: stream to write the metrics to, if path is None (sys.stdout by default)
+        """
+        self.registry = registry
+        self.interval = interval
+        self.path = path
+        self.stream = stream
+
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._export_periodically, daemon=True)
+        self._thread.start()
+
+    def export(self):
+        """Write the current metrics"""
+        text = prometheus_text(self.registry.snapshot())
+
+        if self.path is not None:
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                f.write(text)
+            os.replace(tmp, self.path)
+        else:
+            stream = self.stream if self.stream is not None else sys.stdout
+            stream.write(text)
+            stream.flush()
+
+    def close(self):
+        """Stop the periodic export and write the final metrics"""
+        self._closed.set()
+        self._thread.join()
+        self.export()
+
+    def _export_periodically(self):
+        while not self._closed.wait(self.interval):
+            try:
+                self.export()
+            except Exception:
+                logging.getLogger(__name__).exception("Metrics export failed")
+
+
+class MongoMetrics(object):
+    """Metrics of the reads and writes of a MongoDB collection"""
+
+    def __init__(self, registry: MetricsRegistry, collection: str):
+        """
+        :param registry: metrics registry
+        :param collection: collection name (label of the metrics)
+        """
+        self.write_latency = registry.histogram('pyevents_mongo_write_seconds', "Duration of the MongoDB writes", collection=collection)
+        self.write_batch_size = registry.histogram('pyevents_mongo_write_batch_size', "Documents per MongoDB write", buckets=SIZE_BUCKETS, collection=collection)
+        self.serialized_bytes = registry.counter('pyevents_mongo_serialized_bytes_total', "Size of the written BSON documents", collection=collection)
+        self.pickle_fallbacks = registry.counter('pyevents_mongo_pickle_fallback_total', "Objects, which were pickled, because they couldn't be encoded as documents", collection=collection)
+        self.read_latency = registry.histogram('pyevents_mongo_read_seconds', "Duration of the MongoDB reads", collection=collection)
+        self.read_batch_size = registry.histogram('pyevents_mongo_read_batch_size', "Documents per MongoDB read", buckets=SIZE_BUCKETS, collection=collection)
+
+    def written(self, start: float, documents: int, size: int):
+        """
+        :param start: time.perf_counter() before the write
+        :param documents: number of written documents
+        :param size: BSON size of the written documents
+        """
+        self.write_latency.since(start)
+        self.write_batch_size.observe(documents)
+        self.serialized_bytes.inc(size)
+
+    def read(self, start: float, documents: int):
+        """
+        :param start: time.perf_counter() before the read
+        :param documents: number of read documents
+        """
+        self.read_latency.since(start)
+        self.read_batch_size.observe(documents)
@@ -0,0 +1,135 @@
+import datetime
+import logging
+import threading
+from typing import Callable
+
+from pyevents_util.mongodb.mongodb_sequence_log import MongoDBSequenceLog, MongoDBSequenceProvider
+from pyevents_util.mongodb.mongodb_store import MongoDBStore
+
+
+class CheckpointCoordinator(object):
+    """
+    Snapshot-plus-tail recovery for a logged events group.
+    The coordinator saves the model state (periodically and/or on checkpoint()) through a MongoDBStore together with the
+    sequence id of the last event, which the state includes. The recovery restores the latest snapshot and replays only
+    the events of the log after this sequence id, instead of the whole group.
+    Each snapshot replaces the previous one atomically (a single document per checkpoint_id).
+    By default the state is assumed to include all events, stored by the log so far. If the model lags behind the log
+    (e.g. with asynchronous listeners), position should return the sequence id of the last processed event.
+    The default position is valid only for a single writer (without counters_collection).
+    The position and the state are read together under state_lock. The event handling should hold it while it logs an event
+    and applies it to the state (e.g. around the calls of SyncListeners), otherwise an event, which arrives during a
+    checkpoint, can be included in the state, but not in the position, and is replayed again on recovery
+    """
+
+    def __init__(self, store: MongoDBStore, log: MongoDBSequenceLog, get_state: Callable, set_state: Callable = None, checkpoint_id=None,
+                 interval: float = None, position: Callable = None, state_lock=None):
+        """
+        :param store: store for the snapshots
+        :param log: log of the events group
+        :param get_state: function without arguments, which returns a copy of the current (encodable) model state
+        :param set_state: function, which is called with the restored state before the replay of the tail
+        :param checkpoint_id: _id of the snapshot document ('checkpoint_' + group id by default)
+        :param interval: save a snapshot every interval seconds
+        :param position: function without arguments, which returns the sequence id of the last event, included in the state
+        :param state_lock: lock, which the event handling holds while it updates the state (a new RLock by default)
+        """
+        self.store = store
+        self.log = log
+
+        self.get_state = get_state
+        self.set_state = set_state
+        self.position = position
+
+        self.checkpoint_id = checkpoint_id if checkpoint_id is not None else 'checkpoint_' + str(log.group_id)
+
+        self.interval = interval
+
+        self.state_lock = state_lock if state_lock is not None else threading.RLock()
+
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+
+        if interval is not None:
+            self._thread = threading.Thread(target=self._checkpoint_periodically, daemon=True)
+            self._thread.start()
+        else:
+            self._thread = None
+
+    def checkpoint(self, sequence_id: int = None) -> dict:
+        """
+        Save a snapshot of the current state
+        :param sequence_id: sequence id of the last event, included in the state (position() or the last event of the log by default)
+        :return: the snapshot document
+        """
+        with self._lock:
+            with self.state_lock:
+                if sequence_id is None:
+                    sequence_id = self.position() if self.position is not None else self.log.last_sequence_id
+
+                state = self.get_state()
+
+            # the events up to sequence_id must be in the log before the snapshot, otherwise a restarted log can reuse their ids
+            if self.log.buffered:
+                self.log.flush()
+
+            snapshot = {'_id': self.checkpoint_id,
+                        'group_id': self.log.group_id,
+                        'sequence_id': sequence_id,
+                        'created': datetime.datetime.now(datetime.timezone.utc),
+                        'state': state}
+
+            self.store.store(snapshot)
+
+            if self.store.write_behind:
+                self.store.flush()
+
+            logging.getLogger(__name__).debug("Checkpoint " + str(self.checkpoint_id) + " at sequence id " + str(sequence_id))
+
+            return snapshot
+
+    def latest(self) -> dict:
+        """
+        :return: the latest snapshot document ('group_id', 'sequence_id', 'created', 'state') or None if there is none
+        """
+        return self.store.load(self.checkpoint_id)
+
+    def recover(self, listeners, **kwargs):
+        """
+        Restore the latest snapshot (with set_state) and replay the events after it to listeners.
+        Without snapshot the whole group is replayed
+        :param listeners: event listeners for the replayed events
+        :param kwargs: other MongoDBSequenceProvider arguments (decoder, batch_size, prefetch, etc.)
+        :return: the restored state (None if there was no snapshot)
+        """
+        snapshot = self.latest()
+
+        if snapshot is not None:
+            state = snapshot['state']
+            start = snapshot['sequence_id'] + 1 if snapshot['sequence_id'] is not None else 0
+
+            if self.set_state is not None:
+                self.set_state(state)
+        else:
+            state, start = None, 0
+
+        logging.getLogger(__name__).debug("Recover group " + str(self.log.group_id) + " from sequence id " + str(start))
+
+        kwargs.setdefault('ensure_index', False)
+        MongoDBSequenceProvider(self.log.collection, group_id=self.log.group_id, listeners=listeners, start=start, **kwargs)()
+
+        return state
+
+    def close(self):
+        """Stop the periodic snapshots"""
+        self._closed.set()
+
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def _checkpoint_periodically(self):
+        while not self._closed.wait(self.interval):
+            try:
+                self.checkpoint()
+            except Exception:
+                logging.getLogger(__name__).exception("Periodic checkpoint failed")
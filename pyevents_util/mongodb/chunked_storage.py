@@ -0,0 +1,209 @@
+import collections.abc
+import logging
+from typing import Callable
+
+import pymongo
+from bson.binary import Binary
+from bson.objectid import ObjectId
+
+import pyevents_util.mongodb.util as mongoutil
+
+
+class ChunkStore(object):
+    """
+    Stores large numpy arrays and binary blobs outside of the main document.
+    Every binary value (numpy array buffer or pickled object), which is larger than threshold is split into chunks of chunk_size bytes,
+    saved in a side collection and replaced with a reference in the main document. Use encode/decode as encoder/decoder
+    of MongoDBSequenceLog, MongoDBSequenceProvider and MongoDBStore. MongoDBStore deletes the chunks of the replaced
+    versions of its objects, and the log and the store delete the chunks of the encodings, which they discard.
+    The top level fields of decoded dict documents are loaded lazily - the chunks are fetched only when the field is accessed
+    """
+
+    def __init__(self, chunks_collection, threshold: int = 4 * 1024 * 1024, chunk_size: int = 1024 * 1024, encoder: Callable = None, decoder: Callable = None):
+        """
+        :param chunks_collection: side collection for the chunks
+        :param threshold: binary values larger than this number of bytes are stored in chunks
+        :param chunk_size: chunk size in bytes
+        :param encoder: encoder, which is applied before the chunking
+        :param decoder: decoder, which is applied after the chunks are loaded
+        """
+        self.collection = chunks_collection
+        self.threshold = threshold
+        self.chunk_size = chunk_size
+
+        self._encoder = encoder if encoder is not None else mongoutil.default_encoder
+        self._decoder = decoder if decoder is not None else mongoutil.default_decoder
+
+        self.collection.create_index([('files_id', pymongo.ASCENDING), ('n', pymongo.ASCENDING)], unique=True)
+
+    def encode(self, obj):
+        """
+        Encode object and move the large binary values to the chunks collection
+        :param obj: object to encode
+        :return: encoded object
+        """
+        obj = self._encoder(obj)
+
+        if self._is_large(obj):
+            return self._store_chunks(obj)
+
+        stored = list()
+        try:
+            for container, key, value in mongoutil.walk_encoded(obj, compressed=True):
+                if self._is_large(value):
+                    container[key] = self._store_chunks(value)
+                    stored.append(container[key]['__chunked__'])
+        except Exception:
+            if stored:
+                self.collection.delete_many({'files_id': {'$in': stored}})
+            raise
+
+        return obj
+
+    def decode(self, obj):
+        """
+        Decode object. The fields of dict documents, which are stored in chunks, are loaded on first access
+        :param obj: object to decode
+        :return: decoded object
+        """
+        if mongoutil.is_document(obj):
+            return LazyDocument({k: _LazyValue(self, v) if self._has_chunks(v) else self._decoder(v) for k, v in obj.items()})
+
+        return self._decoder(self.resolve(obj))
+
+    def resolve(self, obj):
+        """
+        Replace all chunk references in an encoded object with the stored binary data
+        :param obj: encoded object
+        :return: encoded object without chunk references
+        """
+        if is_chunk_reference(obj):
+            return self._load_chunks(obj)
+
+        for container, key, value in mongoutil.walk_encoded(obj, compressed=True):
+            if is_chunk_reference(value):
+                container[key] = self._load_chunks(value)
+
+        return obj
+
+    def delete(self, obj, keep=None):
+        """
+        Delete the chunks, referenced by an encoded object
+        :param obj: encoded object
+        :param keep: encoded object, whose chunks are kept (for example the new version of a replaced document)
+        """
+        files = self._references(obj)
+        if keep is not None:
+            files -= self._references(keep)
+
+        if files:
+            self.collection.delete_many({'files_id': {'$in': list(files)}})
+
+    def _references(self, obj) -> set:
+        """ids of the chunked values, referenced by an encoded object"""
+        refs = [obj] if is_chunk_reference(obj) else [v for _, _, v in mongoutil.walk_encoded(obj, compressed=True) if is_chunk_reference(v)]
+        return {r['__chunked__'] for r in refs}
+
+    def _is_large(self, value):
+        return isinstance(value, (bytes, bytearray)) and len(value) > self.threshold
+
+    def _has_chunks(self, obj):
+        return is_chunk_reference(obj) or any(is_chunk_reference(v) for _, _, v in mongoutil.walk_encoded(obj, compressed=True))
+
+    def _store_chunks(self, data):
+        files_id = ObjectId()
+        view = memoryview(data)
+
+        chunks = [{'files_id': files_id, 'n': n, 'data': Binary(view[i:i + self.chunk_size].tobytes())} for n, i in enumerate(range(0, len(data), self.chunk_size))]
+        if chunks:
+            self.collection.insert_many(chunks, ordered=True)
+
+        logging.getLogger(__name__).debug("Stored " + str(len(data)) + " bytes in " + str(len(chunks)) + " chunks")
+
+        return {'__chunked__': files_id, 'length': len(data), 'chunk_size': self.chunk_size}
+
+    def _load_chunks(self, ref):
+        data = bytearray(ref['length'])
+        offset = 0
+        for chunk in self.collection.find({'files_id': ref['__chunked__']}).sort('n', pymongo.ASCENDING):
+            data[offset:offset + len(chunk['data'])] = chunk['data']
+            offset += len(chunk['data'])
+
+        if offset != ref['length']:
+            raise ValueError("Chunked value " + str(ref['__chunked__']) + " is incomplete: " + str(offset) + " of " + str(ref['length']) + " bytes")
+
+        return data
+
+
+def is_chunk_reference(obj):
+    return isinstance(obj, dict) and '__chunked__' in obj
+
+
+def chunk_store(encoder):
+    """
+    :param encoder: encoder of a log or store
+    :return: the ChunkStore of encoder, if it is ChunkStore.encode (otherwise None)
+    """
+    owner = getattr(encoder, '__self__', None)
+    return owner if isinstance(owner, ChunkStore) else None
+
+
+class _LazyValue(object):
+    """Encoded value with chunk references, which is loaded on first access"""
+
+    __slots__ = ('store', 'value')
+
+    def __init__(self, store: ChunkStore, value):
+        self.store = store
+        self.value = value
+
+    def load(self):
+        return self.store._decoder(self.store.resolve(self.value))
+
+
+class LazyDocument(collections.abc.MutableMapping):
+    """
+    Document, whose chunked fields are loaded from the database on first access. It isn't a dict subclass, so that every
+    access path (including dict(doc), {**doc}, values() and items()) goes through __getitem__ and returns loaded values
+    """
+
+    def __init__(self, fields: dict = None):
+        self._fields = dict(fields) if fields is not None else dict()
+
+    def __getitem__(self, key):
+        value = self._fields[key]
+        if isinstance(value, _LazyValue):
+            value = self._fields[key] = value.load()
+
+        return value
+
+    def __setitem__(self, key, value):
+        self._fields[key] = value
+
+    def __delitem__(self, key):
+        del self._fields[key]
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __contains__(self, key):
+        return key in self._fields
+
+    def copy(self):
+        return LazyDocument(self._fields)
+
+    def is_loaded(self, key):
+        """
+        :param key: field name
+        :return: whether the field is already loaded
+        """
+        return not isinstance(self._fields[key], _LazyValue)
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(' + repr({k: v if not isinstance(v, _LazyValue) else '<not loaded>' for k, v in self._fields.items()}) + ')'
+
+
+mongoutil.register_encoder(LazyDocument, lambda d: {k: d[k] for k in d})
@@ -0,0 +1,302 @@
+import collections.abc
+import datetime
+import json
+import numbers
+import os
+import pickle
+from typing import Iterable, Tuple
+
+import numpy as np
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# prefix of the validity masks in the npz, npy and Arrow files
+VALID_PREFIX = '__valid__.'
+
+MANIFEST = 'columns.json'
+
+
+class EventColumns(collections.abc.Mapping):
+    """
+    Columnar form of a sequence of events: a mapping column name -> numpy array with one row per event.
+    The fields of nested dicts are flattened to dotted names ('data.input'). The ndarray fields with the same shape and dtype
+    in all events are stacked to a single (events, *shape) array. The bool, numeric, str and datetime fields become typed
+    columns. All other fields (lists, mixed types, objects) become object columns.
+    If a field is missing (or None) in some of the events, its column is filled with zeros and valid[name] is a bool
+    array, which marks the events with the field. The sequence_id column has the sequence ids of the events.
+    An event field sequence_id conflicts with this column and raises ValueError (exclude it with the fields of the provider).
+    The columns can be saved as .npz, as a directory of .npy files (which can be memory-mapped), and with pyarrow as
+    Arrow IPC (memory-mapped reads) or Parquet files
+    """
+
+    def __init__(self, columns: dict, valid: dict = None):
+        """
+        :param columns: column name -> numpy array
+        :param valid: column name -> bool array of the events with the field (only for the columns with missing values)
+        """
+        self.columns = columns
+        self.valid = valid if valid is not None else dict()
+
+    def __getitem__(self, key):
+        return self.columns[key]
+
+    def __iter__(self):
+        return iter(self.columns)
+
+    def __len__(self):
+        return len(self.columns)
+
+    @property
+    def size(self) -> int:
+        """number of events"""
+        return len(self.columns['sequence_id']) if 'sequence_id' in self.columns else 0
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(' + ', '.join(k + ': ' + str(v.dtype) + str(list(v.shape)) for k, v in self.columns.items()) + ')'
+
+    @classmethod
+    def from_events(cls, events: Iterable[Tuple[int, object]]):
+        """
+        :param events: (sequence_id, decoded event) tuples (for example MongoDBSequenceProvider.sequence_events())
+        :return: columns of the events
+        """
+        # name -> (indices of the events, values)
+        values = dict()
+        sequence_ids = list()
+
+        for i, (sequence_id, event) in enumerate(events):
+            sequence_ids.append(sequence_id)
+
+            if isinstance(event, collections.abc.Mapping):
+                stack = [('', event)]
+                while stack:
+                    prefix, d = stack.pop()
+                    for k, v in d.items():
+                        name = prefix + str(k)
+                        if isinstance(v, collections.abc.Mapping):
+                            stack.append((name + '.', v))
+                        elif v is not None:
+                            indices, column = values.setdefault(name, (list(), list()))
+                            indices.append(i)
+                            column.append(v)
+            elif event is not None:
+                indices, column = values.setdefault('event', (list(), list()))
+                indices.append(i)
+                column.append(event)
+
+        if 'sequence_id' in values:
+            raise ValueError("The events have a sequence_id field, which conflicts with the sequence_id column")
+
+        n = len(sequence_ids)
+
+        columns = {'sequence_id': np.array(sequence_ids, dtype=np.int64)}
+        valid = dict()
+
+        for name, (indices, column) in values.items():
+            columns[name] = _column(column, indices, n)
+
+            if len(indices) < n:
+                valid[name] = np.zeros(n, dtype=bool)
+                valid[name][indices] = True
+
+        return cls(columns, valid)
+
+    def save_npz(self, path: str, compressed: bool = False):
+        """
+        Save the columns in a single .npz file
+        :param compressed: compress the file (np.savez_compressed)
+        """
+        arrays = dict(self.columns, **{VALID_PREFIX + k: v for k, v in self.valid.items()})
+
+        (np.savez_compressed if compressed else np.savez)(path, **arrays)
+
+    @classmethod
+    def load_npz(cls, path: str):
+        """
+        Load columns saved with save_npz. npz files can't be memory-mapped (see save_npy)
+        """
+        with np.load(path, allow_pickle=True) as f:
+            return cls._from_arrays({k: f[k] for k in f.files})
+
+    def save_npy(self, directory: str):
+        """
+        Save each column as a .npy file in directory, with a json manifest of the column names
+        """
+        os.makedirs(directory, exist_ok=True)
+
+        manifest = list()
+        for i, (name, array) in enumerate(_arrays(self)):
+            file = 'column_' + str(i) + '.npy'
+            np.save(os.path.join(directory, file), array, allow_pickle=array.dtype == object)
+            manifest.append({'name': name, 'file': file, 'object': array.dtype == object})
+
+        with open(os.path.join(directory, MANIFEST), 'w') as f:
+            json.dump(manifest, f)
+
+    @classmethod
+    def load_npy(cls, directory: str, mmap_mode: str = 'r'):
+        """
+        Load columns saved with save_npy
+        :param mmap_mode: np.load mmap_mode ('r' memory-maps the columns read-only, None reads them in memory).
+        The object columns are always read in memory
+        """
+        with open(os.path.join(directory, MANIFEST)) as f:
+            manifest = json.load(f)
+
+        arrays = dict()
+        for entry in manifest:
+            path = os.path.join(directory, entry['file'])
+            arrays[entry['name']] = np.load(path, allow_pickle=True) if entry['object'] else np.load(path, mmap_mode=mmap_mode)
+
+        return cls._from_arrays(arrays)
+
+    @classmethod
+    def _from_arrays(cls, arrays: dict):
+        columns = {k: v for k, v in arrays.items() if not k.startswith(VALID_PREFIX)}
+        valid = {k[len(VALID_PREFIX):]: v for k, v in arrays.items() if k.startswith(VALID_PREFIX)}
+
+        return cls(columns, valid)
+
+    def to_arrow(self):
+        """
+        :return: the columns as pyarrow.Table. The stacked arrays are fixed size lists with their shape in the field
+        metadata and the object columns are pickled
+        """
+        _check_pyarrow()
+
+        arrays, fields = list(), list()
+
+        for name, array in _arrays(self):
+            metadata = None
+
+            if array.dtype == object:
+                values = pyarrow.array([pickle.dumps(v) for v in array], type=pyarrow.binary())
+                metadata = {'pickle': 'true'}
+            elif array.ndim > 1:
+                values = pyarrow.FixedSizeListArray.from_arrays(pyarrow.array(np.ascontiguousarray(array).reshape(-1)), int(np.prod(array.shape[1:])))
+                metadata = {'shape': json.dumps(list(array.shape[1:]))}
+            else:
+                values = pyarrow.array(array)
+
+            arrays.append(values)
+            fields.append(pyarrow.field(name, values.type, metadata=metadata))
+
+        return pyarrow.Table.from_arrays(arrays, schema=pyarrow.schema(fields))
+
+    @classmethod
+    def from_arrow(cls, table):
+        """
+        :param table: pyarrow.Table, created with to_arrow. The numeric columns share the memory of the table
+        :return: columns of the table
+        """
+        arrays = dict()
+
+        for field in table.schema:
+            column = table.column(field.name).combine_chunks()
+            metadata = field.metadata or dict()
+
+            if metadata.get(b'pickle') == b'true':
+                array = np.empty(len(column), dtype=object)
+                array[:] = [pickle.loads(v) for v in column.to_pylist()]
+            elif b'shape' in metadata:
+                shape = json.loads(metadata[b'shape'])
+                array = column.flatten().to_numpy(zero_copy_only=False).reshape([len(column)] + shape)
+            else:
+                array = column.to_numpy(zero_copy_only=False)
+
+            arrays[field.name] = array
+
+        return cls._from_arrays(arrays)
+
+    def save_arrow(self, path: str):
+        """Save the columns as Arrow IPC file"""
+        table = self.to_arrow()
+
+        with pyarrow.OSFile(path, 'wb') as sink:
+            with pyarrow.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+
+    @classmethod
+    def load_arrow(cls, path: str, memory_map: bool = True):
+        """
+        Load columns saved with save_arrow
+        :param memory_map: memory-map the file instead of reading it
+        """
+        _check_pyarrow()
+
+        source = pyarrow.memory_map(path, 'r') if memory_map else pyarrow.OSFile(path, 'rb')
+
+        return cls.from_arrow(pyarrow.ipc.open_file(source).read_all())
+
+    def save_parquet(self, path: str, compression: str = 'snappy'):
+        """Save the columns as Parquet file"""
+        pyarrow.parquet.write_table(self.to_arrow(), path, compression=compression)
+
+    @classmethod
+    def load_parquet(cls, path: str, memory_map: bool = True):
+        """
+        Load columns saved with save_parquet
+        :param memory_map: memory-map the file while reading it
+        """
+        _check_pyarrow()
+
+        return cls.from_arrow(pyarrow.parquet.read_table(path, memory_map=memory_map))
+
+
+def _arrays(columns: EventColumns):
+    """(name, array) of the columns followed by the validity masks (with VALID_PREFIX)"""
+    yield from columns.columns.items()
+    yield from ((VALID_PREFIX + k, v) for k, v in columns.valid.items())
+
+
+def _check_pyarrow():
+    if pyarrow is None:
+        raise ImportError("The Arrow and Parquet formats require pyarrow")
+
+
+def _column(values: list, indices: list, n: int):
+    """Build the typed column of n rows from the values of the events at indices"""
+    full = len(indices) == n
+    first = values[0]
+
+    if isinstance(first, np.ndarray):
+        if first.dtype != object and all(isinstance(v, np.ndarray) and v.shape == first.shape and v.dtype == first.dtype for v in values):
+            if full:
+                return np.stack(values)
+
+            result = np.zeros((n,) + first.shape, dtype=first.dtype)
+            result[indices] = np.stack(values)
+            return result
+
+        # arrays with different shapes or dtypes
+        dtype = None
+    elif all(isinstance(v, (bool, np.bool_)) for v in values):
+        dtype = bool
+    elif all(isinstance(v, numbers.Real) and not isinstance(v, (bool, np.bool_)) for v in values):
+        dtype = np.result_type(*{v.dtype if isinstance(v, np.generic) else np.dtype(np.int64 if isinstance(v, numbers.Integral) else np.float64) for v in values})
+    elif all(isinstance(v, str) for v in values):
+        dtype = str
+    elif all(isinstance(v, datetime.datetime) for v in values):
+        values = [v.astimezone(datetime.timezone.utc).replace(tzinfo=None) if v.tzinfo is not None else v for v in values]
+        dtype = 'datetime64[us]'
+    else:
+        dtype = None
+
+    if dtype is None:
+        result = np.empty(n, dtype=object)
+        for i, v in zip(indices, values):
+            result[i] = v
+        return result
+
+    if full:
+        return np.array(values, dtype=dtype)
+
+    typed = np.array(values, dtype=dtype)
+    result = np.zeros(n, dtype=typed.dtype)
+    result[indices] = typed
+    return result
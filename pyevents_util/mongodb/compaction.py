@@ -0,0 +1,163 @@
+import datetime
+import logging
+
+import bson
+import pymongo
+
+import pyevents_util.mongodb.util as mongoutil
+
+
+class SequenceLogCompactor(object):
+    """
+    Compaction and retention of the event groups of a MongoDBSequenceLog collection.
+    The compaction rolls contiguous runs of old events of a group into compressed segment documents, which hold a packed
+    block of up to segment_size events. A segment replaces the document of its first event (same group_id and sequence_id)
+    and has the additional fields segment_end (sequence id after the last event), count and created (time of the newest
+    event, if the events have it). MongoDBSequenceProvider reads segments and live events transparently in order.
+    Runs are broken at gaps in the sequence ids, so each segment is contiguous.
+    The compaction should run only on events, which are no longer appended to (for example with before set to the sequence
+    id of the last checkpoint). Interrupted compactions are safe: the events, which were already packed in a segment, but
+    not deleted yet, are skipped by the provider and removed by the next compaction
+    """
+
+    def __init__(self, mongo_collection, segment_size: int = 1000, segment_bytes: int = 8 * 1024 * 1024, codec: str = 'zlib', level: int = None, min_segment_size: int = None):
+        """
+        :param mongo_collection: collection with the logged events
+        :param segment_size: maximum number of events per segment
+        :param segment_bytes: maximum (uncompressed) BSON size of the events of a segment (must stay below the 16MB document limit)
+        :param codec: compression codec of the segments (see mongoutil.CODECS)
+        :param level: compression level
+        :param min_segment_size: minimum number of events of the last run of a compaction (segment_size by default). Shorter
+        runs are left for the next compaction, so that frequent compactions don't create many small segments
+        """
+        self.collection = mongo_collection
+
+        self.segment_size = segment_size
+        self.segment_bytes = segment_bytes
+        self.codec = codec
+        self.level = level
+        self.min_segment_size = min_segment_size if min_segment_size is not None else segment_size
+
+    def compact(self, group_id, before: int = None, older_than: datetime.timedelta = None) -> int:
+        """
+        Roll the live events of the group into segments
+        :param group_id: id of the events sequence
+        :param before: compact only the events before this sequence id
+        :param older_than: compact only the events older than this (based on the created field or the ObjectId of the event)
+        :return: number of compacted events
+        """
+        query = {'group_id': group_id}
+        if before is not None:
+            query['sequence_id'] = {'$lt': before}
+
+        cutoff = datetime.datetime.now(datetime.timezone.utc) - older_than if older_than is not None else None
+
+        codec_options = mongoutil.collection_codec_options(self.collection)
+
+        run, run_bytes, covered_end, compacted = list(), 0, None, 0
+
+        for doc in self.collection.find(query).sort('sequence_id', pymongo.ASCENDING):
+            if mongoutil.is_segment(doc):
+                compacted += self._write_segment(group_id, run)
+                run, run_bytes = list(), 0
+
+                covered_end = max(covered_end, doc['segment_end']) if covered_end is not None else doc['segment_end']
+                continue
+
+            if covered_end is not None and doc['sequence_id'] < covered_end:
+                # leftover of an interrupted compaction
+                self.collection.delete_one({'_id': doc['_id']})
+                continue
+
+            if cutoff is not None and _created(doc) > cutoff:
+                break
+
+            size = len(bson.encode({'sequence_id': doc['sequence_id'], 'obj': doc['obj']}, codec_options=codec_options))
+
+            if run and (doc['sequence_id'] != run[-1]['sequence_id'] + 1 or run_bytes + size > self.segment_bytes):
+                compacted += self._write_segment(group_id, run)
+                run, run_bytes = list(), 0
+
+            run.append(doc)
+            run_bytes += size
+
+            if len(run) >= self.segment_size:
+                compacted += self._write_segment(group_id, run)
+                run, run_bytes = list(), 0
+
+        if len(run) >= self.min_segment_size:
+            compacted += self._write_segment(group_id, run)
+
+        logging.getLogger(__name__).debug("Compacted " + str(compacted) + " events of group " + str(group_id))
+
+        return compacted
+
+    def _write_segment(self, group_id, run: list) -> int:
+        if len(run) < 2:
+            # a single event gains nothing from a segment
+            return 0
+
+        segment = {'group_id': group_id,
+                   'sequence_id': run[0]['sequence_id'],
+                   'segment_end': run[-1]['sequence_id'] + 1,
+                   'count': len(run),
+                   'segment': mongoutil.encode_segment(run, self.codec, self.level, mongoutil.collection_codec_options(self.collection))}
+
+        created = max(_created(e) for e in run)
+        if created != _NEVER:
+            segment['created'] = created
+
+        # the segment is visible before the packed events are deleted, the provider skips the events it covers
+        self.collection.replace_one({'_id': run[0]['_id']}, segment)
+        self.collection.delete_many({'_id': {'$in': [e['_id'] for e in run[1:]]}})
+
+        return len(run)
+
+    def apply_retention(self, group_id, keep_last: int = None, before: int = None, older_than: datetime.timedelta = None) -> int:
+        """
+        Delete the old events and segments of the group. Segments are deleted only if all their events are expired
+        :param group_id: id of the events sequence
+        :param keep_last: keep only this number of the last sequence ids
+        :param before: delete the events before this sequence id
+        :param older_than: delete the events older than this (based on the created field or the ObjectId of the event)
+        :return: number of deleted documents
+        """
+        end = before
+
+        if keep_last is not None:
+            last = mongoutil.last_sequence_id(self.collection, group_id)
+            if last is None:
+                return 0
+
+            end = last + 1 - keep_last if end is None else min(end, last + 1 - keep_last)
+
+        deleted = 0
+
+        if end is not None:
+            deleted += self.collection.delete_many({'group_id': group_id, 'sequence_id': {'$lt': end}, 'segment_end': {'$exists': False}}).deleted_count
+            deleted += self.collection.delete_many({'group_id': group_id, 'segment_end': {'$lte': end}}).deleted_count
+
+        if older_than is not None:
+            cutoff = datetime.datetime.now(datetime.timezone.utc) - older_than
+
+            deleted += self.collection.delete_many({'group_id': group_id, 'created': {'$lt': cutoff}}).deleted_count
+            deleted += self.collection.delete_many({'group_id': group_id, 'created': {'$exists': False}, 'segment_end': {'$exists': False}, '_id': {'$lt': bson.ObjectId.from_datetime(cutoff)}}).deleted_count
+
+        logging.getLogger(__name__).debug("Deleted " + str(deleted) + " documents of group " + str(group_id))
+
+        return deleted
+
+
+def _created(doc) -> datetime.datetime:
+    if 'created' in doc:
+        created = doc['created']
+        return created if created.tzinfo is not None else created.replace(tzinfo=datetime.timezone.utc)
+
+    if isinstance(doc['_id'], bson.ObjectId):
+        return doc['_id'].generation_time
+
+    # without creation time the event is never considered old
+    return _NEVER
+
+
+_NEVER = datetime.datetime.max.replace(tzinfo=datetime.timezone.utc)
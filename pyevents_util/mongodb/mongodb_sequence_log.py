@@ -1,22 +1,76 @@
+import collections
+import datetime
+import functools
+import itertools
 import logging
-import pickle
+import operator
+import queue
 import threading
+import time
 import uuid
-from typing import Callable
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Tuple
 
+import bson
 import pymongo
-from bson.binary import Binary
-from bson.errors import BSONError
+from pymongo.errors import BulkWriteError
 
 import pyevents_util.mongodb.util as mongoutil
+from pyevents_util.events import StoreObjectEvent, event_factory
+from pyevents_util.metrics import MongoMetrics
+from pyevents_util.mongodb.chunked_storage import chunk_store
+from pyevents_util.mongodb.columnar import EventColumns
+from pyevents_util.routing import subscribe
 
 
 class MongoDBSequenceLog(object):
-    """Log events based on accept_event_function criteria"""
+    """
+    Log events based on accept_event_function criteria.
+    If any of batch_size, batch_bytes or flush_interval is set, the log works in buffered (write-behind) mode:
+    documents are accumulated and written with a single ordered insert_many when one of the thresholds is reached.
+    In this mode the store_object notifications are fired after the batch is acknowledged and flush()/close() should be
+    called when the log is no longer used. If a write fails, the unwritten events stay in the buffer and are written
+    with the next flush. The error of a failed periodic flush is raised by the next store() (or close(), if it fails again).
+    If counters_collection is set, multiple writers (threads, processes or hosts) can append to the same group: each writer
+    atomically reserves blocks of block_size sequence ids and assigns them locally. The unused ids of a block leave gaps in
+    the sequence, and the events of different writers are ordered by reservation and not by time.
+    If expire_after is set, the events have a created field and are deleted by the server with a TTL index (see also
+    SequenceLogCompactor for the compaction and the per-group retention)
+    """
 
-    def __init__(self, mongo_collection, accept_for_serialization: Callable, listeners, group_id=None, encoder: Callable = None):
+    def __init__(self, mongo_collection, accept_for_serialization: Callable, listeners, group_id=None, encoder: Callable = None,
+                 batch_size: int = None, batch_bytes: int = None, flush_interval: float = None, write_concern: pymongo.WriteConcern = None, ensure_index: bool = True,
+                 counters_collection=None, block_size: int = 1000, routes: Iterable[Tuple] = None, compact_events: bool = False,
+                 metrics=None, expire_after: float = None):
+        """
+        :param mongo_collection: collection to store the events in
+        :param accept_for_serialization: predicate, which decides whether an event should be logged
+        :param listeners: event listeners
+        :param group_id: id of the events sequence. If the group already exists, the new events are appended to it
+        :param encoder: encoder for the events
+        :param batch_size: flush the buffer after this number of events
+        :param batch_bytes: flush the buffer after the encoded events exceed this size in bytes
+        :param flush_interval: flush the buffer every flush_interval seconds
+        :param write_concern: durability policy for the writes (for example pymongo.WriteConcern(w=1, j=True))
+        :param ensure_index: check for/create the unique (group_id, sequence_id) index and the index of the segments
+        :param counters_collection: collection for the sequence id counters (enables the multi-writer mode)
+        :param block_size: number of sequence ids to reserve at once in multi-writer mode
+        :param routes: (type, phase) tuples of the events, which are passed to accept_for_serialization, if listeners is an EventRouter (all events by default)
+        :param compact_events: fire the store_object events as slotted Event objects instead of dicts
+        :param metrics: MetricsRegistry for the write latency, batch sizes, serialized bytes and pickle fallbacks (no metrics if None)
+        :param expire_after: delete the events this number of seconds after they were logged (TTL index on created)
+        """
 
-        self.collection = mongo_collection
+        self.collection = mongo_collection if write_concern is None else mongo_collection.with_options(write_concern=write_concern)
+
+        if ensure_index:
+            mongoutil.ensure_sequence_index(self.collection)
+
+        self._codec_options = mongoutil.collection_codec_options(self.collection)
+
+        self.expire_after = expire_after
+        if expire_after is not None:
+            mongoutil.ensure_ttl_index(self.collection, expire_after)
 
         self._lock = threading.RLock()
 
@@ -25,49 +79,590 @@ class MongoDBSequenceLog(object):
         self._sequence_id = 0
 
         if group_id is not None:
-            existing_events = self.collection.find({'group_id': group_id}).sort('sequence_id', pymongo.DESCENDING).limit(1)
-            if existing_events.collection.estimated_document_count() > 0:
-                e = next(existing_events)
-                self._sequence_id = e['sequence_id'] + 1
+            last = mongoutil.last_sequence_id(self.collection, group_id)
+            if last is not None:
+                self._sequence_id = last + 1
+
+        self._counters = counters_collection
+        self.block_size = block_size
+
+        if counters_collection is not None:
+            # the counter never goes below the existing events of the group
+            counters_collection.update_one({'_id': self.group_id}, {'$max': {'next': self._sequence_id}}, upsert=True)
+            self._block_end = self._sequence_id
+        else:
+            self._block_end = None
 
         self.accept_for_serialization = accept_for_serialization
 
         self._encoder = encoder if encoder is not None else mongoutil.default_encoder
 
+        # the chunks of the encodings, which fall back to pickling, are deleted
+        self._chunks = chunk_store(encoder)
+
         self.listeners = listeners
+        self._store_object_event = event_factory(StoreObjectEvent, compact_events)
+
+        self._metrics = MongoMetrics(metrics, self.collection.name) if metrics is not None else None
+
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.flush_interval = flush_interval
+
+        self._buffer = list()
+        self._buffer_bytes = 0
+        self._flush_error = None
+        self._flush_lock = threading.Lock()
+        self._closed = threading.Event()
 
-        self.listeners += self.onevent
+        if flush_interval is not None:
+            self._flush_thread = threading.Thread(target=self._flush_periodically, daemon=True)
+            self._flush_thread.start()
+        else:
+            self._flush_thread = None
+
+        subscribe(self.listeners, self.onevent, routes)
+
+    @property
+    def buffered(self):
+        return self.batch_size is not None or self.batch_bytes is not None or self.flush_interval is not None
+
+    @property
+    def last_sequence_id(self):
+        """
+        :return: sequence id of the last event, stored by this log (or the last event of the group, if none was stored yet).
+        None if the group is empty
+        """
+        with self._lock:
+            return self._sequence_id - 1 if self._sequence_id > 0 else None
 
     def store(self, obj):
+        if self.buffered:
+            with self._lock:
+                error, self._flush_error = self._flush_error, None
+
+            if error is not None:
+                raise error
+
+            self._store_buffered(obj)
+            return
+
         with self._lock:
+            sequence_id = self._next_sequence_id()
+
+            start = time.perf_counter()
+
+            doc = None
+
+            encoded = self._encode(obj)
+            if encoded is not None:
+                doc = self._document(sequence_id, encoded)
+                try:
+                    self.collection.insert_one(doc)
+                    logging.getLogger(__name__).debug("Log json event")
+                except mongoutil.BSON_ERRORS:
+                    self._discard(encoded)
+                    doc = None
+
+            if doc is None:
+                doc = self._binary_document(sequence_id, obj)
+                self.collection.insert_one(doc)
+
+            if self._metrics is not None:
+                self._metrics.written(start, 1, len(bson.encode(doc, codec_options=self._codec_options)))
+
+        self.listeners(self._store_object_event(obj))
+
+    def _next_sequence_id(self):
+        """Assign the next sequence id. Must be called with self._lock held"""
+        if self._counters is not None and self._sequence_id >= self._block_end:
+            self._sequence_id, self._block_end = mongoutil.reserve_sequence_block(self._counters, self.group_id, self.block_size)
+
+        sequence_id = self._sequence_id
+        self._sequence_id += 1
+
+        return sequence_id
+
+    def _document(self, sequence_id, encoded):
+        doc = {'group_id': self.group_id, 'sequence_id': sequence_id, 'obj': encoded}
+        if self.expire_after is not None:
+            doc['created'] = datetime.datetime.now(datetime.timezone.utc)
+
+        return doc
+
+    def _encode(self, obj):
+        """
+        :return: the encoded object or None, if the encoder can't encode it (for example because of reference cycles)
+        """
+        try:
+            return obj if self._encoder is None else self._encoder(obj)
+        except mongoutil.ENCODER_ERRORS:
+            return None
+
+    def _discard(self, encoded):
+        if self._chunks is not None:
+            self._chunks.delete(encoded)
+
+    def _binary_document(self, sequence_id, obj):
+        logging.getLogger(__name__).debug("Failed to serialize json. Falling back to binary serialization")
+
+        if self._metrics is not None:
+            self._metrics.pickle_fallbacks.inc()
+
+        return self._document(sequence_id, mongoutil.encode_binary(obj, self._encoder))
+
+    def _store_buffered(self, obj):
+        with self._lock:
+            sequence_id = self._next_sequence_id()
+
+            doc = None
+
+            encoded = self._encode(obj)
+            if encoded is not None:
+                doc = self._document(sequence_id, encoded)
+                try:
+                    size = len(bson.encode(doc, codec_options=self._codec_options))
+                except mongoutil.BSON_ERRORS:
+                    self._discard(encoded)
+                    doc = None
+
+            if doc is None:
+                doc = self._binary_document(sequence_id, obj)
+                size = len(bson.encode(doc, codec_options=self._codec_options))
+
+            self._buffer.append((doc, obj, size))
+            self._buffer_bytes += size
+
+            full = (self.batch_size is not None and len(self._buffer) >= self.batch_size) or (self.batch_bytes is not None and self._buffer_bytes >= self.batch_bytes)
+
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Write all buffered events with a single ordered insert_many and notify the listeners after acknowledgement"""
+        with self._flush_lock:
+            with self._lock:
+                batch, size, self._buffer, self._buffer_bytes = self._buffer, self._buffer_bytes, list(), 0
+
+            if not batch:
+                return
+
+            start = time.perf_counter()
+
             try:
-                self.collection.insert_one({'group_id': self.group_id, 'sequence_id': self._sequence_id, 'obj': obj if self._encoder is None else self._encoder(obj)})
-                logging.getLogger(__name__).debug("Log json event")
-            except (BSONError, TypeError):
-                self.collection.insert_one({'group_id': self.group_id, 'sequence_id': self._sequence_id, 'obj': Binary(pickle.dumps(obj))})
-                logging.getLogger(__name__).debug("Failed to serialize json. Falling back to binary serialization")
+                self.collection.insert_many([doc for doc, _, _ in batch], ordered=True)
+            except Exception as e:
+                written = _written_count(e)
+
+                # the unwritten events are kept at the head of the buffer, in order
+                with self._lock:
+                    self._buffer = batch[written:] + self._buffer
+                    self._buffer_bytes += sum(s for _, _, s in batch[written:])
+
+                for _, obj, _ in batch[:written]:
+                    self.listeners(self._store_object_event(obj))
+
+                raise
+
+            if self._metrics is not None:
+                self._metrics.written(start, len(batch), size)
+            logging.getLogger(__name__).debug("Log batch of " + str(len(batch)) + " events")
+
+            for _, obj, _ in batch:
+                self.listeners(self._store_object_event(obj))
+
+    def close(self):
+        """Stop the periodic flushing and write the remaining buffered events"""
+        self._closed.set()
+
+        if self._flush_thread is not None and self._flush_thread is not threading.current_thread():
+            self._flush_thread.join()
+
+        self.flush()
 
-            self._sequence_id += 1
+    def _flush_periodically(self):
+        while not self._closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logging.getLogger(__name__).exception("Periodic flush failed")
 
-        self.listeners({'type': 'store_object', 'data': obj})
+                with self._lock:
+                    self._flush_error = e
 
     def onevent(self, event):
         if self.accept_for_serialization(event):
             self.store(event)
 
 
+def _written_count(error: Exception) -> int:
+    """
+    :return: number of the documents of a failed ordered insert_many, which are stored in the collection
+    """
+    if not isinstance(error, BulkWriteError):
+        return 0
+
+    written = error.details.get('nInserted', 0)
+
+    # a document, which was written by a previous attempt (with an unacknowledged result), already exists with its _id
+    errors = error.details.get('writeErrors', [])
+    if errors and errors[0].get('index') == written and errors[0].get('code') == 11000 and '_id' in (errors[0].get('keyPattern') or {}):
+        written += 1
+
+    return written
+
+
 class MongoDBSequenceProvider(object):
-    """Fire logged events"""
+    """
+    Fire logged events.
+    The replay can be pipelined: a background thread prefetches up to prefetch batches of batch_size documents from the
+    cursor and decode_workers threads decode them, while the events are still passed to the listeners in sequence_id order.
+    Gaps in the sequence ids (for example unused ids of multi-writer logs or lost events) are recorded in gaps.
+    The replay can be limited to a [start, end) range of sequence ids, to events matching a filter (evaluated by the server)
+    and to a subset of the event fields. Events, which aren't stored as documents (pickled, compressed or chunked objects),
+    are loaded whole. After each event resume_token is the sequence id to continue an interrupted replay from.
+    Segments of compacted events (see SequenceLogCompactor) are unpacked in place. The filter and the fields of the packed
+    events are evaluated locally, which supports only equality and the $in, $ne, $gt, $gte, $lt, $lte and $exists operators.
+    columns() loads the events in columnar form (stacked numpy arrays and typed columns, see EventColumns)
+    """
 
-    def __init__(self, mongo_collection, group_id, listeners, decoder: Callable = None):
+    def __init__(self, mongo_collection, group_id, listeners, decoder: Callable = None, batch_size: int = None, prefetch: int = 0, decode_workers: int = 0, ensure_index: bool = True,
+                 on_gap: Callable = None, start: int = None, end: int = None, event_filter: dict = None, fields: list = None, metrics=None):
+        """
+        :param mongo_collection: collection with the logged events
+        :param group_id: id of the events sequence
+        :param listeners: event listeners
+        :param decoder: decoder for the events
+        :param batch_size: cursor batch size
+        :param prefetch: number of batches to fetch in advance in a background thread
+        :param decode_workers: number of threads to decode the events with
+        :param ensure_index: check for/create the unique (group_id, sequence_id) index and the index of the segments
+        :param on_gap: function(first_missing, next_present), which is called for each gap in the sequence ids
+        :param start: first sequence id to replay
+        :param end: replay the events before this sequence id
+        :param event_filter: mongodb query on the event fields (for example {'type': 'data', 'phase': 'TESTING_unordered'})
+        :param fields: event fields to load (all fields if None)
+        :param metrics: MetricsRegistry for the read latency and batch sizes (no metrics if None)
+        """
         self._mongo_collection = mongo_collection
+        self._codec_options = mongoutil.collection_codec_options(mongo_collection)
+
+        if ensure_index:
+            mongoutil.ensure_sequence_index(mongo_collection)
+
         self.group_id = group_id
         self.listeners = listeners
 
         self._decoder = decoder if decoder is not None else mongoutil.default_decoder
 
-    def __call__(self):
-        for e in self._mongo_collection.find({'group_id': self.group_id}).sort('sequence_id', pymongo.ASCENDING):
-            element = e['obj'] if self._decoder is None else self._decoder(e['obj'])
-            logging.debug("Sequence " + str(element))
+        self.batch_size = batch_size
+        self.prefetch = prefetch
+        self.decode_workers = decode_workers
+
+        self.on_gap = on_gap
+        self.gaps = list()
+        self._next_sequence_id = 0
+
+        self.start = start
+        self.end = end
+        self.event_filter = event_filter
+        self.fields = fields
+
+        self.resume_token = None
+
+        self._metrics = MongoMetrics(metrics, mongo_collection.name) if metrics is not None else None
+
+    def __call__(self, resume_token: int = None):
+        """
+        Fire the logged events
+        :param resume_token: resume_token of an interrupted replay
+        """
+        debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+
+        for element in self.events(resume_token):
+            if debug:
+                logging.debug("Sequence " + str(element))
+
             self.listeners(element)
+
+    def events(self, resume_token: int = None):
+        """
+        :param resume_token: resume_token of an interrupted replay
+        :return: generator of the decoded events in sequence_id order
+        """
+        for _, element in self.sequence_events(resume_token):
+            yield element
+
+    def columns(self, resume_token: int = None) -> EventColumns:
+        """
+        Load the events (of the range, filter and fields of the provider) in columnar form for vectorized analysis
+        :param resume_token: resume_token of an interrupted replay
+        :return: EventColumns of the events
+        """
+        return EventColumns.from_events(self.sequence_events(resume_token))
+
+    def sequence_events(self, resume_token: int = None):
+        """
+        :param resume_token: resume_token of an interrupted replay
+        :return: generator of (sequence_id, decoded event) tuples in sequence_id order
+        """
+        start = self.start if self.start is not None else 0
+        if resume_token is not None:
+            start = max(start, resume_token)
+
+        self.gaps = list()
+        self._next_sequence_id = start
+        self._segments_end = start
+        self.resume_token = start
+
+        for sequence_id, element in self._decoded_events(start):
+            yield sequence_id, element
+            self.resume_token = sequence_id + 1
+
+    def _decoded_events(self, start):
+        batches = map(functools.partial(self._unpack_segments, start), self._batches(start))
+        if self.fields is not None:
+            batches = map(self._load_payloads, batches)
+
+        if self.event_filter is None:
+            batches = map(self._check_gaps, batches)
+
+        if self.decode_workers > 0:
+            with ThreadPoolExecutor(max_workers=self.decode_workers) as executor:
+                pending = collections.deque()
+                for batch in batches:
+                    pending.append(executor.submit(self._decode_batch, batch))
+                    if len(pending) > self.decode_workers:
+                        yield from pending.popleft().result()
+
+                while pending:
+                    yield from pending.popleft().result()
+        else:
+            for batch in batches:
+                yield from self._decode_batch(batch)
+
+    def _cursor(self, start):
+        query = {'group_id': self.group_id}
+
+        if start > 0:
+            # the segment, which contains start, begins before it. The segments don't overlap, so it's the first segment,
+            # which ends after start (a lookup in SEGMENT_INDEX, independent of the events before start)
+            segment = self._mongo_collection.find_one({'group_id': self.group_id, 'segment_end': {'$gt': start, '$exists': True}}, projection={'_id': False, 'sequence_id': True},
+                                                      sort=mongoutil.SEGMENT_INDEX)
+            if segment is not None and segment['sequence_id'] < start:
+                start = segment['sequence_id']
+
+        if start > 0 or self.end is not None:
+            query['sequence_id'] = {'$gte': start}
+            if self.end is not None:
+                query['sequence_id']['$lt'] = self.end
+
+        if self.event_filter is not None:
+            query['$or'] = [{'obj.' + k: v for k, v in self.event_filter.items()}, {'segment_end': {'$exists': True}}]
+
+        # the markers of the payloads, which can't be projected, are included to detect them
+        projection = None if self.fields is None else dict({'sequence_id': True, 'segment_end': True, 'segment': True}, **{'obj.' + f: True for f in itertools.chain(self.fields, _PAYLOAD_MARKERS)})
+
+        cursor = self._mongo_collection.find(query, projection=projection).sort('sequence_id', pymongo.ASCENDING)
+        if self.batch_size is not None:
+            cursor = cursor.batch_size(self.batch_size)
+
+        return cursor
+
+    def _batches(self, start):
+        cursor = self._cursor(start)
+        batch_size = self.batch_size if self.batch_size is not None else 100
+
+        def read_batches():
+            while True:
+                start = time.perf_counter()
+
+                batch = list(itertools.islice(cursor, batch_size))
+                if not batch:
+                    break
+
+                if self._metrics is not None:
+                    self._metrics.read(start, len(batch))
+
+                yield batch
+
+        if self.prefetch <= 0:
+            yield from read_batches()
+            return
+
+        batches_queue = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+
+        def offer(item):
+            """Put item in the queue, unless the consumer stopped. Return whether the item was queued"""
+            while not stop.is_set():
+                try:
+                    batches_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+
+            return False
+
+        def fetch():
+            try:
+                for b in itertools.chain(read_batches(), [None]):
+                    if not offer(b):
+                        break
+            except Exception as exc:
+                offer(exc)
+
+        thread = threading.Thread(target=fetch, daemon=True)
+        thread.start()
+
+        try:
+            while True:
+                batch = batches_queue.get()
+                if batch is None:
+                    break
+                elif isinstance(batch, Exception):
+                    raise batch
+
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
+            cursor.close()
+
+    def _unpack_segments(self, start, batch):
+        if not any(mongoutil.is_segment(e) for e in batch):
+            if self._segments_end <= start:
+                return batch
+
+            # skip the leftovers of an interrupted compaction
+            return [e for e in batch if e['sequence_id'] >= self._segments_end]
+
+        result = list()
+        for e in batch:
+            if not mongoutil.is_segment(e):
+                if e['sequence_id'] >= self._segments_end:
+                    result.append(e)
+                continue
+
+            for packed in mongoutil.decode_segment(e, self._codec_options):
+                sequence_id = packed['sequence_id']
+
+                if sequence_id < max(start, self._segments_end) or (self.end is not None and sequence_id >= self.end):
+                    continue
+
+                if self.event_filter is not None and not _matches(packed['obj'], self.event_filter):
+                    continue
+
+                result.append(packed if self.fields is None else {'sequence_id': sequence_id, 'obj': _project(packed['obj'], self.fields)})
+
+            self._segments_end = max(self._segments_end, e['segment_end'])
+
+        return result
+
+    def _load_payloads(self, batch):
+        """
+        Load the whole obj of the events, whose payload can't be projected (pickled, compressed, chunked or escaped objects).
+        The events, which are unpacked from segments, already have their whole obj (and no _id)
+        """
+        partial = [e for e in batch if '_id' in e and not _projectable(e.get('obj', _MISSING))]
+        if not partial:
+            return batch
+
+        payloads = {d['_id']: d['obj'] for d in self._mongo_collection.find({'_id': {'$in': [e['_id'] for e in partial]}}, projection={'obj': True})}
+        for e in partial:
+            e['obj'] = payloads[e['_id']]
+
+        return batch
+
+    def _check_gaps(self, batch):
+        for e in batch:
+            if e['sequence_id'] != self._next_sequence_id:
+                gap = (self._next_sequence_id, e['sequence_id'])
+                self.gaps.append(gap)
+
+                logging.getLogger(__name__).warning("Group " + str(self.group_id) + " has no events between sequence ids " + str(gap[0]) + " and " + str(gap[1] - 1))
+
+                if self.on_gap is not None:
+                    self.on_gap(*gap)
+
+            self._next_sequence_id = e['sequence_id'] + 1
+
+        return batch
+
+    def _decode_batch(self, batch):
+        return [(e['sequence_id'], e['obj'] if self._decoder is None else self._decoder(e['obj'])) for e in batch]
+
+
+_MISSING = object()
+
+# keys of the encoded objects, whose fields aren't fields of the event
+_PAYLOAD_MARKERS = ('__compressed__', '__chunked__', '__items__')
+
+_COMPARISONS = {'$gt': operator.gt, '$gte': operator.ge, '$lt': operator.lt, '$lte': operator.le}
+
+
+def _get_path(obj, path):
+    for key in path.split('.'):
+        if not isinstance(obj, dict) or key not in obj:
+            return _MISSING
+        obj = obj[key]
+
+    return obj
+
+
+def _compare(value, condition) -> bool:
+    if isinstance(condition, dict) and condition and all(k.startswith('$') for k in condition):
+        for op, operand in condition.items():
+            if op == '$exists':
+                ok = (value is not _MISSING) == bool(operand)
+            elif op == '$in':
+                ok = any(_compare(value, o) for o in operand)
+            elif op == '$ne':
+                ok = not _compare(value, operand)
+            elif op in _COMPARISONS:
+                try:
+                    ok = value is not _MISSING and _COMPARISONS[op](value, operand)
+                except TypeError:
+                    ok = False
+            else:
+                raise ValueError("Operator " + op + " is not supported for compacted events")
+
+            if not ok:
+                return False
+
+        return True
+
+    if value is _MISSING:
+        return condition is None
+
+    # like mongodb, a list matches if any of its elements matches
+    return value == condition or (isinstance(value, list) and condition in value)
+
+
+def _matches(obj, event_filter: dict) -> bool:
+    """Evaluate a mongodb query on a packed event"""
+    return all(_compare(_get_path(obj, k), v) for k, v in event_filter.items())
+
+
+def _projectable(obj) -> bool:
+    return isinstance(obj, dict) and not any(m in obj for m in _PAYLOAD_MARKERS)
+
+
+def _project(obj, fields: list) -> dict:
+    """Keep only fields (dotted paths) of a packed event"""
+    if not _projectable(obj):
+        return obj
+
+    result = dict()
+    for f in fields:
+        value = _get_path(obj, f)
+        if value is _MISSING:
+            continue
+
+        target = result
+        keys = f.split('.')
+        for key in keys[:-1]:
+            target = target.setdefault(key, dict())
+        target[keys[-1]] = value
+
+    return result
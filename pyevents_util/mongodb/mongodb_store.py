@@ -1,26 +1,96 @@
+import collections
+import collections.abc
+import hashlib
 import logging
-from typing import Callable
+import threading
+import time
+from typing import Callable, Iterable, Tuple
 
 import pymongo
-from bson.binary import Binary
-from bson.errors import BSONError
 
+from pyevents_util.events import StoreObjectEvent, event_factory
+from pyevents_util.metrics import MongoMetrics
+from pyevents_util.mongodb.chunked_storage import ChunkStore, chunk_store
 from pyevents_util.mongodb.util import *
+from pyevents_util.routing import subscribe
+
+VERSION_FIELD = '__store_version__'
 
 
 class MongoDBStore(object):
-    """Save object manager based on accept_event_function criteria"""
+    """
+    Save object manager based on accept_event_function criteria.
+    If flush_interval or max_pending is set, the store works in coalescing write-behind mode: only the latest stored object
+    for each _id is kept until the next flush, and all of them are written with a single bulk_write. The objects are encoded
+    at flush time and the store_object notifications are fired after the write. close() writes the pending objects.
+    If a flush fails, its objects are kept for the next one (unless they are replaced by newer versions in the meantime). The
+    error of a failed periodic flush is raised by the next store() or close().
+    If cache_size or cache_bytes is set, load() reads through an LRU cache of decoded objects, which is invalidated by store().
+    With versioned=True every write records a new version in the document and load() checks the version of cached objects
+    against the database, so that multiple processes can share the store.
+    With delta=True the store remembers a digest of each top level field of the last written version of every _id and sends
+    only the changed fields ($set/$unset). Objects, whose type changes, are replaced. The delta mode assumes that an object
+    is written only by this store
+    """
 
-    def __init__(self, mongo_collection, accept_for_serialization: Callable, encoder: Callable = None, listeners=None):
+    def __init__(self, mongo_collection, accept_for_serialization: Callable, encoder: Callable = None, listeners=None, flush_interval: float = None, max_pending: int = None,
+                 decoder: Callable = None, cache_size: int = None, cache_bytes: int = None, versioned: bool = False, delta: bool = False,
+                 routes: Iterable[Tuple] = None, compact_events: bool = False, metrics=None, chunks: ChunkStore = None):
+        """
+        :param mongo_collection: collection to store the objects in
+        :param accept_for_serialization: predicate, which decides whether the data of an event should be stored
+        :param encoder: encoder for the objects
+        :param listeners: event listeners
+        :param flush_interval: write the pending objects every flush_interval seconds
+        :param max_pending: write the pending objects when their number reaches max_pending
+        :param decoder: decoder for load()
+        :param cache_size: maximum number of cached objects
+        :param cache_bytes: maximum (encoded) size of the cached objects
+        :param versioned: record a version on each write and validate the cached objects against it
+        :param delta: write only the changed top level fields
+        :param routes: (type, phase) tuples of the events, which are passed to accept_for_serialization, if listeners is an EventRouter (all events by default)
+        :param compact_events: fire the store_object events as slotted Event objects instead of dicts
+        :param metrics: MetricsRegistry for the write/read latency, batch sizes, serialized bytes and pickle fallbacks (no metrics if None)
+        :param chunks: ChunkStore of the encoder, whose chunks of the replaced objects are deleted (detected if encoder is ChunkStore.encode)
+        """
 
         self._mongo_collection = mongo_collection
 
         self.accept_for_serialization = accept_for_serialization
 
         self._encoder = encoder if encoder is not None else default_encoder
+        self._chunks = chunks if chunks is not None else chunk_store(encoder)
+
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._pending = collections.OrderedDict()
+        self._flush_error = None
+        self._write_stats = {'stored': 0, 'coalesced': 0, 'written': 0, 'updated': 0, 'unchanged': 0}
+
+        self.delta = delta
+        self._digests = dict()
+
+        self._decoder = decoder
+        self.versioned = versioned
+        self._cache = LRUCache(cache_size, cache_bytes) if cache_size is not None or cache_bytes is not None else None
+        self._generation = 0
+
+        self._metrics = MongoMetrics(metrics, mongo_collection.name if mongo_collection is not None else 'events') if metrics is not None else None
+
+        self._closed = threading.Event()
+
+        if flush_interval is not None:
+            self._flush_thread = threading.Thread(target=self._flush_periodically, daemon=True)
+            self._flush_thread.start()
+        else:
+            self._flush_thread = None
 
         self.listeners = listeners
-        self.listeners += self.on_event
+        self._store_object_event = event_factory(StoreObjectEvent, compact_events)
+        subscribe(self.listeners, self.on_event, routes)
 
     @property
     def collection(self):
@@ -29,26 +99,370 @@ class MongoDBStore(object):
 
         return self._mongo_collection
 
+    @property
+    def write_behind(self):
+        return self.flush_interval is not None or self.max_pending is not None
+
+    @property
+    def write_stats(self):
+        """
+        :return: number of stored objects, objects, which were replaced by a newer version before they were written, written objects,
+        objects, which were written as field updates (delta mode) and objects without changes, which were not written (delta mode)
+        """
+        with self._lock:
+            return dict(self._write_stats)
+
+    @property
+    def cache_stats(self):
+        """
+        :return: cache hits, misses, evictions, invalidations, entries and bytes (None if the cache is disabled)
+        """
+        return self._cache.stats if self._cache is not None else None
+
     def on_event(self, event):
         if self.accept_for_serialization(event):
             self.store(event['data'])
 
     def store(self, obj):
-        if isinstance(obj, dict):
+        if isinstance(obj, collections.abc.Mapping):
             _id = obj['_id']
         else:
             _id = getattr(obj, '_id')
 
+        if self.write_behind:
+            with self._lock:
+                error, self._flush_error = self._flush_error, None
+
+            if error is not None:
+                raise error
+
+            with self._lock:
+                self._write_stats['stored'] += 1
+                if _id in self._pending:
+                    self._write_stats['coalesced'] += 1
+                    del self._pending[_id]
+
+                self._pending[_id] = obj
+                full = self.max_pending is not None and len(self._pending) >= self.max_pending
+
+            if full:
+                self.flush()
+
+            return
+
+        if self.delta:
+            with self._lock:
+                self._write_stats['stored'] += 1
+
+            self._write([self._request(_id, obj)])
+            self.listeners(self._store_object_event(obj))
+            return
+
+        start = time.perf_counter()
+
+        doc = None
+
+        encoded = self._encode(obj)
+        if encoded is not None:
+            doc = self._versioned(encoded)
+            try:
+                self._replace(_id, doc)
+                logging.getLogger(__name__).debug("Stored json object")
+            except BSON_ERRORS:
+                self._discard(encoded)
+                doc = None
+
+        if doc is None:
+            doc = self._versioned(self._binary_document(obj))
+            self._replace(_id, doc)
+
+        if self._metrics is not None:
+            self._metrics.written(start, 1, len(bson.encode(doc, codec_options=collection_codec_options(self.collection))))
+
+        with self._lock:
+            self._write_stats['stored'] += 1
+            self._write_stats['written'] += 1
+
+        self._invalidate(_id)
+
+        self.listeners(self._store_object_event(obj))
+
+    def flush(self):
+        """Write the pending objects with a single bulk_write and notify the listeners"""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, collections.OrderedDict()
+
+            if not pending:
+                return
+
+            try:
+                self._write([self._request(_id, obj) for _id, obj in pending.items()])
+            except Exception:
+                # the unwritten objects are kept at the head of the pending objects, unless there are newer versions
+                with self._lock:
+                    unwritten = collections.OrderedDict((_id, obj) for _id, obj in pending.items() if _id not in self._pending)
+                    self._write_stats['coalesced'] += len(pending) - len(unwritten)
+
+                    unwritten.update(self._pending)
+                    self._pending = unwritten
+
+                raise
+
+            for obj in pending.values():
+                self.listeners(self._store_object_event(obj))
+
+    def close(self):
+        """Stop the periodic flushing and write the pending objects. Raises the error of a failed periodic flush"""
+        self._closed.set()
+
+        if self._flush_thread is not None and self._flush_thread is not threading.current_thread():
+            self._flush_thread.join()
+
+        self.flush()
+
+        with self._lock:
+            error, self._flush_error = self._flush_error, None
+
+        if error is not None:
+            raise error
+
+    def _encode_document(self, obj):
+        """
+        :return: the encoded (and versioned) document and the digests of its fields (in delta mode)
+        """
+        doc = self._encode(obj)
+        if doc is not None:
+            try:
+                return self._versioned(doc), self._validate(doc)
+            except BSON_ERRORS:
+                self._discard(doc)
+
+        doc = self._binary_document(obj)
+
+        return self._versioned(doc), self._validate(doc)
+
+    def _encode(self, obj):
+        """
+        :return: the encoded object or None, if the encoder can't encode it (for example because of reference cycles)
+        """
+        try:
+            return obj if self._encoder is None else self._encoder(obj)
+        except ENCODER_ERRORS:
+            return None
+
+    def _replace(self, _id, doc):
+        """Replace the stored object and delete the chunks of the previous version"""
+        if self._chunks is None:
+            self.collection.replace_one({'_id': _id}, doc, upsert=True)
+            return
+
+        previous = self.collection.find_one_and_replace({'_id': _id}, doc, upsert=True)
+        if previous is not None:
+            self._chunks.delete(previous, keep=doc)
+
+    def _discard(self, doc):
+        """Delete the chunks of an encoded document, which isn't written"""
+        if self._chunks is not None:
+            self._chunks.delete(doc)
+
+    def _binary_document(self, obj):
+        logging.getLogger(__name__).debug("Failed to serialize json. Falling back to binary serialization")
+
+        if self._metrics is not None:
+            self._metrics.pickle_fallbacks.inc()
+
+        return {'binary_data': encode_binary(obj, self._encoder)}
+
+    def _validate(self, doc):
+        """Check whether the document can be serialized. In delta mode compute the digests of the top level fields"""
+        if not self.delta:
+            bson.encode(doc, codec_options=collection_codec_options(self.collection))
+            return None
+
+        return {k: hashlib.blake2b(bson.encode({'v': v}, codec_options=collection_codec_options(self.collection)), digest_size=16).digest() for k, v in doc.items()}
+
+    def _request(self, _id, obj):
+        """
+        :return: (_id, write request or None if nothing changed, field digests, encoded document)
+        """
+        doc, digests = self._encode_document(obj)
+
+        if not self.delta:
+            return _id, pymongo.ReplaceOne({'_id': _id}, doc, upsert=True), digests, doc
+
+        with self._lock:
+            previous = self._digests.get(_id)
+
+        if previous is None or previous.get('__class__') != digests.get('__class__') or 'binary_data' in previous or 'binary_data' in digests:
+            return _id, pymongo.ReplaceOne({'_id': _id}, doc, upsert=True), digests, doc
+
+        update = dict()
+
+        changed = {k: doc[k] for k, d in digests.items() if previous.get(k) != d}
+        if changed:
+            if VERSION_FIELD in doc:
+                changed[VERSION_FIELD] = doc[VERSION_FIELD]
+
+            update['$set'] = changed
+
+        removed = {k: '' for k in previous if k not in digests}
+        if removed:
+            update['$unset'] = removed
+
+        return _id, pymongo.UpdateOne({'_id': _id}, update) if update else None, digests, doc
+
+    def _write(self, requests):
+        """Execute the write requests, created by _request"""
+        active = [r for _, r, _, _ in requests if r is not None]
+
+        # the previous versions with their chunk references
+        previous = {d['_id']: d for d in self.collection.find({'_id': {'$in': [_id for _id, _, _, _ in requests]}})} if self._chunks is not None else None
+
+        if active:
+            start = time.perf_counter()
+
+            try:
+                result = self.collection.bulk_write(active, ordered=False)
+            except Exception:
+                self._discard_unwritten(requests)
+                raise
+
+            if result.matched_count + result.upserted_count < len(active):
+                # some of the updated documents were removed in the meantime
+                self.collection.bulk_write([pymongo.ReplaceOne({'_id': _id}, doc, upsert=True) for _id, r, _, doc in requests if isinstance(r, pymongo.UpdateOne)], ordered=False)
+
+            logging.getLogger(__name__).debug("Stored " + str(len(active)) + " objects")
+
+            if self._metrics is not None:
+                self._metrics.written(start, len(active), sum(len(bson.encode(doc, codec_options=collection_codec_options(self.collection))) for _, r, _, doc in requests if r is not None))
+
+        with self._lock:
+            self._write_stats['written'] += len(active)
+            self._write_stats['updated'] += sum(1 for r in active if isinstance(r, pymongo.UpdateOne))
+            self._write_stats['unchanged'] += len(requests) - len(active)
+
+            if self.delta:
+                for _id, _, digests, _ in requests:
+                    self._digests[_id] = digests
+
+        for _id, r, _, _ in requests:
+            if r is not None:
+                self._invalidate(_id)
+
+        if previous is not None:
+            for _id, r, _, doc in requests:
+                if r is not None and _id in previous:
+                    self._chunks.delete(previous[_id], keep=doc)
+                elif r is None:
+                    self._chunks.delete(doc, keep=previous.get(_id))
+
+    def _discard_unwritten(self, requests):
+        """Delete the chunks of the documents of a failed write, which are not referenced by the stored documents"""
+        if self._chunks is None:
+            return
+
         try:
-            self.collection.replace_one({'_id': _id}, obj if self._encoder is None else self._encoder(obj), upsert=True)
-            logging.getLogger(__name__).debug("Stored json object")
-        except (BSONError, TypeError):
-            self.collection.replace_one({'_id': _id}, {'binary_data': Binary(pickle.dumps(obj))}, upsert=True)
-            logging.getLogger(__name__).debug("Failed to serialize json. Falling back to binary serialization")
+            stored = {d['_id']: d for d in self.collection.find({'_id': {'$in': [_id for _id, _, _, _ in requests]}})}
+        except Exception as e:
+            logging.getLogger(__name__).warning("Failed to delete the chunks of unwritten objects: " + str(e))
+            return
+
+        for _id, _, _, doc in requests:
+            self._chunks.delete(doc, keep=stored.get(_id))
 
-        self.listeners({'type': 'store_object', 'data': obj})
+    def _versioned(self, doc):
+        if self.versioned:
+            doc[VERSION_FIELD] = ObjectId()
+
+        return doc
+
+    def _invalidate(self, _id):
+        if self._cache is not None:
+            with self._lock:
+                self._generation += 1
+
+            self._cache.invalidate(_id)
+
+    def load(self, _id):
+        """
+        Restore object through the cache (if enabled). The cached objects are shared between the callers and should not be modified
+        (numpy arrays are read-only)
+        :param _id: object id
+        :return: the object or None if it doesn't exist
+        """
+        if self._cache is None:
+            start = time.perf_counter()
+            obj = self.restore(self.collection, _id, self._decoder)
+
+            if self._metrics is not None:
+                self._metrics.read(start, 1)
+
+            return obj
+
+        if self.write_behind:
+            with self._lock:
+                pending = _id in self._pending
+
+            if pending:
+                self.flush()
+
+        cached = self._cache.get(_id)
+        if cached is not None:
+            version, obj = cached
+            if not self.versioned:
+                return obj
+
+            current = self.collection.find_one({'_id': _id}, projection={VERSION_FIELD: True})
+            if current is not None and current.get(VERSION_FIELD) == version:
+                return obj
+
+            self._cache.invalidate(_id)
+
+        with self._lock:
+            generation = self._generation
+
+        start = time.perf_counter()
+
+        data = self.collection.find_one({'_id': _id})
+
+        if self._metrics is not None:
+            self._metrics.read(start, 1)
+
+        if data is None:
+            return None
+
+        version = data.pop(VERSION_FIELD, None)
+        size = len(bson.encode(data, codec_options=collection_codec_options(self.collection)))
+
+        data = data['binary_data'] if 'binary_data' in data else data
+        obj = default_decoder(data) if self._decoder is None else self._decoder(data)
+
+        with self._lock:
+            if generation == self._generation:
+                self._cache.put(_id, (version, obj), size)
+
+        return obj
+
+    def _flush_periodically(self):
+        while not self._closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logging.getLogger(__name__).exception("Periodic flush failed")
+
+                with self._lock:
+                    self._flush_error = e
 
     @staticmethod
-    def restore(mongo_collection, _id):
+    def restore(mongo_collection, _id, decoder: Callable = None):
         data = mongo_collection.find_one({'_id': _id})
-        return default_decoder(data['binary_data'] if 'binary_data' in data else data)
+        if data is None:
+            return None
+
+        data.pop(VERSION_FIELD, None)
+
+        if decoder is None:
+            return default_decoder(data['binary_data'] if 'binary_data' in data else data, writeable=True)
+
+        return decoder(data['binary_data'] if 'binary_data' in data else data)
@@ -1,44 +1,739 @@
 import numpy as np
 import base64
+import collections
+import dataclasses
+import datetime
+import enum
+import functools
+import importlib
+import lzma
 import pickle
+import re
+import threading
+import time
+import types
+import uuid
+import zlib
+from typing import Callable
+
+import bson
+import pymongo
+from bson.binary import Binary
+from bson.codec_options import CodecOptions
+from bson.code import Code
+from bson.dbref import DBRef
+from bson.decimal128 import Decimal128
+from bson.errors import BSONError
+from bson.int64 import Int64
+from bson.max_key import MaxKey
+from bson.min_key import MinKey
+from bson.objectid import ObjectId
+from bson.regex import Regex
+from bson.timestamp import Timestamp
+
+from pyevents_util.events import Event
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+NDARRAY_VERSION = 2
+
+_ENCODERS = dict()
+
+_DECODERS = dict()
+
+_dispatch_cache = dict()
+
+# objects of these types are never encoded as documents
+_OPAQUE_TYPES = (type, types.FunctionType, types.BuiltinFunctionType, types.MethodType, types.ModuleType, functools.partial, enum.Enum)
+
+
+def register_encoder(cls: type, encoder: Callable, traverse: bool = True):
+    """
+    Register encoder for a type (and its subclasses without own encoder)
+    :param cls: type
+    :param encoder: function, which converts an instance of cls to a BSON compatible value
+    :param traverse: whether the nested values of the result (dict values or list items) should be encoded too
+    """
+    _ENCODERS[cls] = (encoder, traverse)
+    _dispatch_cache.clear()
+
+
+def register_decoder(marker: str, decoder: Callable, leaf: bool = False):
+    """
+    Register decoder for encoded dicts, which contain the marker key
+    :param marker: key, which identifies the encoded type
+    :param decoder: function, which converts the encoded dict to the original value
+    :param leaf: if True, the nested values are passed to the decoder as they are. Otherwise they are decoded first
+    """
+    _DECODERS[marker] = (decoder, leaf)
+
+
+def _dispatch(cls):
+    try:
+        return _dispatch_cache[cls]
+    except KeyError:
+        pass
+
+    for c in cls.__mro__:
+        if c in _ENCODERS:
+            entry = _ENCODERS[c]
+            break
+    else:
+        if not issubclass(cls, _OPAQUE_TYPES) and (dataclasses.is_dataclass(cls) or hasattr(cls, '__slots__') or '__dict__' in dir(cls)):
+            entry = (_encode_pickled, False) if _customizes_pickling(cls) else (_object_encoder(cls), True)
+        else:
+            entry = (None, False)
+
+    _dispatch_cache[cls] = entry
+
+    return entry
 
 
 def default_encoder(obj):
     """
-    Encodes object to json serializable types
+    Encodes object to json serializable types. The type specific encoders are registered with register_encoder.
+    Numpy arrays are stored as their raw contiguous buffer (bson Binary) together with the dtype (including the byte order and the
+    fields of structured dtypes) and the shape. Arrays with object dtypes raise TypeError.
+    Lists, tuples, dataclasses and objects with __dict__ or __slots__ are stored as (queryable) documents. Objects of classes,
+    which customize pickling (__reduce__, __getstate__, __setstate__ etc.), are pickled, so that they are restored properly.
+    Dicts with the marker keys of encoded values (like __class__) are stored as lists of (key, value) pairs.
+    The traversal is iterative, so deeply nested objects don't hit the recursion limit. Cyclic references raise TypeError
     :param obj: object to encode
     :return: encoded object
     """
 
-    if isinstance(obj, np.ndarray):
-        data_b64 = base64.b64encode(np.ascontiguousarray(obj).data)
-        return dict(__ndarray__=data_b64, dtype=str(obj.dtype), shape=obj.shape)
+    root = [obj]
+    stack = [(root, 0)]
+    path = dict()
 
-    if isinstance(obj, dict):
-        result = dict()
-        for k, v in obj.items():
-            result[k] = default_encoder(v)
+    while stack:
+        container, key = stack.pop()
 
-        return result
+        if container is None:
+            del path[key]
+            continue
+
+        value = container[key]
+
+        encoder, traverse = _dispatch(type(value))
+        if encoder is None:
+            continue
+
+        encoded = encoder(value)
+        container[key] = encoded
+
+        if traverse:
+            if id(value) in path:
+                raise TypeError("Cannot encode cyclic reference to " + type(value).__name__)
 
-    return obj
+            path[id(value)] = value
+            stack.append((None, id(value)))
 
+            if isinstance(encoded, dict):
+                stack.extend((encoded, k) for k in encoded)
+            elif isinstance(encoded, list):
+                stack.extend((encoded, i) for i in range(len(encoded)))
 
-def default_decoder(obj):
+    return root[0]
+
+
+def default_decoder(obj, writeable: bool = False):
     """
-    Decodes a previously encoded json object, taking care of numpy arrays
+    Decodes a previously encoded json object, taking care of numpy arrays and the types with registered decoders.
+    Binary data outside of an encoded type is treated as a pickled object
     :param obj: object to decode
+    :param writeable: if True, numpy arrays are copied to writeable buffers. Otherwise they share the (read-only) stored buffer
     :return: decoded object
     """
 
-    if isinstance(obj, dict):
-        if '__ndarray__' in obj:
-            data = base64.b64decode(obj['__ndarray__'])
-            return np.frombuffer(data, obj['dtype']).reshape(obj['shape'])
+    root = [obj]
+    stack = [(root, 0, False)]
+
+    while stack:
+        container, key, finish = stack.pop()
+        value = container[key]
+
+        if finish:
+            container[key] = _DECODERS[finish][0](value)
+        elif isinstance(value, dict):
+            if '__ndarray__' in value:
+                container[key] = decode_ndarray(value, writeable=writeable)
+            elif '__compressed__' in value:
+                container[key] = decompress(value)
+                stack.append((container, key, False))
+            else:
+                for marker, (decoder, leaf) in _DECODERS.items():
+                    if marker in value:
+                        if leaf:
+                            container[key] = decoder(value)
+                        else:
+                            stack.append((container, key, marker))
+                            stack.extend((value, k, False) for k in value)
+
+                        break
+                else:
+                    stack.extend((value, k, False) for k in value)
+        elif isinstance(value, list):
+            stack.extend((value, i, False) for i in range(len(value)))
+        elif isinstance(value, (bytes, bytearray)):
+            container[key] = pickle.loads(value)
+
+    return root[0]
+
+
+def is_document(obj):
+    """
+    :param obj: encoded object
+    :return: whether obj is a plain document (and not an encoded value like a numpy array, an object or a reference)
+    """
+    return isinstance(obj, dict) and '__ndarray__' not in obj and '__compressed__' not in obj and '__chunked__' not in obj and not any(m in obj for m in _DECODERS)
+
+
+def decode_ndarray(obj, writeable: bool = False):
+    """
+    Decodes numpy array. By default the resulting array shares the memory of the stored buffer (and is read-only).
+    Arrays, stored in the legacy base64 format (without version) are supported too
+    :param obj: encoded array
+    :param writeable: copy the data to a writeable buffer, if needed
+    :return: numpy array
+    """
+    if obj.get('__version__', 1) >= 2:
+        data = obj['__ndarray__']
+        if isinstance(data, dict) and '__compressed__' in data:
+            data = decompress(data)
+    else:
+        data = base64.b64decode(obj['__ndarray__'])
+
+    if writeable and not isinstance(data, bytearray):
+        data = bytearray(data)
+
+    return np.frombuffer(data, _descr_dtype(obj['dtype'])).reshape(obj['shape'])
+
+
+def _encode_ndarray(obj):
+    if obj.dtype.hasobject:
+        raise TypeError("Numpy arrays with objects have no raw buffer")
+
+    return dict(__ndarray__=Binary(np.ascontiguousarray(obj).tobytes()), __version__=NDARRAY_VERSION, dtype=np.lib.format.dtype_to_descr(obj.dtype), shape=list(obj.shape))
+
+
+def _descr_dtype(descr):
+    """dtype of a stored descr: a dtype string or the field list of a structured dtype (with the tuples stored as lists)"""
+    if isinstance(descr, str):
+        return np.dtype(descr)
+
+    return np.lib.format.descr_to_dtype([_descr_field(f) for f in descr])
+
+
+def _descr_field(field):
+    name, dtype, *shape = field
+    return (tuple(name) if isinstance(name, list) else name, dtype if isinstance(dtype, str) else [_descr_field(f) for f in dtype], *(tuple(s) for s in shape))
+
+
+def _encode_bytes(obj):
+    return {'__bytes__': Binary(bytes(obj))}
+
+
+def _decode_bytes(obj):
+    data = obj['__bytes__']
+    if isinstance(data, dict) and '__compressed__' in data:
+        data = decompress(data)
+
+    return bytes(data)
+
+
+@functools.lru_cache(maxsize=None)
+def _import_class(name):
+    module, qualname = name.split(':')
+    result = importlib.import_module(module)
+    for attr in qualname.split('.'):
+        result = getattr(result, attr)
+
+    return result
+
+
+def _object_encoder(cls):
+    """Create encoder for dataclasses and objects with __dict__ or __slots__"""
+
+    class_name = cls.__module__ + ':' + cls.__qualname__
+    is_local = '<locals>' in cls.__qualname__
+    is_dataclass = dataclasses.is_dataclass(cls)
+
+    if is_dataclass:
+        names = [f.name for f in dataclasses.fields(cls)]
+    else:
+        names = list()
+        for c in cls.__mro__:
+            slots = c.__dict__.get('__slots__', ())
+            names.extend(s for s in ([slots] if isinstance(slots, str) else slots) if s not in ('__dict__', '__weakref__'))
+
+    def encode(obj):
+        if is_local:
+            raise TypeError("Cannot encode instance of local class " + class_name)
+
+        result = {'__class__': class_name}
+
+        if not is_dataclass and hasattr(obj, '__dict__'):
+            result.update(obj.__dict__)
+
+        for n in names:
+            if hasattr(obj, n):
+                result[n] = getattr(obj, n)
+
+        return result
+
+    return encode
+
+
+_PICKLE_METHODS = ('__reduce__', '__reduce_ex__', '__getstate__', '__getnewargs__', '__getnewargs_ex__')
+
+
+def _customizes_pickling(cls) -> bool:
+    """Whether the instances of the class can't be restored from their attributes"""
+    return hasattr(cls, '__setstate__') or any(getattr(cls, m, None) is not getattr(object, m, None) for m in _PICKLE_METHODS)
+
+
+def _encode_pickled(obj):
+    # binary data outside of an encoded type is decoded as pickled object
+    return Binary(pickle.dumps(obj))
+
+
+# markers of the encoded values without registered decoder
+_MARKERS = ('__ndarray__', '__compressed__', '__chunked__')
+
+
+def _encode_dict(obj):
+    """Dicts with marker keys are stored as lists of (key, value) pairs, so that they aren't decoded as encoded values"""
+    if any(m in obj for m in _DECODERS) or any(m in obj for m in _MARKERS):
+        return {'__items__': [[k, v] for k, v in obj.items()]}
+
+    return dict(obj)
+
+
+def _decode_object(obj):
+    cls = _import_class(obj.pop('__class__'))
+    result = cls.__new__(cls)
+    for k, v in obj.items():
+        object.__setattr__(result, k, v)
+
+    return result
+
+
+for _t in (str, int, float, bool, type(None), datetime.datetime, uuid.UUID, Binary, ObjectId, Code, Decimal128, Int64, Regex, Timestamp, MinKey, MaxKey, DBRef, re.Pattern):
+    register_encoder(_t, lambda x: x, traverse=False)
+
+register_encoder(dict, _encode_dict)
+register_encoder(Event, _encode_dict)
+register_encoder(list, list)
+register_encoder(tuple, lambda x: {'__tuple__': list(x)})
+register_encoder(bytes, _encode_bytes, traverse=False)
+register_encoder(bytearray, _encode_bytes, traverse=False)
+register_encoder(np.ndarray, _encode_ndarray, traverse=False)
+register_encoder(np.generic, lambda x: x.item(), traverse=False)
+
+register_decoder('__bytes__', _decode_bytes, leaf=True)
+register_decoder('__tuple__', lambda x: tuple(x['__tuple__']))
+register_decoder('__class__', _decode_object)
+register_decoder('__items__', lambda x: dict(x['__items__']))
+
+
+def encode_binary(obj, encoder: Callable = None):
+    """
+    Fallback for objects, which cannot be stored as documents: pickle the object as bson Binary and pass it through the encoder,
+    so that large blobs can be handled by encoders like ChunkStore.encode
+    :param obj: object to encode
+    :param encoder: encoder of the binary data
+    :return: encoded object
+    """
+    binary = Binary(pickle.dumps(obj))
+    return binary if encoder is None else encoder(binary)
+
+
+# errors of the encoders for objects, which they can't encode (for example objects with reference cycles)
+ENCODER_ERRORS = (BSONError, TypeError)
+
+# errors of bson.encode for values, which can't be stored in documents
+BSON_ERRORS = (BSONError, OverflowError)
+
+
+def collection_codec_options(collection) -> CodecOptions:
+    """
+    :param collection: collection
+    :return: BSON codec options of the collection for bson.encode/bson.decode. Collections, which have other options types
+    (for example mongomock), are converted to CodecOptions with the same settings
+    """
+    options = collection.codec_options
+    if isinstance(options, CodecOptions):
+        return options
+
+    return CodecOptions(document_class=options.document_class, tz_aware=options.tz_aware, uuid_representation=options.uuid_representation,
+                        unicode_decode_error_handler=options.unicode_decode_error_handler, tzinfo=options.tzinfo)
+
+
+SEQUENCE_INDEX = [('group_id', pymongo.ASCENDING), ('sequence_id', pymongo.ASCENDING)]
+
+# partial index of the segments, which finds the segment containing a sequence id without scanning the events before it
+SEGMENT_INDEX = [('group_id', pymongo.ASCENDING), ('segment_end', pymongo.ASCENDING)]
+
+
+def ensure_sequence_index(collection):
+    """
+    Check whether the sequence log collection has the unique (group_id, sequence_id) index and the partial (group_id, segment_end)
+    index of the segments and create them if they are missing
+    :param collection: sequence log collection
+    """
+    indexes = [([tuple(k) for k in index['key']], index) for index in collection.index_information().values()]
+
+    if not any(keys == SEQUENCE_INDEX and index.get('unique', False) for keys, index in indexes):
+        collection.create_index(SEQUENCE_INDEX, unique=True)
+
+    if not any(keys == SEGMENT_INDEX for keys, _ in indexes):
+        collection.create_index(SEGMENT_INDEX, partialFilterExpression={'segment_end': {'$exists': True}})
+
+
+def ensure_ttl_index(collection, expire_after: float):
+    """
+    Create the TTL index on the created field of the sequence log collection, if it's missing
+    :param collection: sequence log collection
+    :param expire_after: seconds after which the events (and segments) are deleted by the server
+    """
+    for index in collection.index_information().values():
+        if [tuple(k) for k in index['key']] == [('created', pymongo.ASCENDING)] and 'expireAfterSeconds' in index:
+            return
+
+    collection.create_index([('created', pymongo.ASCENDING)], expireAfterSeconds=int(expire_after))
+
+
+def last_sequence_id(collection, group_id):
+    """
+    Find the last sequence_id of a group (using the (group_id, sequence_id) index)
+    :param collection: sequence log collection
+    :param group_id: group id
+    :return: the last sequence_id or None if the group is empty
+    """
+    e = collection.find_one({'group_id': group_id}, projection={'_id': False, 'sequence_id': True, 'segment_end': True}, sort=[('sequence_id', pymongo.DESCENDING)])
+    if e is None:
+        return None
+
+    return e['segment_end'] - 1 if 'segment_end' in e else e['sequence_id']
+
+
+def is_segment(doc):
+    """
+    :return: whether a sequence log document is a compacted segment
+    """
+    return 'segment_end' in doc
+
+
+def encode_segment(events: list, codec: str = 'zlib', level: int = None, codec_options=None):
+    """
+    Pack a contiguous run of sequence log documents into the payload of a segment document
+    :param events: sequence log documents (with sequence_id and obj)
+    :param codec: compression codec (see CODECS)
+    :param level: compression level
+    :param codec_options: BSON codec options of the collection
+    :return: compressed payload (or Binary, if the compression didn't reduce the size)
+    """
+    payload = bson.encode({'events': [{'sequence_id': e['sequence_id'], 'obj': e['obj']} for e in events]}, codec_options=codec_options or bson.DEFAULT_CODEC_OPTIONS)
+
+    compressed = compress(payload, codec, level)
+
+    return compressed if isinstance(compressed, dict) else Binary(compressed)
+
+
+def decode_segment(doc, codec_options=None):
+    """
+    :param doc: segment document
+    :param codec_options: BSON codec options of the collection
+    :return: list of the packed sequence log documents (with sequence_id and obj)
+    """
+    payload = doc['segment']
+    if isinstance(payload, dict):
+        payload = decompress(payload)
+
+    return bson.decode(bytes(payload), codec_options=codec_options or bson.DEFAULT_CODEC_OPTIONS)['events']
+
+
+def reserve_sequence_block(counters_collection, group_id, size: int):
+    """
+    Atomically reserve a block of sequence ids of a group
+    :param counters_collection: collection with the sequence counters
+    :param group_id: group id
+    :param size: number of ids to reserve
+    :return: (first, end) range of the reserved ids
+    """
+    counter = counters_collection.find_one_and_update({'_id': group_id}, {'$inc': {'next': size}}, upsert=True, return_document=pymongo.ReturnDocument.AFTER)
+    return counter['next'] - size, counter['next']
+
+
+def walk_encoded(obj, compressed: bool = False):
+    """
+    Iterate over all (container, key, value) of the nested dicts and lists of an encoded object without recursion.
+    The values can be replaced through the container during the iteration. Chunk references are not traversed
+    :param obj: encoded object
+    :param compressed: traverse the compressed values too (their payload is already encoded and must not be modified
+    by other encoders, but it can be moved to chunks)
+    """
+    stack = [obj]
+    while stack:
+        current = stack.pop()
+        if isinstance(current, dict):
+            if '__chunked__' in current or (not compressed and '__compressed__' in current):
+                continue
+
+            items = current.items()
+        elif isinstance(current, list):
+            items = enumerate(current)
         else:
+            continue
+
+        for k, v in list(items):
+            yield current, k, v
+            if isinstance(v, (dict, list)):
+                stack.append(v)
+
+
+class Codec(object):
+    """Compression codec with compression ratio and timing statistics"""
+
+    def __init__(self, name: str, compress: Callable, decompress: Callable):
+        self.name = name
+        self._compress = compress
+        self._decompress = decompress
+
+        self._lock = threading.Lock()
+        self._stats = {'compress_calls': 0, 'bytes_in': 0, 'bytes_out': 0, 'compress_time': 0.0, 'decompress_calls': 0, 'decompress_time': 0.0}
+
+    def compress(self, data, level=None):
+        start = time.perf_counter()
+        result = self._compress(data) if level is None else self._compress(data, level)
+        elapsed = time.perf_counter() - start
+
+        with self._lock:
+            self._stats['compress_calls'] += 1
+            self._stats['bytes_in'] += len(data)
+            self._stats['bytes_out'] += len(result)
+            self._stats['compress_time'] += elapsed
+
+        return result
+
+    def decompress(self, data):
+        start = time.perf_counter()
+        result = self._decompress(data)
+        elapsed = time.perf_counter() - start
+
+        with self._lock:
+            self._stats['decompress_calls'] += 1
+            self._stats['decompress_time'] += elapsed
+
+        return result
+
+    @property
+    def stats(self):
+        """
+        :return: dict with the number of calls, the uncompressed and compressed bytes, the ratio (compressed / uncompressed) and the time spent
+        """
+        with self._lock:
+            stats = dict(self._stats)
+
+        stats['ratio'] = stats['bytes_out'] / stats['bytes_in'] if stats['bytes_in'] > 0 else None
+
+        return stats
+
+    def reset_stats(self):
+        with self._lock:
+            for k in self._stats:
+                self._stats[k] = 0
+
+
+CODECS = dict()
+
+
+def register_codec(codec: Codec):
+    """
+    Register compression codec. The codec name is stored in the compressed documents
+    :param codec: codec
+    """
+    CODECS[codec.name] = codec
+
+
+register_codec(Codec('zlib', zlib.compress, zlib.decompress))
+register_codec(Codec('lzma', lambda data, preset=None: lzma.compress(data, preset=preset), lzma.decompress))
+
+if lz4_frame is not None:
+    register_codec(Codec('lz4', lz4_frame.compress, lz4_frame.decompress))
+
+if zstandard is not None:
+    register_codec(Codec('zstd', zstandard.compress, zstandard.decompress))
+
+
+def codec_stats():
+    """
+    :return: statistics of all registered codecs
+    """
+    return {name: codec.stats for name, codec in CODECS.items()}
+
+
+def compress(data, codec: str = 'zlib', level: int = None):
+    """
+    Compress binary data
+    :param data: data to compress
+    :param codec: codec name
+    :param level: compression level (codec default if None)
+    :return: compressed value, which records the codec, or the original data if the compression didn't reduce the size
+    """
+    compressed = CODECS[codec].compress(data, level)
+    if len(compressed) >= len(data):
+        return data
+
+    return {'__compressed__': codec, 'data': Binary(compressed)}
+
+
+def decompress(obj):
+    """
+    Decompress a value, produced by compress
+    :param obj: compressed value
+    :return: decompressed data. Values, which contain serialized document fields, are decoded to the original field
+    """
+    data = CODECS[obj['__compressed__']].decompress(obj['data'])
+
+    if obj.get('format') == 'bson':
+        return bson.decode(data)['v']
+
+    return data
+
+
+class CompressingEncoder(object):
+    """
+    Encoder, which compresses the binary values (numpy array buffers and pickled objects) larger than threshold.
+    If compress_fields is True, the top level dict and list fields of documents, which are larger than threshold, are compressed too
+    (as BSON). The codec is recorded in the document, so default_decoder decompresses the values automatically
+    """
+
+    def __init__(self, codec: str = 'zlib', threshold: int = 1024, level: int = None, compress_fields: bool = False, encoder: Callable = None):
+        """
+        :param codec: codec name (see CODECS)
+        :param threshold: values larger than this number of bytes are compressed
+        :param level: compression level
+        :param compress_fields: compress large top level dict and list fields
+        :param encoder: encoder, which is applied before the compression
+        """
+        if codec not in CODECS:
+            raise ValueError("Unknown codec " + str(codec) + ". Available codecs: " + str(list(CODECS)))
+
+        self.codec = codec
+        self.threshold = threshold
+        self.level = level
+        self.compress_fields = compress_fields
+
+        self._encoder = encoder if encoder is not None else default_encoder
+
+    def __call__(self, obj):
+        obj = self._encoder(obj)
+
+        if self._is_large(obj):
+            return compress(obj, self.codec, self.level)
+
+        if self.compress_fields and isinstance(obj, dict) and '__ndarray__' not in obj:
             for k, v in obj.items():
-                obj[k] = default_decoder(v)
-    elif isinstance(obj, bytes):
-        return pickle.loads(obj)
+                if k != '_id' and isinstance(v, (dict, list)) and not (isinstance(v, dict) and '__ndarray__' in v):
+                    obj[k] = self._compress_field(v)
+
+        for container, key, value in walk_encoded(obj):
+            if self._is_large(value):
+                container[key] = compress(value, self.codec, self.level)
+
+        return obj
+
+    def _is_large(self, value):
+        return isinstance(value, (bytes, bytearray)) and len(value) > self.threshold
+
+    def _compress_field(self, value):
+        try:
+            data = bson.encode({'v': value})
+        except (BSONError, TypeError, ValueError):
+            return value
+
+        if len(data) <= self.threshold:
+            return value
+
+        result = compress(data, self.codec, self.level)
+        if result is data:
+            return value
+
+        result['format'] = 'bson'
+
+        return result
+
+
+class LRUCache(object):
+    """Thread safe LRU cache, bounded by number of entries and (estimated) size in bytes, with hit/miss/eviction statistics"""
+
+    def __init__(self, max_entries: int = None, max_bytes: int = None):
+        """
+        :param max_entries: maximum number of entries (unbounded if None)
+        :param max_bytes: maximum total size of the entries (unbounded if None)
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self._stats['hits'] += 1
+                return self._entries[key][0]
+
+            self._stats['misses'] += 1
+
+            return default
+
+    def put(self, key, value, size: int = 0):
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+
+            self._entries[key] = (value, size)
+            self._bytes += size
+
+            while (self.max_entries is not None and len(self._entries) > self.max_entries) or (self.max_bytes is not None and self._bytes > self.max_bytes):
+                self._bytes -= self._entries.popitem(last=False)[1][1]
+                self._stats['evictions'] += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+                self._stats['invalidations'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
 
-    return obj
+    @property
+    def stats(self):
+        """
+        :return: hits, misses, evictions, invalidations, number of entries and size in bytes
+        """
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries), bytes=self._bytes)
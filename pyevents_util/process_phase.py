@@ -0,0 +1,156 @@
+import collections
+import logging
+import os
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from pyevents_util.algo_phase import AlgoPhase
+
+# numpy array, transported through a shared memory block
+SharedArray = collections.namedtuple('SharedArray', ['name', 'dtype', 'shape'])
+
+_worker_model = None
+
+
+def to_shared(obj, threshold: int, blocks: list):
+    """
+    Replace the numpy arrays (in nested dicts, lists and tuples) larger than threshold bytes with SharedArray references.
+    The data is copied once into a new shared memory block
+    :param obj: object
+    :param threshold: minimum array size in bytes
+    :param blocks: list, to which the created SharedMemory blocks are appended
+    :return: object with SharedArray references
+    """
+    if isinstance(obj, np.ndarray) and obj.nbytes >= threshold and obj.dtype != object:
+        shm = shared_memory.SharedMemory(create=True, size=obj.nbytes)
+        blocks.append(shm)
+        np.ndarray(obj.shape, dtype=obj.dtype, buffer=shm.buf)[...] = obj
+        return SharedArray(shm.name, obj.dtype.str, obj.shape)
+
+    if isinstance(obj, dict):
+        return {k: to_shared(v, threshold, blocks) for k, v in obj.items()}
+
+    if isinstance(obj, (list, tuple)) and not isinstance(obj, SharedArray):
+        return type(obj)(to_shared(v, threshold, blocks) for v in obj)
+
+    return obj
+
+
+def from_shared(obj, blocks: list, copy: bool):
+    """
+    Replace the SharedArray references with numpy arrays
+    :param obj: object with SharedArray references
+    :param blocks: list, to which the attached SharedMemory blocks are appended
+    :param copy: if True, the arrays are copied out of the shared memory. Otherwise they are views of the shared memory
+    :return: object with numpy arrays
+    """
+    if isinstance(obj, SharedArray):
+        shm = shared_memory.SharedMemory(name=obj.name)
+        blocks.append(shm)
+
+        array = np.ndarray(obj.shape, dtype=obj.dtype, buffer=shm.buf)
+        return array.copy() if copy else array
+
+    if isinstance(obj, dict):
+        return {k: from_shared(v, blocks, copy) for k, v in obj.items()}
+
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(from_shared(v, blocks, copy) for v in obj)
+
+    return obj
+
+
+def _release(blocks: list, unlink: bool):
+    for shm in blocks:
+        try:
+            shm.close()
+        except BufferError:
+            # the model kept a reference to the data. The mapping is released with the last reference
+            pass
+
+        if unlink:
+            try:
+                shm.unlink()
+            except FileNotFoundError:
+                pass
+
+
+def _init_worker(model):
+    global _worker_model
+    _worker_model = model
+
+
+def _worker_call(model_input, threshold: int):
+    input_blocks = list()
+    model_input = from_shared(model_input, input_blocks, copy=False)
+
+    output_blocks = list()
+    try:
+        output = to_shared(_worker_model(model_input), threshold, output_blocks)
+    finally:
+        _release(input_blocks, unlink=False)
+
+    # the parent process unlinks the output blocks after reading them
+    _release(output_blocks, unlink=False)
+
+    return output
+
+
+class ProcessAlgoPhase(AlgoPhase):
+    """
+    AlgoPhase, which runs the model in worker processes (for CPU bound models, which don't release the GIL).
+    The model must be picklable and is sent to each worker once. Numpy arrays in the inputs and outputs, which are larger
+    than shm_threshold bytes, are transported through shared memory instead of being pickled through the pipes.
+    The events and the iteration numbers are the same as in AlgoPhase
+    """
+
+    def __init__(self, model, listeners, phase=None, workers: int = None, max_in_flight: int = None, shm_threshold: int = 64 * 1024, **kwargs):
+        """
+        :param model: picklable function, which is called with the input data of each iteration
+        :param listeners: event listeners
+        :param phase: phase of the data events, processed by this instance
+        :param workers: number of worker processes (number of CPUs by default)
+        :param max_in_flight: maximum number of submitted, but not completed model calls (2 * workers by default)
+        :param shm_threshold: minimum size in bytes of the arrays, transported through shared memory
+        :param kwargs: other AlgoPhase arguments (batching)
+        """
+        self.shm_threshold = shm_threshold
+
+        super().__init__(model=model, listeners=listeners, phase=phase, workers=workers if workers is not None else os.cpu_count(), max_in_flight=max_in_flight, **kwargs)
+
+    def _create_executor(self, workers):
+        # the workers share the resource tracker of this process, which keeps track of the shared memory blocks
+        resource_tracker.ensure_running()
+
+        return ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(self._model,))
+
+    def _call_async(self, model_input):
+        input_blocks = list()
+        try:
+            future = self._executor.submit(_worker_call, to_shared(model_input, self.shm_threshold, input_blocks), self.shm_threshold)
+        except Exception:
+            _release(input_blocks, unlink=True)
+            raise
+
+        result = Future()
+
+        def done(f):
+            _release(input_blocks, unlink=True)
+
+            try:
+                output_blocks = list()
+                try:
+                    output = from_shared(f.result(), output_blocks, copy=True)
+                finally:
+                    _release(output_blocks, unlink=True)
+            except Exception as e:
+                logging.getLogger(__name__).debug("Model call failed: " + str(e))
+                result.set_exception(e)
+            else:
+                result.set_result(output)
+
+        future.add_done_callback(done)
+
+        return result
@@ -0,0 +1,110 @@
+import itertools
+import threading
+import typing
+
+# matches any type or phase in the routes
+ANY = object()
+
+
+class EventRouter(object):
+    """
+    Event listeners, which dispatch each event only to the handlers, subscribed to its type and phase (instead of
+    broadcasting it to all handlers). It can be used instead of the listeners of the components:
+    AlgoPhase, AlgoPhaseEventsOrder, MongoDBSequenceLog, etc. subscribe only to the events they handle.
+    The handlers of each (type, phase) are resolved once and cached, so the cost of dispatching an event doesn't grow
+    with the number of phases and components.
+    If listeners is set, the events are sent through them (e.g. AsyncListeners for asynchronous dispatching), otherwise
+    the handlers are called in the thread, which sends the event
+    """
+
+    def __init__(self, listeners=None):
+        """
+        :param listeners: underlying event listeners
+        """
+        self._lock = threading.Lock()
+        self._counter = itertools.count()
+
+        # list of (order, handler, type, phase)
+        self._subscriptions = list()
+
+        # (type, phase) -> tuple of handlers
+        self._handlers = dict()
+
+        self.listeners = listeners
+        if listeners is not None:
+            listeners += self.dispatch
+
+    def subscribe(self, handler: typing.Callable, type=ANY, phase=ANY):
+        """
+        Subscribe handler to the events of the given type and phase
+        :param handler: function, which is called with the event
+        :param type: event type (all types if ANY)
+        :param phase: event phase (all phases if ANY). None matches the events without phase
+        """
+        with self._lock:
+            self._subscriptions.append((next(self._counter), handler, type, phase))
+            self._handlers = dict()
+
+    def unsubscribe(self, handler: typing.Callable):
+        """Remove all subscriptions of handler"""
+        with self._lock:
+            self._subscriptions = [s for s in self._subscriptions if s[1] != handler]
+            self._handlers = dict()
+
+    def __iadd__(self, other):
+        self.subscribe(other)
+        return self
+
+    def __isub__(self, other):
+        self.unsubscribe(other)
+        return self
+
+    def __call__(self, event):
+        if self.listeners is not None:
+            self.listeners(event)
+        else:
+            self.dispatch(event)
+
+    def dispatch(self, event):
+        """Call the handlers, subscribed to the type and phase of the event"""
+        key = (_field(event, 'type'), _field(event, 'phase'))
+
+        cache = self._handlers
+
+        try:
+            handlers = cache.get(key)
+        except TypeError:
+            # unhashable phase
+            handlers = self._resolve(*key)
+        else:
+            if handlers is None:
+                handlers = cache[key] = self._resolve(*key)
+
+        for h in handlers:
+            h(event)
+
+    def _resolve(self, type, phase):
+        subscriptions = self._subscriptions
+
+        return tuple(h for _, h, t, p in subscriptions if (t is ANY or t == type) and (p is ANY or p == phase))
+
+
+def _field(event, key):
+    try:
+        return event[key]
+    except (KeyError, TypeError, IndexError):
+        return None
+
+
+def subscribe(listeners, handler: typing.Callable, routes: typing.Iterable[typing.Tuple] = None):
+    """
+    Subscribe handler to the listeners. If listeners is an EventRouter, the handler receives only the events of routes
+    :param listeners: event listeners
+    :param handler: function, which is called with the event
+    :param routes: (type, phase) tuples (ANY matches everything). All events if None
+    """
+    if isinstance(listeners, EventRouter) and routes is not None:
+        for type, phase in routes:
+            listeners.subscribe(handler, type, phase)
+    else:
+        listeners += handler
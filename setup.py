@@ -64,7 +64,7 @@ setup(
 
     # You can just specify the packages manually here if your project is
     # simple. Or you can use find_packages().
-    packages=find_packages(exclude=['contrib', 'docs', 'tests']),
+    packages=find_packages(exclude=['contrib', 'docs', 'tests', 'benchmarks']),
 
     # Alternatively, if you want to distribute just a my_module.py, uncomment
     # this:
@@ -78,7 +78,10 @@ setup(
 
     extras_require={
         'tensorflow': ['tensorflow'],
-        'mongodb': ['pymongo', 'numpy']
+        'mongodb': ['pymongo', 'numpy'],
+        'compression': ['lz4', 'zstandard'],
+        'columnar': ['numpy', 'pyarrow'],
+        'benchmarks': ['pymongo<4.11', 'numpy', 'mongomock']
     },
 
     dependency_links=[
@@ -0,0 +1,600 @@
+import asyncio
+import io
+import random
+import time
+import unittest
+
+import numpy as np
+
+from pyevents.events import *
+from pyevents_util.algo_phase import *
+from pyevents_util.async_phase import *
+from pyevents_util.events import *
+from pyevents_util.metrics import *
+from pyevents_util.process_phase import *
+from pyevents_util.routing import *
+
+
+def square(x):
+    return x ** 2
+
+
+class TestAlgoPhase(unittest.TestCase):
+    """
+    AlgoPhase and AlgoPhaseEventsOrder
+    """
+
+    def test_batching(self):
+        listeners = AsyncListeners()
+
+        calls = list()
+
+        def model(x):
+            calls.append(x.shape)
+            return x * 2
+
+        phase = AlgoPhase(model=model, phase='TESTING', listeners=listeners, batch_size=2, batch_timeout=0.1)
+
+        results = dict()
+        e1 = threading.Event()
+
+        def after_iteration(event):
+            if event['type'] == 'after_iteration':
+                results[event['iteration']] = event['model_output']
+                if len(results) == 5:
+                    e1.set()
+
+        listeners += after_iteration
+
+        for i in range(5):
+            listeners({'type': 'data', 'phase': 'TESTING', 'data': np.full(3, i)})
+
+        e1.wait()
+
+        self.assertEqual(phase._iteration, 5)
+        self.assertEqual(calls, [(2, 3), (2, 3), (1, 3)])
+        for i in range(5):
+            self.assertTrue(np.array_equal(results[i + 1], np.full(3, i * 2)))
+
+    def test_batch_timeout(self):
+        listeners = SyncListeners()
+
+        calls, model_threads = list(), set()
+
+        def model(x):
+            calls.append(len(x))
+            model_threads.add(threading.current_thread())
+            return x
+
+        phase = AlgoPhase(model=model, phase='TESTING', listeners=listeners, batch_size=10, batch_timeout=0.05)
+
+        results = list()
+        received = threading.Event()
+
+        def after_iteration(event):
+            if event['type'] == 'after_iteration':
+                results.append(event['model_output'])
+                received.set()
+
+        listeners += after_iteration
+
+        threads = threading.active_count()
+
+        # the partial batches are flushed by a single thread
+        for i in range(3):
+            received.clear()
+            listeners({'type': 'data', 'phase': 'TESTING', 'data': i})
+            listeners({'type': 'data', 'phase': 'TESTING', 'data': i})
+            self.assertTrue(received.wait(5))
+            self.assertLessEqual(threading.active_count(), threads + 1)
+
+        phase.close()
+
+        self.assertEqual(calls, [2, 2, 2])
+        self.assertEqual(len(model_threads), 1)
+        self.assertNotIn(threading.current_thread(), model_threads)
+        self.assertEqual(results, [0, 0, 1, 1, 2, 2])
+        self.assertEqual(threading.active_count(), threads)
+
+    def test_workers(self):
+        listeners = AsyncListeners()
+
+        def model(x):
+            time.sleep(random.random() * 0.01)
+            return x * 2
+
+        phase = AlgoPhase(model=model, phase='TESTING', listeners=listeners, workers=4, max_in_flight=6)
+
+        iterations = list()
+        e1 = threading.Event()
+
+        def after_iteration(event):
+            if event['type'] == 'after_iteration':
+                iterations.append(event['iteration'])
+                self.assertEqual(event['model_output'], event['model_input'] * 2)
+                if len(iterations) == 50:
+                    e1.set()
+
+        listeners += after_iteration
+
+        for i in range(50):
+            listeners({'type': 'data', 'phase': 'TESTING', 'data': i})
+
+        e1.wait()
+        phase.close()
+
+        self.assertEqual(iterations, list(range(1, 51)))
+
+    def test_workers_concurrent_callers(self):
+        listeners = SyncListeners()
+
+        phase = AlgoPhase(model=lambda x: x * 2, phase='TESTING', listeners=listeners, workers=1, max_in_flight=1)
+
+        iterations = list()
+        started, done = threading.Event(), threading.Event()
+
+        def on_event(event):
+            if event['type'] == 'before_iteration' and event['iteration'] == 1:
+                # the second caller runs, while the first one is still in its before_iteration listeners
+                started.set()
+                time.sleep(0.1)
+            elif event['type'] == 'after_iteration':
+                iterations.append(event['iteration'])
+                if len(iterations) == 2:
+                    done.set()
+
+        listeners += on_event
+
+        first = threading.Thread(target=phase.process, args=(1,), daemon=True)
+        first.start()
+        started.wait(5)
+
+        second = threading.Thread(target=phase.process, args=(2,), daemon=True)
+        second.start()
+
+        self.assertTrue(done.wait(5))
+        phase.close()
+
+        self.assertEqual(iterations, [1, 2])
+
+    def test_process_phase(self):
+        listeners = AsyncListeners()
+
+        phase = ProcessAlgoPhase(model=square, phase='TESTING', listeners=listeners, workers=2, shm_threshold=1024)
+
+        results = dict()
+        e1 = threading.Event()
+
+        def after_iteration(event):
+            if event['type'] == 'after_iteration':
+                results[event['iteration']] = event['model_output']
+                if len(results) == 10:
+                    e1.set()
+
+        listeners += after_iteration
+
+        for i in range(10):
+            listeners({'type': 'data', 'phase': 'TESTING', 'data': np.full((100, 100), i, dtype=np.float64) if i % 2 == 0 else i})
+
+        e1.wait()
+        phase.close()
+
+        self.assertEqual(sorted(results), list(range(1, 11)))
+        for i in range(10):
+            if i % 2 == 0:
+                self.assertTrue(np.array_equal(results[i + 1], np.full((100, 100), i ** 2)))
+            else:
+                self.assertEqual(results[i + 1], i ** 2)
+
+    def test_batching_dict_input(self):
+        batch = stack_inputs([{'input': [0, 1], 'target': np.zeros(2)}, {'input': [1, 1], 'target': np.ones(2)}])
+        self.assertEqual(batch['input'], [[0, 1], [1, 1]])
+        self.assertEqual(batch['target'].shape, (2, 2))
+
+        self.assertEqual(split_outputs({'loss': np.array([0.5, 0.1]), 'step': 3}, 2), [{'loss': 0.5, 'step': 3}, {'loss': 0.1, 'step': 3}])
+        self.assertEqual(split_outputs(None, 2), [None, None])
+
+    def test_events_order_bounded(self):
+        listeners = SyncListeners()
+
+        order = AlgoPhaseEventsOrder(phases=[('TRAINING', 3), ('TESTING', 1)], listeners=listeners, capacity={'TESTING': 2}, overflow='reject')
+
+        rejected = list()
+
+        def on_rejected(event):
+            if event['type'] == 'data_rejected':
+                rejected.append(event['event']['data'])
+
+        listeners += on_rejected
+
+        # the testing events are not consumed until the end of the training phase
+        for i in range(4):
+            listeners({'type': 'data', 'phase': 'TESTING_unordered', 'data': i})
+
+        self.assertEqual(rejected, [2, 3])
+
+        stats = order.queue_stats()
+        self.assertEqual(stats['TESTING'], {'depth': 2, 'capacity': 2, 'pending': 0, 'high_water': 2, 'dropped': 0, 'rejected': 2})
+        self.assertIsNone(stats['TRAINING']['capacity'])
+
+    def test_events_order_drop_oldest(self):
+        listeners = SyncListeners()
+
+        order = AlgoPhaseEventsOrder(phases=[('TRAINING', 3), ('TESTING', 1)], listeners=listeners, capacity=2, overflow='drop_oldest')
+
+        dropped = list()
+
+        def on_dropped(event):
+            if event['type'] == 'data_dropped':
+                dropped.append(event['event']['data'])
+
+        listeners += on_dropped
+
+        for i in range(5):
+            order.put({'type': 'data', 'phase': 'TESTING_unordered', 'data': i})
+
+        self.assertEqual(dropped, [0, 1, 2])
+        self.assertEqual([e['data'] for e in list(order.event_queues['TESTING'].queue)], [3, 4])
+        self.assertEqual(order.queue_stats()['TESTING']['dropped'], 3)
+
+        with self.assertRaises(ValueError):
+            AlgoPhaseEventsOrder(phases=[('TRAINING', 1)], listeners=listeners, overflow='unknown')
+
+    def test_events_order_block_async_listeners(self):
+        listeners = AsyncListeners()
+
+        order = AlgoPhaseEventsOrder(phases=[('TRAINING', 1), ('TESTING', 3), (None, 0)], listeners=listeners, capacity=1, max_pending=2)
+
+        AlgoPhase(model=lambda x: x, phase='TRAINING', listeners=listeners)
+        AlgoPhase(model=lambda x: x, phase='TESTING', listeners=listeners)
+
+        outputs, rejected = list(), list()
+        done = threading.Event()
+
+        def after_iteration(event):
+            if event['type'] == 'after_iteration' and event['phase'] == 'TESTING':
+                outputs.append(event['model_output'])
+                if len(outputs) == 3:
+                    done.set()
+
+        listeners += after_iteration
+        listeners += lambda event: rejected.append(event['event']['data']) if event['type'] == 'data_rejected' else None
+
+        # the full testing queue doesn't block the dispatch thread, which has to deliver the training events
+        for i in range(4):
+            listeners({'type': 'data', 'phase': 'TESTING_unordered', 'data': i})
+        listeners({'type': 'data', 'phase': 'TRAINING_unordered', 'data': 0})
+
+        self.assertTrue(order.join(5))
+        self.assertTrue(done.wait(5))
+
+        self.assertEqual(rejected, [3])
+        self.assertEqual(outputs, [0, 1, 2])
+        self.assertEqual(order.queue_stats()['TESTING']['rejected'], 1)
+
+
+    def test_events_order(self):
+        orders = list()
+
+        def run(listeners):
+            AlgoPhase(model=lambda x: x, phase='TRAINING', listeners=listeners)
+            AlgoPhase(model=lambda x: x, phase='TESTING', listeners=listeners)
+
+            phases = list()
+
+            def after_iteration(event):
+                if event['type'] == 'after_iteration':
+                    phases.append(event['phase'])
+
+            listeners += after_iteration
+
+            # the testing events are sent first, but processed after the training iterations
+            for i in range(2):
+                listeners({'type': 'data', 'phase': 'TESTING_unordered', 'data': i})
+            for i in range(6):
+                listeners({'type': 'data', 'phase': 'TRAINING_unordered', 'data': i})
+
+            return phases
+
+        threads = threading.active_count()
+
+        for _ in range(5):
+            listeners = SyncListeners()
+            order = AlgoPhaseEventsOrder(phases=[('TRAINING', 3), ('TESTING', 1), (None, 0)], listeners=listeners)
+            orders.append((order, run(listeners)))
+
+        for order, phases in orders:
+            self.assertTrue(order.join(5))
+            self.assertEqual(phases, ['TRAINING'] * 3 + ['TESTING'])
+
+        # the instances share a small pool of threads
+        self.assertLessEqual(threading.active_count(), threads + SCHEDULER_THREADS)
+
+        listeners = SyncListeners()
+        order = AlgoPhaseEventsOrder(phases=[('TRAINING', 3), ('TESTING', 1)], listeners=listeners)
+        order.start()
+        self.assertFalse(order.join(0.1))
+        order.stop()
+        self.assertTrue(order.join(5))
+
+    def test_events_order_schedulers(self):
+        slow_listeners, fast_listeners = SyncListeners(), SyncListeners()
+        slow = AlgoPhaseEventsOrder(phases=[('TESTING', 1)], listeners=slow_listeners)
+        fast = AlgoPhaseEventsOrder(phases=[('TESTING', 1)], listeners=fast_listeners)
+
+        release, received = threading.Event(), threading.Event()
+        slow_listeners += lambda event: release.wait(5) if event['type'] == 'data' and event['phase'] == 'TESTING' else None
+        fast_listeners += lambda event: received.set() if event['type'] == 'data' and event['phase'] == 'TESTING' else None
+
+        # a slow listener of one instance doesn't delay the events of the other instances
+        slow_listeners({'type': 'data', 'phase': 'TESTING_unordered', 'data': 0})
+        fast_listeners({'type': 'data', 'phase': 'TESTING_unordered', 'data': 0})
+        self.assertTrue(received.wait(1))
+
+        release.set()
+
+        for order in (slow, fast):
+            order.stop()
+            self.assertTrue(order.join(5))
+
+    def test_events_order_serial_turns(self):
+        listeners = SyncListeners()
+        order = AlgoPhaseEventsOrder(phases=[('TESTING', 50), (None, 0)], listeners=listeners)
+        AlgoPhase(model=lambda x: x, phase='TESTING', listeners=listeners)
+
+        received, running = list(), list()
+
+        def slow(event):
+            if event['type'] == 'data' and event['phase'] == 'TESTING':
+                running.append(threading.current_thread())
+                time.sleep(0.001)
+                received.append((event['data'], len(running)))
+                running.pop()
+
+        listeners += slow
+
+        # the turns of an instance aren't run concurrently on the threads of the pool
+        for i in range(50):
+            listeners({'type': 'data', 'phase': 'TESTING_unordered', 'data': i})
+
+        self.assertTrue(order.join(5))
+        self.assertEqual(received, [(i, 1) for i in range(50)])
+
+
+
+    def test_routing(self):
+        router = EventRouter(SyncListeners())
+
+        calls = {'TRAINING': 0, 'TESTING': 0, 'onevent': 0}
+
+        def model(phase):
+            def call(x):
+                calls[phase] += 1
+                return x
+
+            return call
+
+        training = AlgoPhase(model=model('TRAINING'), phase='TRAINING', listeners=router)
+        testing = AlgoPhase(model=model('TESTING'), phase='TESTING', listeners=router)
+
+        onevent = training.onevent
+
+        def counting_onevent(event):
+            calls['onevent'] += 1
+            onevent(event)
+
+        # only the training data events are routed to the training phase
+        router.unsubscribe(training.onevent)
+        router.subscribe(counting_onevent, 'data', 'TRAINING')
+
+        order = AlgoPhaseEventsOrder(phases=[('TRAINING', 2), ('TESTING', 1), (None, 0)], listeners=router)
+
+        events = list()
+        router += events.append
+
+        router({'type': 'data', 'phase': 'TESTING_unordered', 'data': 1})
+        for i in range(2):
+            router({'type': 'data', 'phase': 'TRAINING_unordered', 'data': i})
+        router({'type': 'other'})
+
+        self.assertTrue(order.join(5))
+
+        self.assertEqual(calls, {'TRAINING': 2, 'TESTING': 1, 'onevent': 2})
+        self.assertEqual([(e['type'], e.get('phase')) for e in events if e['type'] != 'before_iteration'][:4],
+                         [('data', 'TESTING_unordered'), ('data', 'TRAINING_unordered'), ('data', 'TRAINING_unordered'), ('other', None)])
+
+        count = len(events)
+        router -= events.append
+        router({'type': 'other'})
+        self.assertEqual(len(events), count)
+
+
+    def test_compact_events(self):
+        event = DataEvent(np.zeros(2), 'TESTING_unordered')
+        self.assertEqual(event['type'], 'data')
+        self.assertIn('phase', event)
+        self.assertEqual(event.get('missing'), None)
+
+        copy = event.copy()
+        copy['phase'] = 'TESTING'
+        copy['source'] = 'test'
+        self.assertEqual(event['phase'], 'TESTING_unordered')
+        self.assertEqual(list(copy), ['type', 'data', 'phase', 'source'])
+        self.assertNotIn('phase', StoreObjectEvent(1))
+
+        with self.assertRaises(KeyError):
+            copy['type'] = 'other'
+
+        listeners = SyncListeners()
+        AlgoPhase(model=lambda x: x + 1, phase='TESTING', listeners=listeners, compact_events=True)
+        order = AlgoPhaseEventsOrder(phases=[('TESTING', 2), (None, 0)], listeners=listeners)
+
+        events = list()
+        listeners += lambda e: events.append(e) if e['type'] in ('before_iteration', 'after_iteration') else None
+
+        listeners(event)
+        listeners(DataEvent(np.ones(2), 'TESTING_unordered'))
+        self.assertTrue(order.join(5))
+
+        self.assertEqual([type(e) for e in events], [BeforeIterationEvent, AfterIterationEvent] * 2)
+        self.assertTrue(np.array_equal(events[3]['model_output'], np.full(2, 2)))
+        self.assertEqual(dict(events[1])['iteration'], 1)
+
+
+    def test_metrics(self):
+        registry = MetricsRegistry()
+
+        listeners = SyncListeners()
+        AlgoPhase(model=lambda x: x * 2, phase='TRAINING', listeners=listeners, batch_size=2, metrics=registry)
+        AlgoPhase(model=lambda x: x, phase='TESTING', listeners=listeners, metrics=registry)
+        order = AlgoPhaseEventsOrder(phases=[('TRAINING', 4), ('TESTING', 1)], listeners=listeners, metrics=registry)
+
+        for i in range(4):
+            listeners({'type': 'data', 'phase': 'TRAINING', 'data': np.full(2, i)})
+        listeners({'type': 'data', 'phase': 'TESTING', 'data': 1})
+        order.put({'type': 'data', 'phase': 'TESTING_unordered', 'data': 1})
+
+        snapshot = registry.snapshot()
+
+        iterations = {s['labels']['phase']: s['value'] for s in snapshot['pyevents_iterations_total']['samples']}
+        self.assertEqual(iterations, {'TRAINING': 4, 'TESTING': 1})
+        self.assertTrue(all(s['rate'] > 0 for s in snapshot['pyevents_iterations_total']['samples']))
+
+        batches = [s for s in snapshot['pyevents_batch_size']['samples'] if s['labels']['phase'] == 'TRAINING'][0]
+        self.assertEqual((batches['count'], batches['sum']), (2, 4))
+
+        latency = [s for s in snapshot['pyevents_model_latency_seconds']['samples'] if s['labels']['phase'] == 'TESTING'][0]
+        self.assertEqual(latency['count'], 1)
+        self.assertEqual(latency['buckets'][-1], [float('inf'), 1])
+
+        depths = {s['labels']['phase']: s['value'] for s in snapshot['pyevents_queue_depth']['samples']}
+        self.assertEqual(depths, {'TRAINING': 0, 'TESTING': 1})
+
+        text = prometheus_text(snapshot)
+        self.assertIn('# TYPE pyevents_model_latency_seconds histogram', text)
+        self.assertIn('pyevents_iterations_total{phase="TRAINING"} 4', text)
+        self.assertIn('pyevents_model_latency_seconds_bucket{phase="TESTING",le="+Inf"} 1', text)
+
+        stream = io.StringIO()
+        exporter = MetricsExporter(registry, interval=60, stream=stream)
+        exporter.close()
+        self.assertIn('pyevents_queue_depth{phase="TESTING"} 1', stream.getvalue())
+
+        # a new instance replaces the gauges of the previous one
+        AlgoPhaseEventsOrder(phases=[('TRAINING', 4), ('TESTING', 1)], listeners=SyncListeners(), metrics=registry)
+        depths = {s['labels']['phase']: s['value'] for s in registry.snapshot()['pyevents_queue_depth']['samples']}
+        self.assertEqual(depths, {'TRAINING': 0, 'TESTING': 0})
+
+
+class TestAsyncAlgoPhase(unittest.TestCase):
+    """
+    AsyncAlgoPhase and AsyncAlgoPhaseEventsOrder
+    """
+
+    def test_events_order(self):
+        async def main():
+            listeners = SyncListeners()
+
+            order = AsyncAlgoPhaseEventsOrder(phases=[('TRAINING', 3), ('TESTING', 1), (None, 0)], listeners=listeners, capacity=4)
+
+            async def train(x):
+                await asyncio.sleep(random.random() * 0.01)
+                return x * 2
+
+            training = AsyncAlgoPhase(model=train, phase='TRAINING', listeners=listeners, max_in_flight=2)
+            testing = AsyncAlgoPhase(model=lambda x: x + 1, phase='TESTING', listeners=listeners, run_in_executor=True)
+
+            results = list()
+
+            def after_iteration(event):
+                if event['type'] == 'after_iteration':
+                    results.append((event['phase'], event['iteration'], event['model_output']))
+
+            listeners += after_iteration
+
+            listeners({'type': 'data', 'phase': 'TESTING_unordered', 'data': 10})
+            for i in range(3):
+                await order.put({'type': 'data', 'phase': 'TRAINING_unordered', 'data': i})
+
+            await order.join()
+            await training.close()
+            await testing.close()
+
+            return results, order.queue_stats()
+
+        results, stats = asyncio.run(main())
+
+        self.assertEqual(results, [('TRAINING', 1, 0), ('TRAINING', 2, 2), ('TRAINING', 3, 4), ('TESTING', 1, 11)])
+        self.assertEqual(stats['TRAINING']['capacity'], 4)
+        self.assertEqual(stats['TESTING']['depth'], 0)
+
+    def test_errors_and_reject(self):
+        async def main():
+            listeners = SyncListeners()
+
+            order = AsyncAlgoPhaseEventsOrder(phases=[('TRAINING', 1), ('TESTING', 1)], listeners=listeners, capacity=1, overflow='reject')
+
+            def model(x):
+                raise ValueError(x)
+
+            phase = AsyncAlgoPhase(model=model, phase='TRAINING', listeners=listeners)
+
+            events = list()
+            listeners += lambda event: events.append(event) if event['type'] in ('after_iteration', 'data_rejected') else None
+
+            listeners({'type': 'data', 'phase': 'TESTING_unordered', 'data': 1})
+            listeners({'type': 'data', 'phase': 'TESTING_unordered', 'data': 2})
+            listeners({'type': 'data', 'phase': 'TRAINING_unordered', 'data': 3})
+
+            await asyncio.sleep(0.05)
+            await phase.close()
+
+            order.stop()
+            await order.join()
+
+            return events
+
+        events = asyncio.run(main())
+
+        self.assertEqual(events[0]['type'], 'data_rejected')
+        self.assertEqual(events[0]['event']['data'], 2)
+        self.assertIsInstance(events[1]['error'], ValueError)
+        self.assertEqual(events[1]['phase'], 'TRAINING')
+
+    def test_block_from_listeners(self):
+        async def main():
+            listeners = SyncListeners()
+
+            order = AsyncAlgoPhaseEventsOrder(phases=[('TRAINING', 1), ('TESTING', 5), (None, 0)], listeners=listeners, capacity=2, max_pending=3)
+
+            training = AsyncAlgoPhase(model=lambda x: x, phase='TRAINING', listeners=listeners)
+            testing_phase = AsyncAlgoPhase(model=lambda x: x, phase='TESTING', listeners=listeners)
+
+            testing, rejected = list(), list()
+            listeners += lambda event: testing.append(event['model_output']) if event['type'] == 'after_iteration' and event['phase'] == 'TESTING' else None
+            listeners += lambda event: rejected.append(event['event']['data']) if event['type'] == 'data_rejected' else None
+
+            # the listeners can't wait for the full queue: 3 events are pending and the last one is rejected
+            for i in range(6):
+                listeners({'type': 'data', 'phase': 'TESTING_unordered', 'data': i})
+
+            stats = order.queue_stats()['TESTING']
+
+            listeners({'type': 'data', 'phase': 'TRAINING_unordered', 'data': 0})
+
+            await order.join()
+            await training.close()
+            await testing_phase.close()
+
+            return testing, rejected, stats, order.queue_stats()['TESTING']
+
+        testing, rejected, stats, final_stats = asyncio.run(main())
+
+        self.assertEqual(testing, [0, 1, 2, 3, 4])
+        self.assertEqual(rejected, [5])
+        self.assertEqual((stats['depth'], stats['pending'], stats['rejected']), (2, 3, 1))
+        self.assertEqual((final_stats['depth'], final_stats['pending']), (0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,19 @@
+import asyncio
+import base64
+import dataclasses
+import tempfile
 import unittest
 
 from pyevents.events import *
+from pyevents_util.algo_phase import *
+from pyevents_util.async_phase import *
+from pyevents_util.mongodb.checkpoint import *
+from pyevents_util.mongodb.chunked_storage import *
+from pyevents_util.mongodb.columnar import *
+from pyevents_util.mongodb.compaction import *
 from pyevents_util.mongodb.mongodb_sequence_log import *
 from pyevents_util.mongodb.mongodb_store import *
+from pyevents_util.metrics import *
 
 
 class TestMongoDB(unittest.TestCase):
@@ -81,6 +92,599 @@ class TestMongoDB(unittest.TestCase):
 
         self.assertTrue(listener_called['called'])
 
+    def test_event_log_resume(self):
+        listeners = AsyncListeners()
+
+        other = MongoDBSequenceLog(self.client.test_db.events, accept_for_serialization=lambda x: False, listeners=listeners, group_id='other_group')
+        for i in range(3):
+            other.store({'type': 'data', '_id': i})
+
+        self.assertTrue(any(index['key'] == [('group_id', 1), ('sequence_id', 1)] and index['unique'] for index in self.client.test_db.events.index_information().values()))
+
+        log = MongoDBSequenceLog(self.client.test_db.events, accept_for_serialization=lambda x: False, listeners=listeners, group_id='test_group')
+        self.assertEqual(log._sequence_id, 0)
+        log.store({'type': 'data', '_id': 0})
+
+        log = MongoDBSequenceLog(self.client.test_db.events, accept_for_serialization=lambda x: False, listeners=listeners, group_id='test_group')
+        self.assertEqual(log._sequence_id, 1)
+
+        log = MongoDBSequenceLog(self.client.test_db.events, accept_for_serialization=lambda x: False, listeners=listeners, group_id='other_group')
+        self.assertEqual(log._sequence_id, 3)
+
+    def test_event_log_multiple_writers(self):
+        listeners = AsyncListeners()
+
+        log1 = MongoDBSequenceLog(self.client.test_db.events, accept_for_serialization=lambda x: False, listeners=listeners, group_id='test_group', counters_collection=self.client.test_db.counters, block_size=3)
+        log2 = MongoDBSequenceLog(self.client.test_db.events, accept_for_serialization=lambda x: False, listeners=listeners, group_id='test_group', counters_collection=self.client.test_db.counters, block_size=3)
+
+        for i in range(4):
+            log1.store({'type': 'data', 'writer': 1, 'i': i})
+            log2.store({'type': 'data', 'writer': 2, 'i': i})
+
+        sequence_ids = [e['sequence_id'] for e in self.client.test_db.events.find({'group_id': 'test_group'}).sort('sequence_id', pymongo.ASCENDING)]
+        self.assertEqual(sequence_ids, [0, 1, 2, 3, 4, 5, 6, 9])
+
+        gaps = list()
+        event_provider = MongoDBSequenceProvider(self.client.test_db.events, listeners=listeners, group_id='test_group', on_gap=lambda first, end: gaps.append((first, end)))
+        events = list(event_provider.events())
+
+        self.assertEqual(len(events), 8)
+        self.assertEqual([e['i'] for e in events if e['writer'] == 1], list(range(4)))
+        self.assertEqual(event_provider.gaps, [(7, 9)])
+        self.assertEqual(gaps, [(7, 9)])
+
+        # a writer, which joins a group with existing events, continues after them
+        log3 = MongoDBSequenceLog(self.client.test_db.events, accept_for_serialization=lambda x: False, listeners=listeners, group_id='other_group')
+        log3.store({'type': 'data'})
+        log3 = MongoDBSequenceLog(self.client.test_db.events, accept_for_serialization=lambda x: False, listeners=listeners, group_id='other_group', counters_collection=self.client.test_db.counters)
+        log3.store({'type': 'data'})
+        self.assertEqual(mongoutil.last_sequence_id(self.client.test_db.events, 'other_group'), 1)
+
+    def test_event_log_buffered(self):
+        listeners = AsyncListeners()
+        log = MongoDBSequenceLog(self.client.test_db.events, accept_for_serialization=lambda x: True if x['type'] == 'data' else False, listeners=listeners, group_id=None, batch_size=2)
+
+        stored = list()
+        e1 = threading.Event()
+
+        def store_listener(x):
+            if x['type'] == 'store_object':
+                stored.append(x['data']['_id'])
+                if len(stored) == 4:
+                    e1.set()
+
+        listeners += store_listener
+
+        for i in range(4):
+            listeners({'type': 'data', '_id': i, 'test_numpy': np.zeros((2, 3))})
+
+        e1.wait()
+
+        self.assertEqual(stored, [0, 1, 2, 3])
+
+        log.store({'type': 'data', '_id': 4, 'test_numpy': np.zeros((2, 3))})
+        self.assertEqual(self.client.test_db.events.count_documents({'group_id': log.group_id}), 4)
+
+        log.close()
+
+        q_events = self.client.test_db.events.find({'group_id': log.group_id}).sort('sequence_id', pymongo.ASCENDING)
+        for i, e in enumerate(q_events):
+            self.assertEqual(e['sequence_id'], i)
+            self.assertEqual(e['obj']['_id'], i)
+            self.assertIsInstance(e['obj'], dict)
+
+        self.assertEqual(i, 4)
+
+        # the BSON size of the buffered documents is computed with real codec options of the collection
+        self.assertIsInstance(mongoutil.collection_codec_options(self.client.test_db.events), bson.codec_options.CodecOptions)
+
+    def test_event_log_buffered_write_error(self):
+        log = MongoDBSequenceLog(self.client.test_db.events, accept_for_serialization=lambda x: False, listeners=SyncListeners(), group_id=None, batch_size=100, flush_interval=0.01)
+
+        def failing_insert(*args, **kwargs):
+            raise pymongo.errors.AutoReconnect("connection lost")
+
+        log.collection.insert_many = failing_insert
+
+        for i in range(3):
+            log.store({'type': 'data', '_id': i})
+
+        self.assertRaises(pymongo.errors.AutoReconnect, log.flush)
+        self.assertEqual(self.client.test_db.events.count_documents({'group_id': log.group_id}), 0)
+
+        # the events are kept for the next periodic flush and its error is raised by the next store
+        while log._flush_error is None:
+            time.sleep(0.01)
+
+        del log.collection.insert_many
+
+        while self.client.test_db.events.count_documents({'group_id': log.group_id}) < 3:
+            time.sleep(0.01)
+
+        self.assertRaises(pymongo.errors.AutoReconnect, log.store, {'type': 'data', '_id': 3})
+
+        log.store({'type': 'data', '_id': 3})
+        log.close()
+
+        q_events = self.client.test_db.events.find({'group_id': log.group_id}).sort('sequence_id', pymongo.ASCENDING)
+        self.assertEqual([(e['sequence_id'], e['obj']['_id']) for e in q_events], [(i, i) for i in range(4)])
+
+    def test_metrics(self):
+        registry = MetricsRegistry()
+
+        listeners = SyncListeners()
+        log = MongoDBSequenceLog(self.client.test_db.events, accept_for_serialization=lambda x: False, listeners=listeners, group_id=None, metrics=registry)
+
+        cycle = list()
+        cycle.append(cycle)
+
+        log.store({'type': 'data', '_id': 0, 'test_numpy': np.zeros((2, 3))})
+        log.store({'type': 'data', '_id': 1, 'cycle': cycle})
+
+        events = list(MongoDBSequenceProvider(self.client.test_db.events, group_id=log.group_id, listeners=listeners, batch_size=10, metrics=registry).events())
+        self.assertEqual(len(events), 2)
+
+        snapshot = registry.snapshot()
+        self.assertEqual(snapshot['pyevents_mongo_pickle_fallback_total']['samples'][0]['value'], 1)
+        self.assertEqual(snapshot['pyevents_mongo_write_seconds']['samples'][0]['count'], 2)
+        self.assertGreater(snapshot['pyevents_mongo_serialized_bytes_total']['samples'][0]['value'], 48)
+        self.assertEqual(snapshot['pyevents_mongo_read_batch_size']['samples'][0]['sum'], 2)
+        self.assertEqual(snapshot['pyevents_mongo_read_seconds']['samples'][0]['labels'], {'collection': 'events'})
+
+    def test_checkpoint(self):
+        listeners = SyncListeners()
+        log = MongoDBSequenceLog(self.client.test_db.events, accept_for_serialization=lambda x: x['type'] == 'data', listeners=listeners, group_id='test_checkpoint', batch_size=4)
+        store = MongoDBStore(self.client.test_db.store, accept_for_serialization=lambda x: False, listeners=listeners)
+
+        model = {'total': np.zeros(3), 'events': 0}
+
+        def apply(event):
+            if event['type'] == 'data':
+                model['total'] = model['total'] + event['value']
+                model['events'] += 1
+
+        listeners += apply
+
+        coordinator = CheckpointCoordinator(store, log, get_state=lambda: dict(model))
+
+        for i in range(6):
+            listeners({'type': 'data', 'value': np.full(3, i)})
+
+        snapshot = coordinator.checkpoint()
+        self.assertEqual(snapshot['sequence_id'], 5)
+
+        for i in range(6, 10):
+            listeners({'type': 'data', 'value': np.full(3, i)})
+
+        log.close()
+
+        # recovery in a new process
+        model = {'total': np.zeros(3), 'events': 0}
+
+        def set_state(state):
+            model.update(state)
+
+        replayed = SyncListeners()
+        replayed += apply
+
+        recovery = CheckpointCoordinator(store, MongoDBSequenceLog(self.client.test_db.events, accept_for_serialization=lambda x: False, listeners=SyncListeners(), group_id='test_checkpoint'),
+                                         get_state=lambda: dict(model), set_state=set_state)
+        state = recovery.recover(replayed)
+
+        self.assertEqual(state['events'], 6)
+        self.assertEqual(model['events'], 10)
+        self.assertTrue(np.array_equal(model['total'], np.full(3, 45)))
+
+        self.assertIsNone(CheckpointCoordinator(store, log, get_state=dict, checkpoint_id='missing').latest())
+
+        # an event, which arrives during a checkpoint, waits for the state_lock instead of slipping between position and state
+        listeners = SyncListeners()
+        log = MongoDBSequenceLog(self.client.test_db.events, accept_for_serialization=lambda x: x['type'] == 'data', listeners=listeners, group_id='test_checkpoint_lock')
+        listeners += apply
+        model = {'total': np.zeros(3), 'events': 0}
+
+        def send(i):
+            with coordinator.state_lock:
+                listeners({'type': 'data', 'value': np.full(3, i)})
+
+        def get_state():
+            sender = threading.Thread(target=send, args=(1,))
+            sender.start()
+            sender.join(0.1)
+            return dict(model)
+
+        coordinator = CheckpointCoordinator(store, log, get_state=get_state, checkpoint_id='lock')
+        send(0)
+
+        snapshot = coordinator.checkpoint()
+        self.assertEqual((snapshot['sequence_id'], snapshot['state']['events']), (0, 1))
+
+    def test_event_provider_prefetch(self):
+        listeners = AsyncListeners()
+        log = MongoDBSequenceLog(self.client.test_db.events, accept_for_serialization=lambda x: True if x['type'] == 'data' else False, listeners=listeners, group_id=None, batch_size=10)
+
+        for i in range(25):
+            log.store({'type': 'data', '_id': i, 'test_numpy': np.full((2, 3), i)})
+
+        log.close()
+
+        event_provider = MongoDBSequenceProvider(self.client.test_db.events, listeners=listeners, group_id=log.group_id, batch_size=4, prefetch=2, decode_workers=3)
+
+        events = list(event_provider.events())
+        self.assertEqual([e['_id'] for e in events], list(range(25)))
+        for i, e in enumerate(events):
+            self.assertTrue(isinstance(e['test_numpy'], np.ndarray))
+            self.assertEqual(e['test_numpy'][0, 0], i)
+
+    def test_event_provider_early_close(self):
+        log = MongoDBSequenceLog(self.client.test_db.events, accept_for_serialization=lambda x: False, listeners=SyncListeners(), group_id=None, batch_size=100)
+        for i in range(500):
+            log.store({'type': 'data', '_id': i})
+        log.close()
+
+        registry = MetricsRegistry()
+        event_provider = MongoDBSequenceProvider(self.client.test_db.events, listeners=SyncListeners(), group_id=log.group_id, batch_size=10, prefetch=2, metrics=registry)
+
+        events = event_provider.events()
+        self.assertEqual(next(events)['_id'], 0)
+        events.close()
+
+        # the prefetching stops with the consumer instead of reading the rest of the cursor
+        reads = registry.snapshot()['pyevents_mongo_read_batch_size']['samples'][0]['count']
+        self.assertLessEqual(reads, 5)
+
+    def test_ndarray_encoding(self):
+        for arr in [np.arange(12, dtype=np.float32).reshape(3, 4), np.arange(6, dtype='>i4').reshape(2, 3)[:, ::2], np.zeros((0, 3)), np.array(5)]:
+            self.client.test_db.arrays.replace_one({'_id': 0}, {'_id': 0, 'arr': mongoutil.default_encoder(arr)}, upsert=True)
+            result = mongoutil.default_decoder(self.client.test_db.arrays.find_one({'_id': 0}))['arr']
+            self.assertEqual(result.dtype, arr.dtype)
+            self.assertEqual(result.shape, arr.shape)
+            self.assertTrue(np.array_equal(result, arr))
+
+        # structured dtypes keep their field names, nested fields and subarray shapes
+        structured = np.zeros(3, dtype=[('id', '<i4'), ('position', '>f8', (2,)), ('meta', [('flag', '?'), ('name', 'U4')])])
+        structured['id'] = [1, 2, 3]
+        structured['position'][1] = [0.5, -1]
+        structured['meta']['name'] = ['a', 'bc', 'def']
+        self.client.test_db.arrays.replace_one({'_id': 0}, {'_id': 0, 'arr': mongoutil.default_encoder(structured)}, upsert=True)
+        result = mongoutil.default_decoder(self.client.test_db.arrays.find_one({'_id': 0}))['arr']
+        self.assertEqual(result.dtype, structured.dtype)
+        self.assertEqual(result.dtype.names, ('id', 'position', 'meta'))
+        self.assertTrue(np.array_equal(result, structured))
+
+        # legacy base64 format
+        arr = np.arange(6, dtype=np.float64).reshape(2, 3)
+        legacy = dict(__ndarray__=base64.b64encode(arr.data), dtype=str(arr.dtype), shape=arr.shape)
+        self.assertTrue(np.array_equal(mongoutil.default_decoder(legacy), arr))
+
+    def test_chunked_replay_order(self):
+        chunks = ChunkStore(self.client.test_db.chunks, threshold=400, chunk_size=256)
+        log = MongoDBSequenceLog(self.client.test_db.events, accept_for_serialization=lambda x: False, listeners=SyncListeners(), group_id=None, encoder=chunks.encode)
+
+        for i in range(4):
+            log.store({'type': 'data', 'phase': 'TRAINING_unordered', 'data': np.full(100, i, dtype=np.float64)})
+
+        def replay(listeners):
+            ordered = list()
+            listeners += lambda event: ordered.append(event) if event['type'] == 'data' and event['phase'] == 'TRAINING' else None
+
+            MongoDBSequenceProvider(self.client.test_db.events, listeners=listeners, group_id=log.group_id, decoder=chunks.decode)()
+
+            return ordered
+
+        # the lazy documents of the chunked events are ordered like dicts
+        listeners = SyncListeners()
+        order = AlgoPhaseEventsOrder(phases=[('TRAINING', 4), (None, 0)], listeners=listeners)
+        ordered = replay(listeners)
+        order.stop()
+        self.assertTrue(order.join(5))
+
+        self.assertEqual([e['data'][0] for e in ordered], [0, 1, 2, 3])
+        self.assertIsInstance(ordered[0], LazyDocument)
+
+        async def main():
+            listeners = SyncListeners()
+            order = AsyncAlgoPhaseEventsOrder(phases=[('TRAINING', 4), (None, 0)], listeners=listeners)
+            ordered = replay(listeners)
+            order.stop()
+            await order.join()
+
+            return ordered
+
+        self.assertEqual([e['data'][0] for e in asyncio.run(main())], [0, 1, 2, 3])
+
+    def test_chunked_storage(self):
+        listeners = AsyncListeners()
+        chunks = ChunkStore(self.client.test_db.chunks, threshold=400, chunk_size=256)
+
+        log = MongoDBSequenceLog(self.client.test_db.events, accept_for_serialization=lambda x: True if x['type'] == 'data' else False, listeners=listeners, group_id=None, encoder=chunks.encode)
+        log.store({'type': 'data', '_id': 0, 'large': np.arange(1000, dtype=np.float64), 'small': np.zeros(3)})
+
+        e = self.client.test_db.events.find_one({'group_id': log.group_id})
+        self.assertTrue(is_chunk_reference(e['obj']['large']['__ndarray__']))
+        self.assertEqual(self.client.test_db.chunks.count_documents({}), 32)
+
+        events = list(MongoDBSequenceProvider(self.client.test_db.events, listeners=listeners, group_id=log.group_id, decoder=chunks.decode).events())
+        self.assertEqual(len(events), 1)
+        self.assertTrue(events[0].is_loaded('small'))
+        self.assertFalse(events[0].is_loaded('large'))
+        self.assertTrue(np.array_equal(events[0]['large'], np.arange(1000, dtype=np.float64)))
+        self.assertTrue(events[0].is_loaded('large'))
+
+        store = MongoDBStore(self.client.test_db.store, listeners=listeners, accept_for_serialization=lambda x: False, encoder=chunks.encode)
+        store.store(TestMongoDB.TestLogComposite(0))
+        self.assertTrue(is_chunk_reference(self.client.test_db.store.find_one({'_id': 0})['_test_numpy']['__ndarray__']))
+
+        obj = store.restore(self.client.test_db.store, 0, decoder=chunks.decode)
+        self.assertEqual(obj._id, 0)
+        self.assertEqual(type(obj._test_numpy), np.ndarray)
+
+        # all access paths return the loaded values
+        events = list(MongoDBSequenceProvider(self.client.test_db.events, listeners=listeners, group_id=log.group_id, decoder=chunks.decode).events())
+        self.assertTrue(np.array_equal(dict(events[0])['large'], np.arange(1000, dtype=np.float64)))
+        self.assertTrue(all(isinstance(v, (str, int, np.ndarray)) for v in {**events[0]}.values()))
+
+        # the chunks of replaced versions and of discarded encodings are deleted
+        self.client.test_db.chunks.delete_many({})
+        for delta, max_pending in ((False, None), (True, None), (False, 2)):
+            store = MongoDBStore(self.client.test_db.store, listeners=listeners, accept_for_serialization=lambda x: False, encoder=chunks.encode, delta=delta, max_pending=max_pending)
+            for i in range(5):
+                store.store({'_id': 1, 'large': np.full(1000, i, dtype=np.float64)})
+            store.close()
+
+            self.assertEqual(self.client.test_db.chunks.count_documents({}), 32)
+            self.assertTrue(np.array_equal(store.restore(self.client.test_db.store, 1, decoder=chunks.decode)['large'], np.full(1000, 4, dtype=np.float64)))
+
+        # the value 2 ** 70 can't be stored in a document, so the object falls back to pickling
+        store.store({'_id': 1, 'large': np.arange(1000, dtype=np.float64), 'big': 2 ** 70})
+        store.close()
+        self.assertEqual(store.restore(self.client.test_db.store, 1, decoder=chunks.decode)['big'], 2 ** 70)
+        files_id = self.client.test_db.store.find_one({'_id': 1})['binary_data']['__chunked__']
+        self.assertEqual(self.client.test_db.chunks.count_documents({}), self.client.test_db.chunks.count_documents({'files_id': files_id}))
+
+    def test_compression(self):
+        listeners = AsyncListeners()
+        encoder = mongoutil.CompressingEncoder(codec='zlib', threshold=100, compress_fields=True)
+
+        log = MongoDBSequenceLog(self.client.test_db.events, accept_for_serialization=lambda x: True if x['type'] == 'data' else False, listeners=listeners, group_id=None, encoder=encoder)
+        log.store({'type': 'data', '_id': 0, 'test_numpy': np.zeros((100, 10)), 'test_dict': {str(i): i for i in range(100)}})
+
+        e = self.client.test_db.events.find_one({'group_id': log.group_id})
+        self.assertEqual(e['obj']['test_numpy']['__ndarray__']['__compressed__'], 'zlib')
+        self.assertEqual(e['obj']['test_dict']['__compressed__'], 'zlib')
+        self.assertEqual(e['obj']['type'], 'data')
+
+        event = mongoutil.default_decoder(e['obj'])
+        self.assertTrue(np.array_equal(event['test_numpy'], np.zeros((100, 10))))
+        self.assertEqual(event['test_dict'], {str(i): i for i in range(100)})
+
+        # nested fields with compressed values aren't compressed twice
+        for obj in ({'d': {'x': np.zeros(100000)}}, {'d': {'s': 'a' * 200000}}, {'d': [{'x': np.arange(1000)}]}):
+            decoded = mongoutil.default_decoder(bson.decode(bson.encode(encoder(obj))))
+            np.testing.assert_equal(decoded, obj)
+
+        store = MongoDBStore(self.client.test_db.store, listeners=listeners, accept_for_serialization=lambda x: False, encoder=mongoutil.CompressingEncoder(codec='lzma', threshold=100))
+        store.store(TestMongoDB.TestLogComposite(0))
+        self.assertEqual(self.client.test_db.store.find_one({'_id': 0})['_test_numpy']['__ndarray__']['__compressed__'], 'lzma')
+
+        obj = store.restore(self.client.test_db.store, 0)
+        self.assertEqual(obj._id, 0)
+        self.assertEqual(type(obj._test_numpy), np.ndarray)
+
+        stats = mongoutil.codec_stats()
+        self.assertLess(stats['zlib']['ratio'], 1)
+        self.assertGreater(stats['lzma']['decompress_calls'], 0)
+
+    def test_structured_encoding(self):
+        obj = TestMongoDB.TestLogComposite(0)
+        obj.test_dataclass = TestMongoDB.TestDataclass(1, np.ones(3))
+        obj.test_slots = TestMongoDB.TestSlots((1, 2), b'bytes')
+        obj.test_int = np.int64(5)
+
+        self.client.test_db.store.replace_one({'_id': 0}, mongoutil.default_encoder(obj), upsert=True)
+
+        self.assertEqual(self.client.test_db.store.count_documents({'_test_nested.nested': 'nested', 'test_dataclass.value': 1}), 1)
+
+        result = mongoutil.default_decoder(self.client.test_db.store.find_one({'_id': 0}))
+        self.assertEqual(type(result), TestMongoDB.TestLogComposite)
+        self.assertEqual(type(result._test_numpy), np.ndarray)
+
+        # slotted events are encoded as dicts
+        from pyevents_util.events import AfterIterationEvent
+        self.assertEqual(mongoutil.default_encoder(AfterIterationEvent(None, 'TESTING', 1, (1, 2), 3)),
+                         {'type': 'after_iteration', 'model': None, 'phase': 'TESTING', 'iteration': 1, 'model_input': {'__tuple__': [1, 2]}, 'model_output': 3})
+        self.assertEqual(result._test_nested.nested, 'nested')
+        self.assertEqual(result.test_list, [(123, 'abc'), (1, 2, 3)])
+        self.assertEqual(result.test_tuple, (123, 'abc'))
+        self.assertEqual(result.test_dataclass.value, 1)
+        self.assertTrue(np.array_equal(result.test_dataclass.array, np.ones(3)))
+        self.assertEqual(result.test_slots.a, (1, 2))
+        self.assertEqual(result.test_slots.b, b'bytes')
+        self.assertEqual(result.test_int, 5)
+
+        # classes with custom pickling are pickled instead of being restored from their attributes
+        obj = TestMongoDB.TestPickling(3)
+        encoded = mongoutil.default_encoder({'obj': obj})
+        self.assertIsInstance(encoded['obj'], bytes)
+        result = mongoutil.default_decoder(encoded)['obj']
+        self.assertEqual((result.value, result.restored), (3, True))
+
+        # dicts with marker keys are not decoded as encoded values
+        user_dict = {'_id': 1, '__class__': 'os:getcwd', 'nested': {'__tuple__': [1], '__ndarray__': 'x'}}
+        self.client.test_db.store.replace_one({'_id': 1}, mongoutil.default_encoder(user_dict), upsert=True)
+        self.assertEqual(mongoutil.default_decoder(self.client.test_db.store.find_one({'_id': 1})), user_dict)
+
+        # deep nesting
+        nested = list()
+        for i in range(10000):
+            nested = [nested]
+
+        result = mongoutil.default_decoder(mongoutil.default_encoder(nested))
+        for i in range(10000):
+            result = result[0]
+
+        self.assertEqual(result, [])
+
+        # cyclic references fall back to pickle
+        cyclic = {'type': 'data', 'list': []}
+        cyclic['list'].append(cyclic)
+        self.assertRaises(TypeError, mongoutil.default_encoder, cyclic)
+
+        listeners = AsyncListeners()
+        log = MongoDBSequenceLog(self.client.test_db.events, accept_for_serialization=lambda x: True if x['type'] == 'data' else False, listeners=listeners, group_id=None)
+        log.store(cyclic)
+
+        result = mongoutil.default_decoder(self.client.test_db.events.find_one({'group_id': log.group_id})['obj'])
+        self.assertIs(result['list'][0], result)
+
+    def test_event_provider_range(self):
+        listeners = AsyncListeners()
+        log = MongoDBSequenceLog(self.client.test_db.events, accept_for_serialization=lambda x: False, listeners=listeners, group_id=None)
+
+        for i in range(10):
+            log.store({'type': 'data', '_id': i, 'phase': 'TRAINING' if i % 2 == 0 else 'TESTING', 'test_numpy': np.zeros((2, 3))})
+
+        event_provider = MongoDBSequenceProvider(self.client.test_db.events, listeners=listeners, group_id=log.group_id, start=2, end=8, event_filter={'phase': 'TESTING'}, fields=['_id', 'phase'])
+        events = list(event_provider.events())
+        self.assertEqual(events, [{'_id': 3, 'phase': 'TESTING'}, {'_id': 5, 'phase': 'TESTING'}, {'_id': 7, 'phase': 'TESTING'}])
+        self.assertEqual(event_provider.resume_token, 8)
+
+        # events, which fall back to pickling, are loaded whole
+        cyclic = TestMongoDB.TestLogCompositeNested()
+        cyclic.cycle = cyclic
+        mixed_log = MongoDBSequenceLog(self.client.test_db.events, accept_for_serialization=lambda x: False, listeners=listeners, group_id=None)
+        for obj in ({'type': 'data', 'phase': 'TRAINING'}, cyclic, {'type': 'data', 'phase': 'TESTING', 'test_numpy': np.zeros(3)}):
+            mixed_log.store(obj)
+
+        mixed_log.store({'type': 'data', 'phase': 'TESTING', '__class__': 'escaped'})
+
+        for compact in (False, True):
+            if compact:
+                # the packed events of segments have their whole obj
+                self.assertEqual(SequenceLogCompactor(self.client.test_db.events, segment_size=10, min_segment_size=1).compact(mixed_log.group_id), 4)
+
+            events = list(MongoDBSequenceProvider(self.client.test_db.events, listeners=listeners, group_id=mixed_log.group_id, fields=['phase']).events())
+            self.assertEqual(events[0], {'phase': 'TRAINING'})
+            self.assertIs(events[1].cycle, events[1])
+            self.assertEqual(events[2], {'phase': 'TESTING'})
+            self.assertEqual(events[3], {'type': 'data', 'phase': 'TESTING', '__class__': 'escaped'})
+
+        # resume interrupted replay
+        event_provider = MongoDBSequenceProvider(self.client.test_db.events, listeners=listeners, group_id=log.group_id, batch_size=3, prefetch=1)
+        events = event_provider.events()
+        for i in range(4):
+            self.assertEqual(next(events)['_id'], i)
+
+        events.close()
+        self.assertEqual(event_provider.resume_token, 3)
+
+        events = list(event_provider.events(event_provider.resume_token))
+        self.assertEqual([e['_id'] for e in events], list(range(3, 10)))
+        self.assertEqual(event_provider.gaps, [])
+
+    def test_compaction(self):
+        listeners = SyncListeners()
+        collection = self.client.test_db.events
+        log = MongoDBSequenceLog(collection, accept_for_serialization=lambda x: False, listeners=listeners, group_id=None)
+
+        for i in range(25):
+            log.store({'type': 'data', '_id': i, 'phase': 'TRAINING' if i % 2 == 0 else 'TESTING', 'test_numpy': np.full((2, 3), i)})
+
+        compactor = SequenceLogCompactor(collection, segment_size=10)
+        self.assertEqual(compactor.compact(log.group_id, before=22), 20)
+        self.assertEqual(collection.count_documents({'group_id': log.group_id}), 7)
+        self.assertEqual(mongoutil.last_sequence_id(collection, log.group_id), 24)
+
+        # the remaining events are compacted with the next run
+        self.assertEqual(compactor.compact(log.group_id), 0)
+        log.store({'type': 'data', '_id': 25, 'phase': 'TESTING', 'test_numpy': np.full((2, 3), 25)})
+
+        events = list(MongoDBSequenceProvider(collection, listeners=listeners, group_id=log.group_id, batch_size=4).events())
+        self.assertEqual([e['_id'] for e in events], list(range(26)))
+        self.assertTrue(all(np.array_equal(e['test_numpy'], np.full((2, 3), e['_id'])) for e in events))
+
+        event_provider = MongoDBSequenceProvider(collection, listeners=listeners, group_id=log.group_id, start=5, end=23, event_filter={'phase': 'TESTING'}, fields=['_id', 'phase'])
+        self.assertEqual(list(event_provider.events()), [{'_id': i, 'phase': 'TESTING'} for i in range(5, 23, 2)])
+
+        # events of an interrupted compaction are replayed once
+        segment = collection.find_one({'group_id': log.group_id, 'sequence_id': 0})
+        collection.insert_one({'group_id': log.group_id, 'sequence_id': 3, 'obj': mongoutil.decode_segment(segment)[3]['obj']})
+        event_provider = MongoDBSequenceProvider(collection, listeners=listeners, group_id=log.group_id, start=2)
+        self.assertEqual([e['_id'] for e in event_provider.events()], list(range(2, 26)))
+        self.assertEqual(event_provider.gaps, [])
+
+        # the segment of start is found with the segment index, even after a leftover event
+        self.assertIn(mongoutil.SEGMENT_INDEX, [[tuple(k) for k in i['key']] for i in collection.index_information().values()])
+        self.assertEqual([e['_id'] for e in MongoDBSequenceProvider(collection, listeners=listeners, group_id=log.group_id, start=5).events()], list(range(5, 26)))
+
+        # retention
+        self.assertEqual(compactor.apply_retention(log.group_id, keep_last=12), 2)
+        self.assertEqual([e['_id'] for e in MongoDBSequenceProvider(collection, listeners=listeners, group_id=log.group_id, start=10).events()], list(range(10, 26)))
+
+        self.assertEqual(compactor.apply_retention(log.group_id, older_than=datetime.timedelta(hours=1)), 0)
+        remaining = collection.count_documents({'group_id': log.group_id})
+        self.assertEqual(compactor.apply_retention(log.group_id, before=26), remaining)
+        self.assertIsNone(mongoutil.last_sequence_id(collection, log.group_id))
+
+        log = MongoDBSequenceLog(collection, accept_for_serialization=lambda x: False, listeners=listeners, group_id=None, expire_after=3600)
+        log.store({'type': 'data'})
+        self.assertIn('created', collection.find_one({'group_id': log.group_id}))
+        self.assertTrue(any(i.get('expireAfterSeconds') == 3600 for i in collection.index_information().values()))
+
+    def test_columns(self):
+        listeners = SyncListeners()
+        collection = self.client.test_db.events
+        log = MongoDBSequenceLog(collection, accept_for_serialization=lambda x: False, listeners=listeners, group_id=None)
+
+        for i in range(10):
+            event = {'type': 'data', 'phase': 'TRAINING', 'iteration': i, 'loss': i / 10, 'data': {'input': np.full((2, 3), i, dtype=np.float32), 'tags': [i]}}
+            if i % 2 == 0:
+                event['label'] = i
+            log.store(event)
+
+        columns = MongoDBSequenceProvider(collection, listeners=listeners, group_id=log.group_id, start=2, batch_size=3).columns()
+        self.assertEqual(columns.size, 8)
+        np.testing.assert_array_equal(columns['sequence_id'], np.arange(2, 10))
+        np.testing.assert_array_equal(columns['iteration'], np.arange(2, 10))
+        self.assertEqual(columns['iteration'].dtype, np.int64)
+        self.assertEqual(columns['loss'].dtype, np.float64)
+        self.assertEqual(columns['phase'].tolist(), ['TRAINING'] * 8)
+        self.assertEqual(columns['data.input'].shape, (8, 2, 3))
+        self.assertEqual(columns['data.input'].dtype, np.float32)
+        np.testing.assert_array_equal(columns['data.input'][:, 0, 0], np.arange(2, 10))
+        self.assertEqual(columns['data.tags'].dtype, object)
+        np.testing.assert_array_equal(columns.valid['label'], np.arange(2, 10) % 2 == 0)
+        self.assertNotIn('iteration', columns.valid)
+
+        # arrays with different shapes become object columns
+        columns_mixed = EventColumns.from_events([(0, {'x': np.zeros(3)}), (1, {'x': np.zeros(2)}), (2, {'x': np.array([None])})])
+        self.assertEqual(columns_mixed['x'].dtype, object)
+        self.assertEqual([len(x) for x in columns_mixed['x']], [3, 2, 1])
+
+        self.assertRaises(ValueError, EventColumns.from_events, [(0, {'sequence_id': 1})])
+
+        with tempfile.TemporaryDirectory() as directory:
+            columns.save_npz(os.path.join(directory, 'columns.npz'))
+            columns.save_npy(os.path.join(directory, 'npy'))
+
+            for loaded in (EventColumns.load_npz(os.path.join(directory, 'columns.npz')), EventColumns.load_npy(os.path.join(directory, 'npy'))):
+                self.assertEqual(set(loaded), set(columns))
+                np.testing.assert_array_equal(loaded['data.input'], columns['data.input'])
+                np.testing.assert_array_equal(loaded.valid['label'], columns.valid['label'])
+                self.assertEqual(loaded['data.tags'].tolist(), columns['data.tags'].tolist())
+
+            self.assertIsInstance(loaded['data.input'], np.memmap)
+
+            if pyarrow is not None:
+                columns.save_arrow(os.path.join(directory, 'columns.arrow'))
+                columns.save_parquet(os.path.join(directory, 'columns.parquet'))
+
+                for loaded in (EventColumns.load_arrow(os.path.join(directory, 'columns.arrow')), EventColumns.load_parquet(os.path.join(directory, 'columns.parquet'))):
+                    np.testing.assert_array_equal(loaded['data.input'], columns['data.input'])
+                    np.testing.assert_array_equal(loaded['loss'], columns['loss'])
+                    np.testing.assert_array_equal(loaded.valid['label'], columns.valid['label'])
+                    self.assertEqual(loaded['data.tags'].tolist(), columns['data.tags'].tolist())
+
     def test_event_log_with_composite_objects(self):
         global_listeners = AsyncListeners()
 
@@ -195,6 +799,159 @@ class TestMongoDB(unittest.TestCase):
         self.assertEqual(type(obj_result._test_numpy), np.ndarray)
         self.assertEqual(obj_result._test_numpy[0, 0, 0], 5)
 
+    def test_store_write_behind(self):
+        listeners = AsyncListeners()
+
+        store = MongoDBStore(self.client.test_db.store, listeners=listeners, accept_for_serialization=lambda x: False, max_pending=2)
+
+        obj = TestMongoDB.TestLogComposite(0)
+        for i in range(5):
+            obj._test_numpy[0, 0, 0] = i
+            store.store(obj)
+
+        self.assertEqual(self.client.test_db.store.count_documents({}), 0)
+
+        store.store(TestMongoDB.TestLogComposite(1))
+        self.assertEqual(self.client.test_db.store.count_documents({}), 2)
+
+        store.store({'_id': 2, 'value': 'value'})
+        store.close()
+
+        self.assertEqual(store.restore(self.client.test_db.store, 0)._test_numpy[0, 0, 0], 4)
+        self.assertEqual(store.restore(self.client.test_db.store, 2)['value'], 'value')
+        self.assertEqual(store.write_stats, {'stored': 7, 'coalesced': 4, 'written': 3, 'updated': 0, 'unchanged': 0})
+
+    def test_store_write_error(self):
+        store = MongoDBStore(self.client.test_db.store, listeners=SyncListeners(), accept_for_serialization=lambda x: False, max_pending=100)
+
+        newer = [{'_id': 1, 'value': 'newer'}]
+
+        def failing_write(*args, **kwargs):
+            if newer:
+                # a newer version is stored during the first failing write
+                store.store(newer.pop())
+
+            raise pymongo.errors.AutoReconnect("connection lost")
+
+        store.collection.bulk_write = failing_write
+
+        for i in range(3):
+            store.store({'_id': i, 'value': 'value ' + str(i)})
+
+        # the failed objects are kept, but don't overwrite the newer versions
+        self.assertRaises(pymongo.errors.AutoReconnect, store.flush)
+        self.assertEqual(list(store._pending), [0, 2, 1])
+
+        del store.collection.bulk_write
+        store.close()
+
+        self.assertEqual(self.client.test_db.store.count_documents({}), 3)
+        self.assertEqual(store.restore(self.client.test_db.store, 1)['value'], 'newer')
+        self.assertEqual(store.write_stats['coalesced'], 1)
+
+        # the chunks of the unwritten objects are deleted
+        chunks = ChunkStore(self.client.test_db.chunks, threshold=400, chunk_size=256)
+        store = MongoDBStore(self.client.test_db.store, listeners=SyncListeners(), accept_for_serialization=lambda x: False, max_pending=100, encoder=chunks.encode)
+        store.collection.bulk_write = failing_write
+
+        store.store({'_id': 0, 'large': np.arange(1000, dtype=np.float64)})
+        self.assertRaises(pymongo.errors.AutoReconnect, store.flush)
+        self.assertEqual(self.client.test_db.chunks.count_documents({}), 0)
+
+        del store.collection.bulk_write
+        store.close()
+        self.assertEqual(self.client.test_db.chunks.count_documents({}), 32)
+
+        # the error of the periodic flush is raised by the next store and close
+        store = MongoDBStore(self.client.test_db.store, listeners=SyncListeners(), accept_for_serialization=lambda x: False, flush_interval=0.01)
+        store.collection.bulk_write = failing_write
+
+        store.store({'_id': 3, 'value': 'value 3'})
+
+        while store._flush_error is None:
+            time.sleep(0.01)
+
+        self.assertRaises(pymongo.errors.AutoReconnect, store.store, {'_id': 4, 'value': 'value 4'})
+
+        store.store({'_id': 4, 'value': 'value 4'})
+
+        while store._flush_error is None:
+            time.sleep(0.01)
+
+        del store.collection.bulk_write
+        self.assertRaises(pymongo.errors.AutoReconnect, store.close)
+
+        self.assertEqual(self.client.test_db.store.count_documents({}), 5)
+
+    def test_store_cache(self):
+        listeners = AsyncListeners()
+
+        store = MongoDBStore(self.client.test_db.store, listeners=listeners, accept_for_serialization=lambda x: False, cache_size=2, versioned=True)
+
+        for i in range(3):
+            store.store(TestMongoDB.TestLogComposite(i))
+
+        obj = store.load(0)
+        self.assertIs(store.load(0), obj)
+        self.assertEqual(obj._id, 0)
+        self.assertFalse(hasattr(obj, VERSION_FIELD))
+
+        store.load(1)
+        store.load(2)
+        self.assertIsNot(store.load(0), obj)
+
+        # invalidation by store
+        obj = TestMongoDB.TestLogComposite(0)
+        obj._test_numpy[0, 0, 0] = 5
+        store.store(obj)
+        self.assertEqual(store.load(0)._test_numpy[0, 0, 0], 5)
+
+        # version check for writes by another store
+        other = MongoDBStore(self.client.test_db.store, listeners=listeners, accept_for_serialization=lambda x: False, versioned=True)
+        obj._test_numpy[0, 0, 0] = 6
+        other.store(obj)
+        self.assertEqual(store.load(0)._test_numpy[0, 0, 0], 6)
+
+        self.assertEqual(store.restore(self.client.test_db.store, 0)._test_numpy[0, 0, 0], 6)
+
+        stats = store.cache_stats
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 5)
+        self.assertEqual(stats['evictions'], 2)
+        self.assertEqual(stats['entries'], 2)
+
+    def test_store_delta(self):
+        listeners = AsyncListeners()
+
+        store = MongoDBStore(self.client.test_db.store, listeners=listeners, accept_for_serialization=lambda x: False, delta=True)
+
+        obj = TestMongoDB.TestLogComposite(0)
+        obj.counter = 0
+        store.store(obj)
+
+        obj.counter = 1
+        store.store(obj)
+        store.store(obj)
+
+        del obj.test_tuple
+        store.store(obj)
+
+        result = store.restore(self.client.test_db.store, 0)
+        self.assertEqual(result.counter, 1)
+        self.assertFalse(hasattr(result, 'test_tuple'))
+        self.assertEqual(type(result._test_numpy), np.ndarray)
+
+        # changed type
+        store.store({'_id': 0, 'value': 'value'})
+        self.assertEqual(store.restore(self.client.test_db.store, 0), {'_id': 0, 'value': 'value'})
+
+        # the document was removed
+        self.client.test_db.store.delete_many({})
+        store.store({'_id': 0, 'value': 'value 2'})
+        self.assertEqual(store.restore(self.client.test_db.store, 0), {'_id': 0, 'value': 'value 2'})
+
+        self.assertEqual(store.write_stats, {'stored': 6, 'coalesced': 0, 'written': 5, 'updated': 3, 'unchanged': 1})
+
     def tearDown(self):
         self.client.drop_database('test_db')
         self.client = None
@@ -203,6 +960,30 @@ class TestMongoDB(unittest.TestCase):
         def __init__(self):
             self.nested = 'nested'
 
+    @dataclasses.dataclass
+    class TestDataclass(object):
+        value: int
+        array: np.ndarray
+
+    class TestSlots(object):
+        __slots__ = ('a', 'b')
+
+        def __init__(self, a, b):
+            self.a = a
+            self.b = b
+
+    class TestPickling(object):
+        def __init__(self, value):
+            self.value = value
+            self.restored = False
+
+        def __getstate__(self):
+            return {'value': self.value}
+
+        def __setstate__(self, state):
+            self.value = state['value']
+            self.restored = True
+
     class TestLogComposite(object):
         def __init__(self, _id):
             self._id = _id